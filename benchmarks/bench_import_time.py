@@ -0,0 +1,117 @@
+# ==============================================================================
+# قياس زمن بدء التشغيل (Import Time) — الواجهة والمحرك والخدمة
+# ==============================================================================
+# كل هدف يُستورد في مفسّر جديد (بدون cache للوحدات) عدة مرات ويُؤخذ الوسيط:
+# - app     : الاستيرادات في المستوى الأعلى من "streamlit run app.py" (ما يدفعه أول تحميل للصفحة)
+# - engine  : mrp_engine
+# - service : mrp_service
+#
+# python benchmarks/bench_import_time.py --repeat 5 --budget app=1500 --budget engine=800
+#
+# --budget  : حد أقصى بالمللي ثانية لهدف — الخروج برمز 1 عند تجاوزه (للاستخدام في CI)
+# كما يفشل القياس إذا استُورِدت وحدة من FORBIDDEN_AT_STARTUP عند بدء التشغيل
+# (هذه الوحدات يجب أن تُستورد داخل الأقسام التي تستخدمها فقط)
+# ==============================================================================
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_SCRIPT = os.path.join(ROOT, "streamlit run app.py")
+
+# وحدات ثقيلة أو اختيارية — مكانها داخل الأقسام/الدوال وليس عند بدء التشغيل
+FORBIDDEN_AT_STARTUP = ("plotly.express", "duckdb", "numba", "openpyxl", "matplotlib")
+
+
+def app_imports():
+    """أسطر import في المستوى الأعلى من سكربت الواجهة فقط (بدون تنفيذ الواجهة نفسها)"""
+    with open(APP_SCRIPT, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return "\n".join(
+        ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+TARGETS = {
+    "app":     app_imports,
+    "engine":  lambda: "import mrp_engine",
+    "service": lambda: "import mrp_service",
+}
+
+
+def _importtime(code):
+    """تشغيل كود في مفسّر جديد مع -X importtime — المخرجات: (stdout, [(ms, وحدة مستوردة مباشرة)])"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    # سطر importtime: "import time: self | cumulative | name" — المسافة البادئة في name = العمق
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):   # الوحدات المستوردة مباشرة فقط (بدون مسافة بادئة إضافية)
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return proc.stdout, modules
+
+
+def measure(code, baseline=()):
+    """
+    استيراد في عملية جديدة مع -X importtime
+
+    baseline: وحدات بدء المفسّر — لا تُعرض ضمن الأثقل
+    المخرجات: (الزمن الكلي بالمللي ثانية, أثقل الوحدات [(ms, name)], الوحدات الممنوعة التي استُوردت)
+    """
+    probe = (
+        "import sys, time\n"
+        "_t = time.perf_counter()\n"
+        f"{code}\n"
+        "print((time.perf_counter() - _t) * 1000)\n"
+        f"print('forbidden:' + ','.join(m for m in {FORBIDDEN_AT_STARTUP!r} if m in sys.modules))\n"
+    )
+    stdout, modules = _importtime(probe)
+    total_line, forbidden_line = stdout.strip().splitlines()[-2:]
+    forbidden_line = forbidden_line[len("forbidden:"):]
+    # وحدات بدء المفسّر نفسه (site / encodings ...) ليست من تكلفة البرنامج
+    heaviest = sorted((m for m in modules if m[1] not in baseline), reverse=True)
+    return float(total_line), heaviest, [m for m in forbidden_line.split(",") if m]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="قياس زمن الاستيراد عند بدء التشغيل")
+    parser.add_argument("targets", nargs="*", help=f"من {list(TARGETS)} — الافتراضي: كلها")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="عدد الوحدات الأثقل المعروضة")
+    parser.add_argument("--budget", action="append", default=[], metavar="TARGET=MS")
+    args = parser.parse_args(argv)
+    unknown = set(args.targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"أهداف غير معروفة: {sorted(unknown)}")
+    budgets = {name: float(ms) for name, ms in (b.split("=", 1) for b in args.budget)}
+
+    baseline = {name for _, name in _importtime("pass")[1]}
+    failed = False
+    for name in args.targets or list(TARGETS):
+        code = TARGETS[name]()
+        runs = [measure(code, baseline) for _ in range(args.repeat)]
+        total = statistics.median(r[0] for r in runs)
+        heaviest, forbidden = runs[-1][1], runs[-1][2]
+
+        print(f"\n⏱️ {name}: {total:.0f} ms (وسيط {args.repeat} تشغيلات)")
+        for ms, module in heaviest[:args.top]:
+            print(f"    {ms:8.1f} ms  {module}")
+        if forbidden:
+            print(f"    ❌ وحدات لا يجب استيرادها عند البدء: {', '.join(forbidden)}")
+            failed = True
+        if name in budgets and total > budgets[name]:
+            print(f"    ❌ تجاوز الحد: {total:.0f} ms > {budgets[name]:.0f} ms")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2876 @@
+# ==============================================================================
+# MRP Engine — قراءة البيانات وحساب الـ BOM Explosion (بدون واجهة)
+# ==============================================================================
+# الدوال هنا لا تعتمد على Streamlit حتى يمكن استدعاؤها من:
+# - واجهة البرنامج (streamlit run app.py)
+# - عمليات الـ Process Pool في المعالجة الدفعية (run_batch)
+# - سطر الأوامر: python mrp_engine.py batch <folder>
+# ==============================================================================
+import datetime
+import os
+import threading
+
+import pandas as pd
+
+# ==============================================================================
+# 2. إعداد التكوين والأعمدة
+# ==============================================================================
+COLUMN_NAMES = {
+    "material":             ["Material", "Item", "code", "Code", "المادة", "Product"],
+    "material_desc":        ["Material Description", "Description", "وصف"],
+    "order_type":           ["Order Type", "OT", "نوع الطلب", "Sales Org."],
+    "component":            ["Component", "Comp", "المكون"],
+    "component_desc":       ["Component Description", "Comp Desc", " المسمى", "وصف المكون"],
+    "component_uom":        ["Component UoM", "UoM", "الوحدة"],
+    "component_qty":        ["Component Quantity", "Qty", "كمية المكون"],
+    "base_qty":             ["Base Quantity", "Base Qty", "الكمية الأساسية"],
+    "mrp_controller":       ["MRP Controller", "مسؤول MRP"],
+    "current_stock":        ["Current Stock", "Stock", "المخزون الحالي", "Unrestricted"],
+    "component_order_type": ["Component Order Type", "Order Category", "نوع أمر المكون", "Procurement Type"],
+    "hierarchy_level":      ["Hierarchy Level", "Level", "المستوى الهرمي"],
+    "parent_material":      ["Parent Material", "Direct Parent", "الأب المباشر"],
+    "lead_time":            ["Lead Time", "Planned Delivery Time", "LT", "مدة التوريد"],
+}
+
+def col(name_key):
+    """إرجاع اسم العمود الرئيسي"""
+    return COLUMN_NAMES[name_key][0]
+
+def normalize_columns(df, column_map):
+    """توحيد أسماء الأعمدة إلى الاسم الرئيسي"""
+    rename_dict = {}
+    for key, aliases in column_map.items():
+        for alias in aliases:
+            if alias in df.columns and alias != aliases[0]:
+                rename_dict[alias] = aliases[0]
+    return df.rename(columns=rename_dict)
+
+# ==============================================================================
+# 3. دالة تحميل البيانات والتحقق منها
+# ==============================================================================
+# حجم الدفعة (عدد الصفوف) في وضع القراءة المتدفقة — يحدد سقف الذاكرة أثناء القراءة
+STREAMING_CHUNK_ROWS = 50_000
+# الملفات الأكبر من هذا الحجم تُقرأ بالوضع المتدفق افتراضياً
+STREAMING_AUTO_BYTES = 20 * 1024 * 1024
+
+# ورقة اختيارية: Component | Lead Time (أيام عمل) — تُكمل عمود Lead Time في ورقة Component
+LEAD_TIME_SHEET = "Lead Time"
+
+GRAM_VARIANTS = {"g", "gm", "gr", "gram", "grams", "جرام", "جم"}
+CM2_VARIANTS  = {"cm2", "cm^2", "cm²", "سم2", "سم²"}
+
+
+def code_strings(values):
+    """
+    أكواد (مواد / مكونات / MRP Controller) كنصوص بدون مسافات — الفارغ يبقى NaN
+    101 و 101.0 (عمود رقمي به فراغات) و "101" ⇐ "101" في مساري القراءة
+    """
+    def to_code(v):
+        if isinstance(v, float) and v.is_integer():
+            v = int(v)
+        return str(v).strip()
+
+    return values.map(to_code, na_action="ignore").astype(object)
+
+
+def clean_component_chunk(component_df):
+    """
+    تنظيف دفعة من ورقة Component (أو الورقة كاملة) — كل العمليات هنا على مستوى الصف
+    لذلك تعطي نفس النتيجة سواء طُبقت على الورقة كاملة أو على دفعات متتالية.
+
+    المخرجات: (component_df بعد التنظيف, عدد الأصفار في Base Quantity)
+    """
+    comp_qty_col = col("component_qty")
+    base_qty_col = col("base_qty")
+
+    component_df[comp_qty_col] = (
+        pd.to_numeric(component_df[comp_qty_col], errors='coerce').fillna(0).astype(float)
+    )
+
+    # ✅ FIX 1: تطبيق Base Qty بشكل صحيح (خارج except)
+    zero_base = 0
+    if base_qty_col in component_df.columns:
+        base_qty = pd.to_numeric(component_df[base_qty_col], errors='coerce')
+        zero_base = int((base_qty == 0).sum())
+        component_df[base_qty_col] = base_qty.fillna(1).replace(0, 1)
+        component_df[comp_qty_col] = component_df[comp_qty_col] / component_df[base_qty_col]
+        component_df.drop(columns=[base_qty_col], inplace=True)
+
+    # --- الأعمدة الاختيارية مع قيم افتراضية ---
+    if col("current_stock") not in component_df.columns:
+        component_df[col("current_stock")] = 0.0
+    else:
+        component_df[col("current_stock")] = pd.to_numeric(
+            component_df[col("current_stock")], errors='coerce'
+        ).fillna(0).astype(float)
+
+    if col("component_order_type") not in component_df.columns:
+        component_df[col("component_order_type")] = "غير محدد"
+
+    if col("hierarchy_level") not in component_df.columns:
+        component_df[col("hierarchy_level")] = 1
+    else:
+        component_df[col("hierarchy_level")] = pd.to_numeric(
+            component_df[col("hierarchy_level")], errors='coerce'
+        ).fillna(1).astype(int)
+
+    if col("component_desc") not in component_df.columns:
+        component_df[col("component_desc")] = ""
+
+    if col("component_uom") not in component_df.columns:
+        component_df[col("component_uom")] = ""
+
+    if col("mrp_controller") not in component_df.columns:
+        component_df[col("mrp_controller")] = "غير محدد"
+
+    # مدة التوريد (اختياري) — تبقى NaN حيث لا توجد قيمة حتى تُكمَّل من ورقة Lead Time
+    if col("lead_time") in component_df.columns:
+        component_df[col("lead_time")] = pd.to_numeric(
+            component_df[col("lead_time")], errors='coerce'
+        ).astype(float)
+
+    # ✅ توحيد أكواد Material و Component كنصوص بدون مسافات — مرة واحدة عند التحميل
+    # كل المراحل التالية (Explosion، المسارات، فحص الهيكل) تقرأها كما هي بدون نسخ أو تنظيف
+    for code_col in (col("material"), col("component")):
+        component_df[code_col] = component_df[code_col].astype(str).str.strip()
+
+    # ✅ تنظيف عمود Parent Material إن وُجد
+    # هذا العمود يحتوي على الأب المباشر الفعلي لكل مكون (من SAP CS12)
+    if col("parent_material") in component_df.columns:
+        component_df[col("parent_material")] = (
+            component_df[col("parent_material")].astype(str).str.strip()
+        )
+    # إذا لم يكن موجوداً → نُنشئه من Material (fallback للتوافق مع ملفات قديمة)
+    else:
+        component_df[col("parent_material")] = component_df[col("material")]
+
+    # ✅ توحيد وحدات الوزن إلى كيلوجرام
+    # أي مكون وحدته G أو g أو GM أو gram → نقسم الكمية والرصيد على 1000 ونغير الوحدة إلى KG
+    uom_col = col("component_uom")
+    qty_col = col("component_qty")
+    stk_col = col("current_stock")
+
+    uom_norm = component_df[uom_col].astype(str).str.strip().str.lower()
+    is_gram  = uom_norm.isin(GRAM_VARIANTS)
+
+    if is_gram.any():
+        component_df.loc[is_gram, qty_col] = component_df.loc[is_gram, qty_col] / 1000
+        component_df.loc[is_gram, stk_col] = component_df.loc[is_gram, stk_col] / 1000
+        component_df.loc[is_gram, uom_col] = "KG"
+
+    # ✅ NEW: توحيد وحدات المساحة من CM2 إلى M2
+    is_cm2 = uom_norm.isin(CM2_VARIANTS)
+
+    if is_cm2.any():
+        component_df.loc[is_cm2, qty_col] = component_df.loc[is_cm2, qty_col] / 10000
+        component_df.loc[is_cm2, stk_col] = component_df.loc[is_cm2, stk_col] / 10000
+        component_df.loc[is_cm2, uom_col] = "M2"
+
+    return component_df, zero_base
+
+
+def open_workbook_streaming(uploaded_file):
+    """
+    فتح الملف مرة واحدة في وضع read-only لكل أوراقه — فك الضغط وقراءة shared strings
+    مرة واحدة بدلاً من كل ورقة. المستدعي يغلقه (wb.close())
+    """
+    from openpyxl import load_workbook
+
+    _rewind(uploaded_file)
+    return load_workbook(uploaded_file, read_only=True, data_only=True)
+
+
+def iter_sheet_chunks(wb, sheet_name, keep_cols=None, chunk_rows=STREAMING_CHUNK_ROWS):
+    """
+    قراءة ورقة Excel على دفعات من ملف مفتوح (open_workbook_streaming)
+
+    - لا يتم تحميل الورقة كاملة في الذاكرة، فقط دفعة واحدة بحجم chunk_rows
+    - أسماء الأعمدة تُوحَّد مرة واحدة من الصف الأول (normalize_columns)
+    - keep_cols: إن وُجدت، تُحذف الأعمدة الأخرى قبل بناء الـ DataFrame (توفير الذاكرة)
+    """
+    ws = wb[sheet_name]
+    # بعض ملفات SAP تُصدَّر بأبعاد (dimension) خاطئة → نعيد حسابها أثناء القراءة
+    ws.reset_dimensions()
+    rows = ws.iter_rows(values_only=True)
+
+    header = next(rows, None)
+    if header is None:
+        return
+    header = [h if h is not None else f"Unnamed: {i}" for i, h in enumerate(header)]
+    header = list(normalize_columns(pd.DataFrame(columns=header), COLUMN_NAMES).columns)
+
+    keep_idx = [i for i, h in enumerate(header) if keep_cols is None or h in keep_cols]
+    columns  = [header[i] for i in keep_idx]
+    width    = len(header)
+
+    buf = []
+    yielded = False
+    for r in rows:
+        if len(r) < width:
+            r = r + (None,) * (width - len(r))
+        vals = [r[i] for i in keep_idx]
+        if all(v is None for v in vals):
+            continue
+        buf.append(vals)
+        if len(buf) >= chunk_rows:
+            yield pd.DataFrame(buf, columns=columns)
+            yielded = True
+            buf = []
+    # ورقة بها صف العناوين فقط → DataFrame فارغ بنفس الأعمدة
+    if buf or not yielded:
+        yield pd.DataFrame(buf, columns=columns)
+
+
+def _rewind(uploaded_file):
+    """إرجاع مؤشر الملف للبداية (للملفات المرفوعة) — المسارات النصية لا تحتاج ذلك"""
+    if hasattr(uploaded_file, "seek"):
+        uploaded_file.seek(0)
+
+
+def workbook_sheet_names(uploaded_file):
+    """أسماء الأوراق فقط — بدون تحميل محتواها"""
+    from openpyxl import load_workbook
+
+    _rewind(uploaded_file)
+    wb = load_workbook(uploaded_file, read_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+
+def read_plan_streaming(wb):
+    """قراءة ورقة plan على دفعات مع تحويل أعمدة التواريخ إلى أرقام داخل كل دفعة"""
+    plan_chunks = []
+    for chunk in iter_sheet_chunks(wb, "plan"):
+        for c in chunk.columns:
+            if isinstance(c, (datetime.datetime, pd.Timestamp)):
+                chunk[c] = pd.to_numeric(chunk[c], errors="coerce")
+        plan_chunks.append(chunk)
+    return pd.concat(plan_chunks, ignore_index=True)
+
+
+def _sheet_header(wb, sheet_name):
+    """أسماء أعمدة الورقة بعد التوحيد — بقراءة الصف الأول فقط"""
+    chunks = iter_sheet_chunks(wb, sheet_name, chunk_rows=1)
+    try:
+        chunk = next(chunks, None)
+    finally:
+        chunks.close()
+    return [] if chunk is None else list(chunk.columns)
+
+
+def apply_lead_times(component_df, lead_df=None):
+    """
+    دمج مدة التوريد: عمود Lead Time في ورقة Component أولاً، ثم ورقة Lead Time للقيم الناقصة
+    إذا لم يوجد أي مصدر → لا يُضاف العمود (ولا تتم أي إزاحة للتواريخ لاحقاً)
+    """
+    lt_col = col("lead_time")
+    if lead_df is not None and not lead_df.empty and {col("component"), lt_col} <= set(lead_df.columns):
+        lt_map = (
+            lead_df.assign(_key=lead_df[col("component")].astype(str).str.strip())
+            .drop_duplicates(subset=["_key"], keep="last")
+            .set_index("_key")[lt_col]
+        )
+        lt_map = pd.to_numeric(lt_map, errors="coerce")
+        from_sheet = component_df[col("component")].astype(str).str.strip().map(lt_map)
+        if lt_col in component_df.columns:
+            component_df[lt_col] = component_df[lt_col].fillna(from_sheet)
+        else:
+            component_df[lt_col] = from_sheet
+
+    if lt_col in component_df.columns:
+        component_df[lt_col] = component_df[lt_col].fillna(0).clip(lower=0)
+    return component_df
+
+
+class DataValidationError(ValueError):
+    """خطأ في محتوى ملف الإدخال (أوراق أو أعمدة ناقصة) — الرسالة جاهزة للعرض للمستخدم"""
+
+
+def read_workbook(uploaded_file, streaming=False, bom_store=None):
+    """
+    قراءة الأوراق الثلاث وتنظيف ورقة Component
+
+    streaming=False → xls.parse للورقة كاملة ثم التنظيف (السلوك الأصلي)
+    streaming=True  → قراءة متدفقة + تنظيف كل دفعة فوراً + تجميع الدفعات المضغوطة فقط
+    bom_store       → مسار مخزن الـ BOM المحلي: إذا لم يحتوِ الملف ورقة Component
+                      تُقرأ فروع موديلات الخطة فقط من المخزن (load_bom_subset)
+
+    المخرجات: (plan_df, component_df, mrp_df, zero_base)
+    يرفع DataValidationError إذا كانت الأوراق أو الأعمدة الأساسية ناقصة
+    """
+    if not streaming:
+        xls = pd.ExcelFile(uploaded_file, engine='openpyxl')
+        plan_df, component_df, mrp_df, zero_base = _read_workbook(xls, xls.sheet_names, streaming, bom_store)
+    else:
+        # الوضع المتدفق: الملف يُفتح مرة واحدة وتُقرأ منه كل الأوراق
+        wb = open_workbook_streaming(uploaded_file)
+        try:
+            plan_df, component_df, mrp_df, zero_base = _read_workbook(wb, wb.sheetnames, streaming, bom_store)
+        finally:
+            wb.close()
+
+    # ✅ أعمدة الأكواد كنصوص في المسارين — وإلا يختلف النوع (int64 / float64 / object) حسب
+    # طريقة القراءة ويتغير سلوك isin / merge على نفس الملف
+    for df, code_cols in (
+        (plan_df,      [col("material")]),
+        (component_df, [col("mrp_controller")]),
+        (mrp_df,       [col("component"), col("mrp_controller")]),
+    ):
+        for code_col in code_cols:
+            if code_col in df.columns:
+                df[code_col] = code_strings(df[code_col])
+    return plan_df, component_df, mrp_df, zero_base
+
+
+def _read_workbook(book, sheet_names, streaming, bom_store):
+    """
+    جسم read_workbook على ملف مفتوح
+    book: pd.ExcelFile (streaming=False) أو Workbook من open_workbook_streaming (streaming=True)
+    """
+    known_cols = [aliases[0] for aliases in COLUMN_NAMES.values()]
+    required_plan_cols = [col("material"), col("material_desc"), col("order_type")]
+    required_comp_cols = [col("material"), col("component"), col("component_qty")]
+
+    # --- التحقق من الأوراق ---
+    from_store = (
+        "Component" not in sheet_names
+        and bom_store is not None
+        and bom_store_info(bom_store) is not None
+    )
+    required_sheets = ["plan"] if from_store else ["plan", "Component"]
+    missing_sheets = [s for s in required_sheets if s not in sheet_names]
+    if missing_sheets:
+        raise DataValidationError(f"❌ الملف لا يحتوي على الأوراق المطلوبة: {', '.join(missing_sheets)}")
+
+    if from_store:
+        # --- ملف خطة فقط: الـ BOM من المخزن (نظيف مسبقاً عند الحفظ) ---
+        if streaming:
+            plan_df = read_plan_streaming(book)
+            mrp_df = (
+                pd.concat(list(iter_sheet_chunks(book, "MRP Controller")), ignore_index=True)
+                if "MRP Controller" in sheet_names
+                else pd.DataFrame()
+            )
+        else:
+            plan_df = normalize_columns(book.parse("plan"), COLUMN_NAMES)
+            mrp_df = (
+                normalize_columns(book.parse("MRP Controller"), COLUMN_NAMES)
+                if "MRP Controller" in sheet_names
+                else pd.DataFrame()
+            )
+        if not all(c in plan_df.columns for c in required_plan_cols):
+            raise DataValidationError(f"❌ جدول الخطة ناقص أعمدة: {required_plan_cols}")
+        component_df = load_bom_subset(plan_df[col("material")], bom_store)
+        component_df.attrs["bom_store"] = bom_store
+        return plan_df, component_df, mrp_df, 0
+
+    if not streaming:
+        # --- تحميل البيانات ---
+        plan_df      = normalize_columns(book.parse("plan"),      COLUMN_NAMES)
+        component_df = normalize_columns(book.parse("Component"), COLUMN_NAMES)
+        mrp_df = (
+            normalize_columns(book.parse("MRP Controller"), COLUMN_NAMES)
+            if "MRP Controller" in sheet_names
+            else pd.DataFrame()
+        )
+
+        # ✅ إزالة الأعمدة الزائدة غير المعروفة من ورقة Component
+        extra_cols = [c for c in component_df.columns if c not in known_cols]
+        if extra_cols:
+            component_df.drop(columns=extra_cols, inplace=True)
+
+        # --- التحقق من الأعمدة الأساسية ---
+        if not all(c in plan_df.columns for c in required_plan_cols):
+            raise DataValidationError(f"❌ جدول الخطة ناقص أعمدة: {required_plan_cols}")
+
+        if not all(c in component_df.columns for c in required_comp_cols):
+            raise DataValidationError(f"❌ جدول المكونات ناقص أعمدة: {required_comp_cols}")
+
+        component_df, zero_base = clean_component_chunk(component_df)
+        lead_df = (
+            normalize_columns(book.parse(LEAD_TIME_SHEET), COLUMN_NAMES)
+            if LEAD_TIME_SHEET in sheet_names
+            else None
+        )
+        return plan_df, apply_lead_times(component_df, lead_df), mrp_df, zero_base
+
+    # --- التحقق من الأعمدة الأساسية من الصف الأول فقط (قبل قراءة البيانات) ---
+    if not all(c in _sheet_header(book, "plan") for c in required_plan_cols):
+        raise DataValidationError(f"❌ جدول الخطة ناقص أعمدة: {required_plan_cols}")
+
+    if not all(c in _sheet_header(book, "Component") for c in required_comp_cols):
+        raise DataValidationError(f"❌ جدول المكونات ناقص أعمدة: {required_comp_cols}")
+
+    plan_df = read_plan_streaming(book)
+
+    # --- المكونات: الأعمدة المعروفة فقط + تنظيف كل دفعة قبل الاحتفاظ بها ---
+    comp_chunks = []
+    zero_base   = 0
+    for chunk in iter_sheet_chunks(book, "Component", keep_cols=set(known_cols)):
+        chunk, chunk_zero = clean_component_chunk(chunk)
+        zero_base += chunk_zero
+        comp_chunks.append(chunk)
+    component_df = pd.concat(comp_chunks, ignore_index=True)
+
+    mrp_df = (
+        pd.concat(list(iter_sheet_chunks(book, "MRP Controller")), ignore_index=True)
+        if "MRP Controller" in sheet_names
+        else pd.DataFrame()
+    )
+    lead_df = (
+        pd.concat(list(iter_sheet_chunks(book, LEAD_TIME_SHEET)), ignore_index=True)
+        if LEAD_TIME_SHEET in sheet_names
+        else None
+    )
+    return plan_df, apply_lead_times(component_df, lead_df), mrp_df, zero_base
+
+
+# ==============================================================================
+# 3a. ملف جودة البيانات (Data-Quality Profile) — مصدر واحد لملخص القسم C
+# ==============================================================================
+ORDER_TYPE_LABELS = {"F": "شراء", "E": "تصنيع"}
+UNDEFINED_LABEL   = "غير محدد"
+
+
+def profile_data_quality(plan_df, component_df, mrp_df, zero_base=0):
+    """
+    حساب كل مقاييس جودة البيانات مرة واحدة
+
+    - groupby واحد على Component يعطي: عدد الوحدات + أول وصف + أنواع الطلب الموجودة
+      (بدلاً من بحث loc كامل لكل مكون متعدد الوحدات، وفلترة منفصلة لكل نوع طلب)
+    - المخرجات قاموس يُستخدم في واجهة الملخص وفي ورقة Summary معاً
+    """
+    comp_col = col("component")
+    label = (
+        component_df[col("component_order_type")]
+        .map(ORDER_TYPE_LABELS)
+        .fillna(UNDEFINED_LABEL)
+    )
+
+    per_comp = (
+        component_df[[comp_col, col("component_uom"), col("component_desc")]]
+        .assign(
+            _purchase=label.eq("شراء"),
+            _manufacturing=label.eq("تصنيع"),
+            _undefined=label.eq(UNDEFINED_LABEL),
+        )
+        .groupby(comp_col, sort=False)
+        .agg(
+            uom_count=(col("component_uom"), "nunique"),
+            desc=(col("component_desc"), "first"),
+            purchase=("_purchase", "any"),
+            manufacturing=("_manufacturing", "any"),
+            undefined=("_undefined", "any"),
+        )
+    )
+
+    multi_uom = per_comp.loc[per_comp["uom_count"] > 1, "desc"]
+    diff_uom_str = (
+        ", ".join(f"{code} ({desc})" for code, desc in multi_uom.items())
+        if len(multi_uom) > 0 else "لا يوجد"
+    )
+
+    missing_boms = (
+        set(plan_df[col("material")].astype(str).str.strip()) - set(component_df[col("material")])
+    )
+
+    levels_summary = (
+        component_df.groupby(col("hierarchy_level"))[comp_col]
+        .nunique()
+        .reset_index()
+        .rename(columns={comp_col: "عدد المكونات", col("hierarchy_level"): "المستوى"})
+    )
+
+    return {
+        "total_models":        plan_df[col("material")].nunique(),
+        "total_components":    len(per_comp),
+        "total_boms":          len(component_df),
+        "empty_mrp_count":     int(mrp_df[comp_col].isna().sum()) if not mrp_df.empty else 0,
+        "total_diff_uom":      len(multi_uom),
+        "diff_uom_str":        diff_uom_str,
+        "missing_boms":        missing_boms,
+        "zero_base_count":     zero_base,
+        "purchase_count":      int(per_comp["purchase"].sum()),
+        "manufacturing_count": int(per_comp["manufacturing"].sum()),
+        "undefined_count":     int(per_comp["undefined"].sum()),
+        "levels_summary":      levels_summary,
+    }
+
+# ==============================================================================
+# 3a-1. فحص سلامة هيكل الـ BOM (حلقات — فروع منفصلة — آباء غير موجودين)
+# ==============================================================================
+def _strongly_connected_components(adj):
+    """
+    خوارزمية Tarjan (نسخة تكرارية بدون recursion) — O(V+E)
+    adj : قاموس node -> قائمة الأبناء
+    المخرجات: قائمة بالمكونات المترابطة بقوة (كل مكون = قائمة أكواد)
+    """
+    index, low = {}, {}
+    stack, on_stack = [], set()
+    sccs = []
+    counter = 0
+
+    for start in adj:
+        if start in index:
+            continue
+        index[start] = low[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(adj.get(start, ())))]
+
+        while work:
+            node, children = work[-1]
+            descended = False
+            for w in children:
+                if w not in index:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(adj.get(w, ()))))
+                    descended = True
+                    break
+                if w in on_stack:
+                    low[node] = min(low[node], index[w])
+            if descended:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                scc = []
+                while True:
+                    w = stack.pop()
+                    on_stack.discard(w)
+                    scc.append(w)
+                    if w == node:
+                        break
+                sccs.append(scc)
+
+    return sccs
+
+
+def validate_bom_graph(component_df):
+    """
+    فحص هيكل الـ BOM مرة واحدة لكل ملف — كل الفحوصات خطية O(V+E)
+
+    1. حلقات (Cycles)      : مكونات مترابطة بقوة (SCC) في الشبكة التي يمشيها الـ explosion لكل Root
+    2. آباء غير موجودين    : Parent Material لا يظهر كـ Component داخل نفس الـ Material
+    3. فروع منفصلة         : آباء موجودون لكن لا يتصلون بالـ Root (Material) بأي مسار
+
+    المخرجات: DataFrame واحد بكل المشاكل (فارغ إذا كان الهيكل سليماً)
+    """
+    from collections import defaultdict, deque
+
+    mat    = component_df[col("material")]
+    parent = component_df[col("parent_material")]
+    comp   = component_df[col("component")]
+
+    issues = []
+    trees = defaultdict(lambda: defaultdict(list))
+    for m, p, c in zip(mat, parent, comp):
+        trees[m][p].append(c)
+
+    # ── 1. الحلقات على الحواف التي يصلها الـ explosion فعلاً ────────────────────
+    # أبناء p تحت الجذر m: trees[m][p] وإلا trees[p][p] (نصف مصنّع) — نفس _bom_children
+    # دمج حواف كل المنتجات في شبكة واحدة يُظهر حلقات وهمية لا يمر بها أي تفجير
+    # العقدة (m, p) خاصة بالجذر فقط إذا كانت شجرة m تعيد تعريف p أو كوداً يصله p بـ BOM-ه المستقل
+    # غير ذلك تُمشى نفس الحواف تحت أي جذر ⇐ عقدة مشتركة (None, p) بدلاً من نسخة لكل جذر
+    own_parents = defaultdict(list)          # c -> الأكواد التي يظهر c في BOM-ها المستقل
+    for p, tree in trees.items():
+        for c in tree.get(p, ()):
+            own_parents[c].append(p)
+
+    adj = {}
+    for m, tree in trees.items():
+        local = set(tree)
+        queue = deque(local)
+        while queue:
+            for p in own_parents.get(queue.popleft(), ()):
+                if p not in local:
+                    local.add(p)
+                    queue.append(p)
+
+        queue = deque([m])
+        while queue:
+            p = queue.popleft()
+            node = (m, p) if p in local else (None, p)
+            if node in adj:
+                continue
+            children = tree.get(p) or trees.get(p, {}).get(p, ())
+            adj[node] = [(m, c) if c in local else (None, c) for c in children]
+            queue.extend(children)
+
+    cycles = defaultdict(set)
+    for scc in _strongly_connected_components(adj):
+        if len(scc) > 1 or scc[0] in adj.get(scc[0], ()):
+            cycles[tuple(sorted(p for _, p in scc))].update(p if m is None else m for m, p in scc)
+    for codes, roots in cycles.items():
+        issues.append({
+            "نوع المشكلة": "🔁 حلقة (Cycle)",
+            col("material"): ", ".join(sorted(roots)),
+            col("parent_material"): codes[0],
+            col("component"): "",
+            "التفاصيل": (
+                f"{len(codes)} أكواد مترابطة في حلقة: {', '.join(codes)}"
+                if len(codes) > 1 else f"الكود {codes[0]} مكون في نفسه"
+            ),
+        })
+
+    # ── 2. آباء غير موجودين داخل نفس المنتج (vectorized) ─────────────────────
+    known_pairs = pd.MultiIndex.from_arrays([mat, comp])
+    dangling = ~(pd.MultiIndex.from_arrays([mat, parent]).isin(known_pairs) | (parent == mat))
+    for m, p, c in zip(mat[dangling], parent[dangling], comp[dangling]):
+        issues.append({
+            "نوع المشكلة": "❓ أب غير موجود (Dangling Parent)",
+            col("material"): m,
+            col("parent_material"): p,
+            col("component"): c,
+            "التفاصيل": f"الأب {p} غير موجود كمكون داخل {m}",
+        })
+
+    # ── 3. فروع منفصلة: BFS من الـ Root لكل Material ─────────────────────────
+    dangling_pairs = set(zip(mat[dangling], parent[dangling]))
+
+    for m, tree in trees.items():
+        reached = {m}
+        queue = deque([m])
+        while queue:
+            for child in tree.get(queue.popleft(), ()):
+                if child not in reached:
+                    reached.add(child)
+                    queue.append(child)
+        for p, children in tree.items():
+            if p not in reached and (m, p) not in dangling_pairs:
+                issues.append({
+                    "نوع المشكلة": "🧩 فرع منفصل عن الـ Root",
+                    col("material"): m,
+                    col("parent_material"): p,
+                    col("component"): ", ".join(sorted(set(children))),
+                    "التفاصيل": f"{len(children)} مكون تحت {p} لا يصلها أي مسار من {m}",
+                })
+
+    return pd.DataFrame(issues, columns=[
+        "نوع المشكلة", col("material"), col("parent_material"), col("component"), "التفاصيل"
+    ])
+
+# ==============================================================================
+# 3a-2. تجميع الخطة زمنياً (Time Bucketing) قبل الـ Explosion
+# ==============================================================================
+def bucket_plan(plan_melted, freq="D", calendar_starts=None):
+    """
+    تجميع الكميات المخططة في فترات زمنية قبل التفجير
+
+    freq            : "D" يومي | "W" أسبوعي | "M" شهري | "custom" تقويم مخصص
+    calendar_starts : قائمة تواريخ بداية الفترات (لـ custom فقط) — كل تاريخ بالخطة
+                      يُنسب لأقرب بداية فترة قبله (أو لأول فترة إن سبقها)
+
+    المخرجات: نفس أعمدة plan_melted — عمود Date يحمل تاريخ بداية الفترة
+    ✔ عدد مرات التفجير يتناسب مع عدد الفترات وليس عدد الأيام
+    """
+    import numpy as np
+
+    if freq == "D" or plan_melted.empty:
+        return plan_melted
+
+    dates = plan_melted["Date"]
+    if freq == "W":
+        bucket = dates.dt.normalize() - pd.to_timedelta(dates.dt.weekday, unit="D")
+    elif freq == "M":
+        bucket = dates.dt.to_period("M").dt.start_time
+    elif freq == "custom":
+        starts = pd.DatetimeIndex(sorted(set(pd.to_datetime(calendar_starts or []))))
+        if starts.empty:
+            return plan_melted
+        pos = np.searchsorted(starts.values, dates.values, side="right") - 1
+        bucket = pd.Series(starts.values[np.clip(pos, 0, len(starts) - 1)], index=plan_melted.index)
+    else:
+        raise ValueError(f"نوع تجميع غير معروف: {freq}")
+
+    return (
+        plan_melted.assign(Date=bucket)
+        .groupby([col("material"), col("material_desc"), col("order_type"), "Date"],
+                 as_index=False, sort=False, dropna=False)
+        ["Planned Quantity"]
+        .sum()
+    )
+
+# ==============================================================================
+# 3a-2a. تضييق نطاق الحساب قبل الـ Explosion (Filter Pushdown)
+# ==============================================================================
+# بدلاً من تفجير كل الخطة ثم الفلترة في العرض والتصدير:
+# - scope_plan       : الخطة نفسها — فترة التواريخ / أنواع الطلب / الموديلات
+# - controller_scope : الأكواد التي يمكن أن تصل لمكون من MRP Controllers المختارين
+#                      (بحث عكسي من المكونات المطابقة صعوداً) — التفجير لا ينزل في غيرها
+def scope_plan(plan_melted, date_from=None, date_to=None, order_types=None, materials=None):
+    """صفوف الخطة داخل النطاق فقط — None = بدون قيد (القائمة الفارغة = لا شيء)"""
+    mask = pd.Series(True, index=plan_melted.index)
+    if date_from is not None:
+        mask &= plan_melted["Date"] >= pd.Timestamp(date_from)
+    if date_to is not None:
+        mask &= plan_melted["Date"] <= pd.Timestamp(date_to)
+    if order_types is not None:
+        mask &= plan_melted[col("order_type")].astype(str).isin([str(o) for o in order_types])
+    if materials is not None:
+        mask &= plan_melted[col("material")].astype(str).str.strip().isin([str(m) for m in materials])
+    return plan_melted[mask]
+
+
+_BOM_PARENTS_LOCK = threading.Lock()
+
+
+def bom_parents(bom_model):
+    """
+    الفهرس العكسي لكل الأشجار: component -> {parent, ...} (يُبنى مرة واحدة ويُحفظ داخل النموذج)
+    النموذج مشترك بين الجلسات وخيوط الخدمة ⇐ البناء تحت قفل: خيط واحد يبنيه والباقي يقرأ نتيجته
+    """
+    parents_of = bom_model.get("parents_of")
+    if parents_of is None:
+        with _BOM_PARENTS_LOCK:
+            parents_of = bom_model.get("parents_of")
+            if parents_of is None:
+                parents_of = {}
+                for tree in bom_model["bom_dict"].values():
+                    for parent, children in tree.items():
+                        for comp, _ in children:
+                            parents_of.setdefault(comp, set()).add(parent)
+                bom_model["parents_of"] = parents_of
+    return parents_of
+
+
+def controller_scope(bom_model, controllers):
+    """
+    المخرجات: (reach, match)
+        match : مكونات MRP Controllers المختارين
+        reach : match + كل كود يصل إلى أحدها عبر أي شجرة — الفروع خارجه لا تُفجَّر
+    """
+    info = bom_model["comp_info"]
+    match = set(info.loc[
+        info[col("mrp_controller")].astype(str).isin([str(c) for c in controllers]), "_comp_key"
+    ])
+    parents_of = bom_parents(bom_model)
+    reach, frontier = set(match), list(match)
+    while frontier:
+        frontier = [p for code in frontier for p in parents_of.get(code, ()) if p not in reach]
+        reach.update(frontier)
+    return reach, match
+
+
+# ==============================================================================
+# 3a-2b. تفريغ نتائج الـ Explosion على القرص (Spill-to-Parquet) للخطط الضخمة
+# ==============================================================================
+# بدلاً من قائمة dicts واحدة + DataFrame كامل في نفس اللحظة:
+# - الصفوف تُحوَّل لأجزاء DataFrame بحجم ثابت وتُكتب كملفات Parquet مؤقتة
+# - المراحل التالية (إزاحة Lead Time / التجميع / العيّنة) تقرأ جزءاً واحداً في كل مرة
+#   (memory-mapped) — فتبقى الذاكرة القصوى ثابتة مهما كان حجم الخطة
+# - المجلد المؤقت يُحذف تلقائياً عند التخلص من الكائن
+SPILL_ROWS       = int(os.environ.get("MRP_SPILL_ROWS", 5_000_000))
+SPILL_CHUNK_ROWS = 500_000
+
+
+def arrow_safe_frame(df):
+    """Parquet / Arrow لا يقبلان عموداً نصياً يخلط أرقاماً ونصوصاً (مثل MRP Controller) → نص موحّد"""
+    mixed = [
+        c for c in df.columns[df.dtypes == object]
+        if pd.api.types.infer_dtype(df[c], skipna=True).startswith("mixed")
+    ]
+    if not mixed:
+        return df
+    return df.assign(**{c: df[c].where(df[c].isna(), df[c].astype(str)) for c in mixed})
+
+
+class SpilledResult:
+    """نتيجة Explosion مخزنة في أجزاء Parquet — واجهة مصغّرة مطابقة لما تستخدمه المراحل التالية"""
+
+    def __init__(self, spill_dir=None):
+        import shutil
+        import tempfile
+        import weakref
+
+        self.dir     = tempfile.mkdtemp(prefix="mrp_spill_", dir=spill_dir)
+        self.paths   = []
+        self.columns = pd.Index([])
+        self._rows   = 0
+        weakref.finalize(self, shutil.rmtree, self.dir, ignore_errors=True)
+
+    def append(self, chunk):
+        path = os.path.join(self.dir, f"part-{len(self.paths):05d}.parquet")
+        chunk = arrow_safe_frame(chunk)
+        chunk.to_parquet(path, index=False)
+        self.paths.append(path)
+        self.columns = self.columns.union(chunk.columns, sort=False)
+        self._rows += len(chunk)
+
+    def __len__(self):
+        return self._rows
+
+    @property
+    def empty(self):
+        return self._rows == 0
+
+    def iter_chunks(self, columns=None):
+        for path in self.paths:
+            yield pd.read_parquet(path, columns=columns, memory_map=True)
+
+    def map_chunks(self, func, **kwargs):
+        """تطبيق دالة صف-بصف على كل جزء — الناتج SpilledResult جديد"""
+        out = SpilledResult(os.path.dirname(self.dir))
+        for chunk in self.iter_chunks():
+            out.append(func(chunk, **kwargs))
+        return out
+
+    def unique(self, column):
+        return pd.unique(pd.concat([c[column] for c in self.iter_chunks([column])], ignore_index=True))
+
+    def sorted_head(self, columns, by, n):
+        """أول n صف بعد الترتيب — أفضل n من كل جزء ثم ترتيب نهائي"""
+        heads = [c.sort_values(by).head(n) for c in self.iter_chunks(columns)]
+        return pd.concat(heads, ignore_index=True).sort_values(by).head(n)
+
+
+# ==============================================================================
+# ✅ FIX 2: دالة BOM Explosion متعددة المستويات (الإصلاح الجوهري)
+# ==============================================================================
+def bom_explosion(plan_melted, component_df, spill_rows=None):
+    """
+    Multi-Level BOM Explosion — النهج الصحيح لـ SAP CS12
+
+    المفتاح الذهبي:  Material + Parent Material + Component
+    ✔ يمنع دمج نفس (Parent→Component) من منتجات مختلفة
+    ✔ يجمع الكميات داخل نفس المنتج فقط
+    ✔ يعزل bom_dict لكل Material → explosion آمن بدون تلوث
+
+    الخوارزمية:
+    1. groupby(Material + Parent + Component) → bom_core فريد لكل منتج
+    2. bom_dict per Material → tree[parent] = [(comp, qty), ...]
+    3. explode تعاودي لكل صف في الخطة مستقلاً
+
+    الخطوتان 1-2 في build_bom_model (تُبنى مرة واحدة ويمكن مشاركتها بين عدة خطط)
+    والخطوة 3 في explode_plan
+    """
+    return explode_plan(plan_melted, build_bom_model(component_df), spill_rows=spill_rows)
+
+
+def build_bom_model(component_df):
+    """
+    نموذج الـ BOM المفهرس — لا يعتمد على الخطة، لذلك يُبنى مرة واحدة لكل ورقة Component
+
+    المخرجات: قاموس
+        bom_dict      : tree[material][parent] = [(component, qty), ...]
+        comp_info     : الأعمدة الوصفية لكل مكون (جاهزة للدمج مع النتائج)
+        lead_times    : مدة التوريد لكل مكون (فارغ إذا لم تتوفر)
+        has_lead_time : هل توجد بيانات مدة توريد
+    """
+    from collections import defaultdict
+
+    # الأكواد مُنظفة مسبقاً في clean_component_chunk — لا نسخ ولا تعديل على المدخل
+    has_parent_col = col("parent_material") in component_df.columns
+    parent_col = col("parent_material") if has_parent_col else col("material")
+
+    # ✅ STEP 1: تنظيف ثم groupby(Material + Parent + Component) + sum
+    #
+    # SAP CS12 يصدر أحياناً صفوفاً مكررة حرفياً لنفس الزوج (Parent→Component)
+    # بنفس الكمية — هذه نسخ وليست كميات إضافية حقيقية.
+    # الحل الصحيح: خطوتان:
+    #   1. drop_duplicates على كل الأعمدة → يحذف النسخ الحرفية
+    #   2. groupby(Material+Parent+Component)+sum → يجمع الكميات الحقيقية المختلفة
+    #      داخل نفس المنتج، مع عزل كامل بين المنتجات المختلفة
+    component_df = component_df.drop_duplicates(
+        subset=[col("material"), parent_col, col("component"), col("component_qty")],
+        keep="first"
+    )
+    bom_core = component_df.groupby(
+        [col("material"), parent_col, col("component")],
+        as_index=False
+    )[col("component_qty")].sum()
+
+    # ✅ STEP 2: بناء bom_dict منفصل لكل Material
+    # tree[material][parent] = [(component, qty), ...]
+    bom_dict = {}
+    for mat, group in bom_core.groupby(col("material")):
+        tree = defaultdict(list)
+        for _, row in group.iterrows():
+            tree[row[parent_col]].append(
+                (row[col("component")], row[col("component_qty")])
+            )
+        bom_dict[mat] = tree
+
+    # معلومات وصفية للمكونات
+    comp_info = (
+        component_df
+        .drop_duplicates(subset=[col("component")], keep="last")
+        .set_index(col("component"))[[
+            col("component_desc"),
+            col("component_uom"),
+            col("mrp_controller"),
+            col("current_stock"),
+            col("component_order_type"),
+        ]]
+    )
+
+    # مدة التوريد لكل مكون (اختياري) — تُجمع على طول المسار من الـ Root
+    has_lead_time = col("lead_time") in component_df.columns
+    lead_times = (
+        component_df
+        .drop_duplicates(subset=[col("component")], keep="last")
+        .set_index(col("component"))[col("lead_time")]
+        .to_dict()
+        if has_lead_time else {}
+    )
+
+    comp_info_clean = (
+        comp_info.reset_index()
+        .rename(columns={col("component"): "_comp_key"})
+        .drop_duplicates(subset=["_comp_key"])
+    )
+
+    return {
+        "bom_dict":      bom_dict,
+        "comp_info":     comp_info_clean,
+        "lead_times":    lead_times,
+        "has_lead_time": has_lead_time,
+    }
+
+
+def _attach_comp_info(df, bom_model):
+    """إضافة الأعمدة الوصفية للمكون إلى صفوف الـ explosion"""
+    return df.merge(
+        bom_model["comp_info"],
+        left_on=col("component"),
+        right_on="_comp_key",
+        how="left"
+    ).drop(columns=["_comp_key"], errors="ignore")
+
+
+def _bom_children(bom_dict, root_material, parent):
+    """
+    أبناء parent داخل شجرة المنتج الجذر أولاً، ثم داخل شجرة الأب نفسه (نصف مصنّع له BOM مستقل)
+    المخرجات: [(component, qty), ...] — قائمة فارغة إذا كان parent ورقة (Leaf)
+    """
+    children = bom_dict.get(root_material, {}).get(parent, [])
+    if not children:
+        children = bom_dict.get(parent, {}).get(parent, [])
+    return children
+
+
+def explode_plan(plan_melted, bom_model, spill_rows=None, progress=None, cancel=None, kernel=None,
+                 controllers=None):
+    """
+    تشغيل الـ explosion لكل صف في الخطة على نموذج BOM جاهز (build_bom_model)
+    المخرجات: صف لكل (صف خطة × مكون في أي مستوى) + الأعمدة الوصفية للمكون
+
+    spill_rows: عند تجاوز عدد الصفوف هذا الحد تُكتب الصفوف على القرص في أجزاء Parquet
+                بحجم SPILL_CHUNK_ROWS ويكون الناتج SpilledResult بدلاً من DataFrame
+    progress  : دالة تُستدعى بعد كل منتج جذر: progress(done, total, material, new_rows)
+                (new_rows قائمة صفوف، أو DataFrame في وضع النواة المُجمّعة)
+    cancel    : threading.Event — عند ضبطه يتوقف الحساب قبل المنتج التالي (ExplosionCancelled)
+    kernel    : "auto" (النواة المُجمّعة إذا كان numba مثبتاً) أو "off" — الافتراضي EXPLODE_KERNEL
+    controllers: (اختياري) MRP Controllers — الناتج مكوناتهم فقط، ولا يُنزل في فروع لا تصل إليهم
+    """
+    plan_pos = plan_melted[plan_melted["Planned Quantity"] > 0]
+    roots    = plan_pos[col("material")].astype(str).str.strip()
+    reach, match = controller_scope(bom_model, controllers) if controllers is not None else (None, None)
+    if (kernel or EXPLODE_KERNEL) != "off" and explode_kernel_available():
+        return _explode_plan_arrays(
+            plan_pos, roots, bom_model, _explode_kernel_fn(), spill_rows, progress, cancel, reach, match
+        )
+
+    bom_dict      = bom_model["bom_dict"]
+    lead_times    = bom_model["lead_times"]
+    has_lead_time = bom_model["has_lead_time"]
+
+    # 🧩 توسعة الوحدة الواحدة لكل نصف مصنّع (بشجرته المستقلة) — تُحسب مرة واحدة لكل استدعاء
+    # node -> (rows, nodes, depth) | None أثناء الحساب (حلقة تمر بنفس النصف مصنّع)
+    sub_memo = {}
+
+    def expand_unit(node):
+        """
+        صفوف تفجير وحدة واحدة من node بشجرته المستقلة فقط (بدون شجرة أي منتج جذر)
+        nodes : كل الأكواد داخلها — لفحص إمكانية إعادة الاستخدام
+        depth : أعمق BOM Level نسبي فيها
+        """
+        if node not in sub_memo:
+            sub_memo[node] = None
+            rows = []
+            explode(None, node, 1.0, set(), 1, rows)
+            sub_memo[node] = (
+                rows,
+                {node}.union(r[col("component")] for r in rows),
+                max((r["BOM Level"] for r in rows), default=0),
+            )
+        return sub_memo[node]
+
+    def splice_unit(unit, qty, level, row_buf, lead_acc):
+        """
+        نسخة مُقاسة من توسعة الوحدة مكان التفجير التعاودي
+        (الكميات خطية في qty، والمستوى ومدة التوريد إزاحة ثابتة، والـ Parent كما هو)
+        """
+        for r in unit:
+            row = dict(r)
+            row["Required Component Quantity"] = qty * r["Required Component Quantity"]
+            row["BOM Level"] = r["BOM Level"] + level - 1
+            if has_lead_time:
+                row["Cum Lead Time"] = lead_acc + r["Cum Lead Time"]
+            row_buf.append(row)
+
+    # ✅ STEP 3: دالة explosion تعاودية آمنة
+    def explode(root_material, parent, qty, path, level, row_buf, lead_acc=0.0):
+        """
+        root_material : المنتج الجذر (لجلب bom_dict الصحيح)
+        parent        : الأب الحالي الذي نبحث عن أبنائه
+        qty           : الكمية المطلوبة من الأب الحالي
+        path          : مسار العقد التي مررنا بها (لمنع الحلقات)
+        level         : المستوى الهرمي الحالي
+        row_buf       : مخزن الصفوف الناتجة
+        lead_acc      : مدة التوريد التراكمية حتى الأب الحالي (أيام عمل)
+
+        المنطق الصحيح لحساب الكميات:
+        - نبحث أولاً في bom_dict[root_material] عن أبناء parent
+        - إذا لم نجد (مكون وسيط له BOM مستقل)، نبحث في bom_dict[parent]
+        - الكمية المطلوبة = qty_from_parent × qty_of_this_child
+        """
+        if parent in path or level > EXPLODE_MAX_LEVEL:
+            return
+
+        # البحث في شجرة المنتج الجذر أولاً، ثم في شجرة الأب نفسه (نصف مصنّع)
+        root_tree = bom_dict.get(root_material, {})
+        children = root_tree.get(parent, [])
+        if not children:
+            # 🧩 نصف مصنّع: نفس النتيجة في أي منتج جذر بشرط ألا تعيد شجرة الجذر تعريف
+            # أي كود بداخله، وألا يقطعه المسار الحالي (حلقة)، وألا يتجاوز EXPLODE_MAX_LEVEL
+            memo = expand_unit(parent)
+            if memo is not None:
+                unit, nodes, depth = memo
+                if not unit:
+                    return
+                if (level - 1 + depth <= EXPLODE_MAX_LEVEL
+                        and path.isdisjoint(nodes) and root_tree.keys().isdisjoint(nodes)):
+                    splice_unit(unit, qty, level, row_buf, lead_acc)
+                    return
+            children = bom_dict.get(parent, {}).get(parent, [])
+        if not children:
+            return
+
+        new_path = path | {parent}
+        for comp, comp_qty in children:
+            if reach is not None and comp not in reach:
+                continue
+            # ✅ الكمية الصحيحة: كمية الأب × كمية المكون لكل وحدة من الأب
+            needed = qty * comp_qty
+            row = {
+                "Parent":                        parent,
+                col("component"):                comp,
+                col("component_qty"):            comp_qty,
+                "Required Component Quantity":   needed,
+                "BOM Level":                     level,
+            }
+            comp_lead = lead_acc
+            if has_lead_time:
+                comp_lead = lead_acc + lead_times.get(comp, 0.0)
+                row["Cum Lead Time"] = comp_lead
+            row_buf.append(row)
+            # 🔁 الاستدعاء العودي الصحيح:
+            # - نمرر comp كـ parent الجديد (الأب للمستوى التالي)
+            # - نمرر needed كـ qty (الكمية المطلوبة من comp)
+            # - نحاول أولاً داخل شجرة root_material، وإلا داخل شجرة comp نفسه
+            explode(root_material, comp, needed, new_path, level + 1, row_buf, comp_lead)
+
+    def to_frame(rows):
+        return _attach_comp_info(pd.DataFrame(rows), bom_model)
+
+    # ✅ STEP 4: تشغيل الـ explosion لكل صف في الخطة — مجمّعة حسب المنتج الجذر
+    # (وحدة التقدم والإلغاء = منتج جذر واحد بكل تواريخه)
+    total    = roots.nunique()
+    all_rows = []
+    spilled  = None
+    if progress is not None:
+        progress(0, total, None, [])
+    for done, (mat, root_rows) in enumerate(plan_pos.groupby(roots, sort=False), start=1):
+        if cancel is not None and cancel.is_set():
+            raise ExplosionCancelled()
+
+        first_new = len(all_rows)
+        # تفجير وحدة واحدة من المنتج الجذر ثم نسخة مُقاسة لكل صف خطة (تاريخ / نوع طلب)
+        unit = []
+        explode(mat, mat, 1.0, set(), level=1, row_buf=unit, lead_acc=lead_times.get(mat, 0.0))
+        if match is not None:
+            # الوسطاء في reach كانوا للنزول فقط — الناتج مكونات الـ Controllers المختارين
+            unit = [r for r in unit if r[col("component")] in match]
+        for _, plan_row in root_rows.iterrows():
+            qty = plan_row["Planned Quantity"]
+            plan_cols = {
+                col("material"):      mat,
+                col("material_desc"): str(plan_row.get(col("material_desc"), "")).strip(),
+                "Order Type":         plan_row[col("order_type")],
+                "Date":               plan_row["Date"],
+            }
+            all_rows.extend(
+                {**r, "Required Component Quantity": qty * r["Required Component Quantity"], **plan_cols}
+                for r in unit
+            )
+
+        if progress is not None:
+            progress(done, total, mat, all_rows[first_new:])
+
+        # 💽 تجاوز الحد → تفريغ الصفوف على القرص في أجزاء ثابتة الحجم
+        if spill_rows is not None and (spilled is not None or len(all_rows) >= spill_rows):
+            if spilled is None:
+                spilled = SpilledResult()
+            while len(all_rows) >= SPILL_CHUNK_ROWS:
+                spilled.append(to_frame(all_rows[:SPILL_CHUNK_ROWS]))
+                del all_rows[:SPILL_CHUNK_ROWS]
+
+    if spilled is not None:
+        if all_rows:
+            spilled.append(to_frame(all_rows))
+        return spilled
+
+    if not all_rows:
+        return pd.DataFrame()
+
+    return to_frame(all_rows)
+
+# ==============================================================================
+# 3a-2c. نواة التفجير المُجمّعة (JIT — اختياري) على تمثيل مصفوفي للـ BOM
+# ==============================================================================
+# نفس منطق explode() لكن على مصفوفات أعداد: كل كود ← رقم، وأبناء (منتج، أب) ← مقطع
+# متصل في مصفوفتي child / child_qty. الحلقة الداخلية بلا كائنات Python وتكتب الصفوف
+# في مخازن NumPy محجوزة مسبقاً. مع numba تُترجم إلى كود آلة (وتُحرر الـ GIL)،
+# وبدونه يعمل explode_plan بالمسار التعاودي المعتاد
+EXPLODE_KERNEL    = os.environ.get("MRP_EXPLODE_KERNEL", "auto")   # auto | off
+EXPLODE_MAX_LEVEL = 10
+_KERNEL_CACHE = {}
+
+
+def explode_kernel_available():
+    import importlib.util
+
+    return importlib.util.find_spec("numba") is not None
+
+
+def bom_arrays(bom_model):
+    """
+    التمثيل المصفوفي لـ bom_dict (يُبنى مرة واحدة ويُحفظ داخل النموذج)
+
+        codes      : الكود لكل رقم
+        code_ids   : الرقم لكل كود
+        keys       : material_id × n_codes + parent_id مرتبة — للبحث الثنائي
+        seg_start  : بداية أبناء كل مفتاح في child / child_qty
+        seg_end    : نهاية أبناء كل مفتاح
+        node_lead  : مدة التوريد لكل رقم
+    """
+    import numpy as np
+
+    if "arrays" in bom_model:
+        return bom_model["arrays"]
+
+    code_ids = {}
+    for mat, tree in bom_model["bom_dict"].items():
+        code_ids.setdefault(mat, len(code_ids))
+        for parent, children in tree.items():
+            code_ids.setdefault(parent, len(code_ids))
+            for comp, _ in children:
+                code_ids.setdefault(comp, len(code_ids))
+    n_codes = len(code_ids)
+
+    segments = sorted(
+        (code_ids[mat] * n_codes + code_ids[parent], children)
+        for mat, tree in bom_model["bom_dict"].items()
+        for parent, children in tree.items()
+        if children
+    )
+    lengths = np.array([len(children) for _, children in segments], dtype=np.int64)
+    seg_end = np.cumsum(lengths)
+    lead_times = bom_model["lead_times"]
+
+    bom_model["arrays"] = arrays = {
+        "codes":     np.array(list(code_ids), dtype=object),
+        "code_ids":  code_ids,
+        "n_codes":   n_codes,
+        "keys":      np.array([key for key, _ in segments], dtype=np.int64),
+        "seg_start": seg_end - lengths,
+        "seg_end":   seg_end,
+        "child":     np.array([code_ids[c] for _, ch in segments for c, _ in ch], dtype=np.int64),
+        "child_qty": np.array([q for _, ch in segments for _, q in ch], dtype=float),
+        "node_lead": np.array([lead_times.get(c, 0.0) for c in code_ids], dtype=float),
+    }
+    return arrays
+
+
+def _explode_kernel(root_ids, qtys, leads0, start, stop, n, n_codes, keys, seg_start, seg_end,
+                    child, child_qty, node_lead, keep, stack_i, stack_f,
+                    out_plan, out_parent, out_comp, out_cqty, out_need, out_level, out_lead):
+    """
+    تفجير صفوف الخطة [start, stop) بمكدس صريح بدل الاستدعاء التعاودي (نفس ترتيب الصفوف)
+
+    keep              : 1 لكل كود يُسمح بالنزول إليه (controller_scope) — الباقي يُتخطى بفروعه
+    stack_i / stack_f : مكدس الإطارات (مستوى لكل عمود) — [عقدة، موضع، نهاية] و [كمية، مدة توريد]
+                        عدد أعمدته = أقصى عمق للـ BOM
+    المخرجات: (i, n) — i = stop عند الانتهاء، وإلا امتلأت المخازن عند صف الخطة i
+              و n عدد الصفوف المكتوبة قبله (يُستأنف من نفس النقطة بعد تكبير المخازن)
+    """
+    max_level = stack_i.shape[1]
+    cap = out_plan.shape[0]
+    n_keys = keys.shape[0]
+
+    for i in range(start, stop):
+        root = root_ids[i]
+        if root < 0:
+            continue
+        row_start = n
+        node, qty, lead, depth = root, qtys[i], leads0[i], 0
+
+        while True:
+            # دخول node: شجرة المنتج الجذر أولاً، ثم شجرة node نفسه (نصف مصنّع) — بحث ثنائي
+            k = -1
+            for key in (root * n_codes + node, node * n_codes + node):
+                lo, hi = 0, n_keys
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if keys[mid] < key:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                if lo < n_keys and keys[lo] == key:
+                    k = lo
+                    break
+            if k >= 0:
+                stack_i[0, depth] = node
+                stack_i[1, depth] = seg_start[k]
+                stack_i[2, depth] = seg_end[k]
+                stack_f[0, depth] = qty
+                stack_f[1, depth] = lead
+                depth += 1
+
+            # الابن التالي في أعمق إطار لم يكتمل
+            found = False
+            while depth > 0:
+                d = depth - 1
+                p = stack_i[1, d]
+                if p == stack_i[2, d]:
+                    depth -= 1
+                    continue
+                stack_i[1, d] = p + 1
+
+                c    = child[p]
+                if keep[c] == 0:
+                    continue
+                qty  = stack_f[0, d] * child_qty[p]
+                lead = stack_f[1, d] + node_lead[c]
+                if n == cap:
+                    return i, row_start
+                out_plan[n]   = i
+                out_parent[n] = stack_i[0, d]
+                out_comp[n]   = c
+                out_cqty[n]   = child_qty[p]
+                out_need[n]   = qty
+                out_level[n]  = d + 1
+                out_lead[n]   = lead
+                n += 1
+
+                # النزول إلى c: نفس شروط explode() — عمق أقصى + منع الحلقات على المسار
+                if d + 2 > max_level:
+                    continue
+                on_path = False
+                for j in range(depth):
+                    if stack_i[0, j] == c:
+                        on_path = True
+                        break
+                if on_path:
+                    continue
+                node = c
+                found = True
+                break
+            if not found:
+                break
+
+    return stop, n
+
+
+def _explode_kernel_fn():
+    """النواة مُترجمة بـ numba (مرة واحدة لكل عملية، ومحفوظة على القرص بين التشغيلات)"""
+    if "fn" not in _KERNEL_CACHE:
+        import numba
+
+        _KERNEL_CACHE["fn"] = numba.njit(cache=True, nogil=True)(_explode_kernel)
+    return _KERNEL_CACHE["fn"]
+
+
+def _explode_plan_arrays(plan_pos, roots, bom_model, kernel, spill_rows=None, progress=None, cancel=None,
+                         reach=None, match=None):
+    """explode_plan على التمثيل المصفوفي — نفس الصفوف ونفس الترتيب ونفس التقدم والإلغاء والتفريغ"""
+    import numpy as np
+
+    arrays = bom_arrays(bom_model)
+    codes  = arrays["codes"]
+
+    # controller_scope → أقنعة على أرقام الأكواد
+    keep = np.ones(arrays["n_codes"], dtype=np.uint8)
+    match_mask = None
+    if reach is not None:
+        code_ids   = arrays["code_ids"]
+        keep[:]    = 0
+        keep[[code_ids[c] for c in reach if c in code_ids]] = 1
+        match_mask = np.zeros(arrays["n_codes"], dtype=bool)
+        match_mask[[code_ids[c] for c in match if c in code_ids]] = True
+
+    # ترتيب صفوف الخطة حسب المنتج الجذر (بترتيب أول ظهور) كما في groupby(sort=False)
+    group_ids, group_mats = pd.factorize(roots)
+    order      = np.argsort(group_ids, kind="stable")
+    bounds     = np.concatenate([[0], np.cumsum(np.bincount(group_ids, minlength=len(group_mats)))])
+    root_codes = roots.to_numpy(dtype=object)[order]
+    root_ids   = roots.map(arrays["code_ids"]).fillna(-1).to_numpy(dtype=np.int64)[order]
+    qtys       = plan_pos["Planned Quantity"].to_numpy(dtype=float)[order]
+    unit_qtys  = np.ones_like(qtys)
+    leads0     = np.where(root_ids >= 0, arrays["node_lead"][np.maximum(root_ids, 0)], 0.0)
+    mat_descs  = plan_pos[col("material_desc")].astype(str).str.strip().to_numpy(dtype=object)[order]
+    ots        = plan_pos[col("order_type")].to_numpy()[order]
+    dates      = plan_pos["Date"].to_numpy()[order]
+
+    # المخازن المحجوزة مسبقاً — تتضاعف عند الامتلاء
+    stack_i = np.empty((3, EXPLODE_MAX_LEVEL), dtype=np.int64)
+    stack_f = np.empty((2, EXPLODE_MAX_LEVEL), dtype=np.float64)
+    cap = max(1024, 8 * len(plan_pos))
+    bufs = {
+        "plan":   np.empty(cap, dtype=np.int64),
+        "parent": np.empty(cap, dtype=np.int64),
+        "comp":   np.empty(cap, dtype=np.int64),
+        "cqty":   np.empty(cap, dtype=np.float64),
+        "need":   np.empty(cap, dtype=np.float64),
+        "level":  np.empty(cap, dtype=np.int64),
+        "lead":   np.empty(cap, dtype=np.float64),
+    }
+
+    def to_frame(a, b):
+        plan_idx = bufs["plan"][a:b]
+        data = {
+            "Parent":                        codes[bufs["parent"][a:b]],
+            col("component"):                codes[bufs["comp"][a:b]],
+            col("component_qty"):            bufs["cqty"][a:b].copy(),
+            "Required Component Quantity":   bufs["need"][a:b].copy(),
+            "BOM Level":                     bufs["level"][a:b].copy(),
+        }
+        if bom_model["has_lead_time"]:
+            data["Cum Lead Time"] = bufs["lead"][a:b].copy()
+        data[col("material")]      = root_codes[plan_idx]
+        data[col("material_desc")] = mat_descs[plan_idx]
+        data["Order Type"]         = ots[plan_idx]
+        data["Date"]               = dates[plan_idx]
+        return pd.DataFrame(data)
+
+    total   = len(group_mats)
+    n       = 0
+    spilled = None
+    if progress is not None:
+        progress(0, total, None, [])
+    for g in range(total):
+        if cancel is not None and cancel.is_set():
+            raise ExplosionCancelled()
+
+        # تفجير وحدة واحدة من المنتج الجذر (أول صف في المجموعة) ثم نسخة مُقاسة لكل صفوف المجموعة
+        first_new = n
+        i, stop = bounds[g], bounds[g + 1]
+        while True:
+            done_i, unit_end = kernel(
+                root_ids, unit_qtys, leads0, i, i + 1, n, arrays["n_codes"], arrays["keys"],
+                arrays["seg_start"], arrays["seg_end"], arrays["child"], arrays["child_qty"],
+                arrays["node_lead"], keep, stack_i, stack_f,
+                bufs["plan"], bufs["parent"], bufs["comp"], bufs["cqty"],
+                bufs["need"], bufs["level"], bufs["lead"],
+            )
+            if done_i == i + 1:
+                break
+            bufs = {k: np.concatenate([v, np.empty_like(v)]) for k, v in bufs.items()}
+        if match_mask is not None:
+            # الوسطاء في reach كانوا للنزول فقط — الناتج مكونات الـ Controllers المختارين
+            selected = match_mask[bufs["comp"][n:unit_end]]
+            for v in bufs.values():
+                v[n:n + selected.sum()] = v[n:unit_end][selected]
+            unit_end = n + int(selected.sum())
+
+        unit_rows = unit_end - n
+        end = n + unit_rows * (stop - i)
+        while end > len(bufs["plan"]):
+            bufs = {k: np.concatenate([v, np.empty_like(v)]) for k, v in bufs.items()}
+        unit_need = bufs["need"][n:unit_end].copy()
+        for v in bufs.values():
+            v[n:end] = np.tile(v[n:unit_end], stop - i)
+        bufs["plan"][n:end] = np.repeat(np.arange(i, stop), unit_rows)
+        bufs["need"][n:end] = np.outer(qtys[i:stop], unit_need).ravel()
+        n = end
+
+        if progress is not None:
+            new_rows = pd.DataFrame({
+                col("component"): codes[bufs["comp"][first_new:n]],
+                "Date":           dates[bufs["plan"][first_new:n]],
+                REQ_QTY:          bufs["need"][first_new:n].copy(),
+            })
+            progress(g + 1, total, group_mats[g], new_rows)
+
+        # 💽 تجاوز الحد → تفريغ الصفوف على القرص في أجزاء ثابتة الحجم ثم إزاحة الباقي لبداية المخازن
+        if spill_rows is not None and (spilled is not None or n >= spill_rows):
+            if spilled is None:
+                spilled = SpilledResult()
+            flushed = 0
+            while n - flushed >= SPILL_CHUNK_ROWS:
+                spilled.append(_attach_comp_info(to_frame(flushed, flushed + SPILL_CHUNK_ROWS), bom_model))
+                flushed += SPILL_CHUNK_ROWS
+            if flushed:
+                for v in bufs.values():
+                    v[:n - flushed] = v[flushed:n]
+                n -= flushed
+
+    if spilled is not None:
+        if n:
+            spilled.append(_attach_comp_info(to_frame(0, n), bom_model))
+        return spilled
+
+    if n == 0:
+        return pd.DataFrame()
+
+    return _attach_comp_info(to_frame(0, n), bom_model)
+
+# ==============================================================================
+# 3a-3. إزاحة تواريخ الاحتياج بمدة التوريد (Lead-Time Offsetting)
+# ==============================================================================
+def offset_requirement_dates(result_df, weekmask="Sun Mon Tue Wed Thu", holidays=None):
+    """
+    تاريخ الإطلاق الفعلي = تاريخ الخطة − مدة التوريد التراكمية (بأيام العمل)
+
+    - حساب vectorized بالكامل عبر np.busday_offset على تقويم أيام العمل (بدون حلقات Python)
+    - يُحفظ تاريخ الخطة الأصلي في عمود Plan Date ويُستبدل Date بتاريخ الاحتياج الفعلي
+    - الصفوف بمدة توريد = 0 تحتفظ بتاريخها كما هو
+    """
+    import numpy as np
+
+    if result_df.empty or "Cum Lead Time" not in result_df.columns:
+        return result_df
+    if isinstance(result_df, SpilledResult):
+        return result_df.map_chunks(offset_requirement_dates, weekmask=weekmask, holidays=holidays)
+
+    plan_dates = result_df["Date"].to_numpy(dtype="datetime64[D]")
+    lead_days  = np.rint(result_df["Cum Lead Time"].to_numpy(dtype=float)).astype(np.int64)
+    has_lead   = lead_days > 0
+
+    release = plan_dates.copy()
+    if has_lead.any():
+        release[has_lead] = np.busday_offset(
+            plan_dates[has_lead], -lead_days[has_lead],
+            roll="backward", weekmask=weekmask,
+            holidays=[] if holidays is None else holidays,
+        )
+
+    result_df = result_df.copy()
+    result_df["Plan Date"] = result_df["Date"]
+    result_df["Date"] = pd.to_datetime(release)
+    return result_df
+
+# ==============================================================================
+# 3a-4. تجهيز الخطة وتجميع الاحتياج (مشتركة بين الواجهة والمعالجة الدفعية)
+# ==============================================================================
+def melt_plan(plan_df, date_cols):
+    """
+    تحويل الخطة من الشكل الأفقي (عمود لكل تاريخ) إلى صف لكل (منتج × تاريخ)
+    مع إزالة الصفوف بكمية صفر أو تاريخ مجهول
+    """
+    plan_melted = plan_df.melt(
+        id_vars=[col("material"), col("material_desc"), col("order_type")],
+        value_vars=date_cols,
+        var_name="Date",
+        value_name="Planned Quantity"
+    )
+    plan_melted["Date"] = pd.to_datetime(plan_melted["Date"], errors='coerce')
+    plan_melted["Planned Quantity"] = pd.to_numeric(
+        plan_melted["Planned Quantity"], errors="coerce"
+    ).fillna(0)
+    # إزالة الصفوف بكمية صفر أو تاريخ مجهول
+    return plan_melted[
+        (plan_melted["Planned Quantity"] > 0) &
+        (plan_melted["Date"].notna())
+    ].copy()
+
+
+def plan_date_columns(plan_df):
+    """أعمدة التواريخ في ورقة الخطة"""
+    return [c for c in plan_df.columns if isinstance(c, (datetime.datetime, pd.Timestamp))]
+
+
+REQ_QTY = "Required Component Quantity"
+# أعمدة وصف المكون — مفتاح صفوف كل الجداول المحورية
+COMP_KEYS = [
+    col("component"), col("component_desc"), col("component_uom"),
+    col("mrp_controller"), col("current_stock"), col("component_order_type"),
+]
+
+
+def group_sum(df, keys, engine="pandas"):
+    """
+    groupby(keys).sum(Required Component Quantity) — نفس الناتج بالمحركين
+    (الصفوف ذات مفتاح فارغ تُستبعد ومرتبة حسب المفاتيح كما في pandas)
+    """
+    if engine == "duckdb":
+        return _duckdb_group(df, keys)
+    return df.groupby(keys, as_index=False)[REQ_QTY].sum()
+
+
+def summarize_requirements(result_df, engine="pandas"):
+    """
+    تجميع إجمالي لكل مكون × تاريخ × نوع الطلب × مستوى
+    ✅ نعتمد على BOM Level (المحسوب تعاودياً) وليس hierarchy_level من ورقة Component
+    """
+    keys = COMP_KEYS + ["Order Type", "Date", "BOM Level"]
+    if isinstance(result_df, SpilledResult):
+        if engine == "duckdb":
+            return _duckdb_group(result_df.paths, keys)
+        # جمع جزئي لكل جزء ثم جمع نهائي للمجاميع الجزئية (الجمع قابل للتجزئة)
+        partials = [group_sum(chunk, keys) for chunk in result_df.iter_chunks(keys + [REQ_QTY])]
+        return group_sum(pd.concat(partials, ignore_index=True), keys)
+    return group_sum(result_df, keys, engine)
+
+
+def pivot_need_by_date(merged_df, engine="pandas"):
+    """Need_By_Date: صف لكل مكون وعمود لكل تاريخ (مجموع كل المستويات)"""
+    # تجميع كل المستويات: لكل مكون × تاريخ → جمع الاحتياجات
+    result_date = group_sum(merged_df, COMP_KEYS + ["Date"], engine)
+
+    pivot_by_date = result_date.pivot_table(
+        index=COMP_KEYS,
+        columns="Date",
+        values=REQ_QTY,
+        aggfunc="sum",
+        fill_value=0
+    ).reset_index()
+
+    # تنسيق أسماء أعمدة التواريخ
+    pivot_by_date.columns = [
+        c.strftime("%d %b") if isinstance(c, (pd.Timestamp, datetime.datetime)) else c
+        for c in pivot_by_date.columns
+    ]
+    return pivot_by_date
+
+
+def pivot_need_by_order(merged_df, engine="pandas"):
+    """Need_By_Order_Type: صف لكل مكون وعمود لكل (نوع طلب × تاريخ)"""
+    result_order = group_sum(merged_df, COMP_KEYS + ["Order Type", "Date"], engine)
+
+    pivot_by_order = result_order.pivot_table(
+        index=COMP_KEYS,
+        columns=["Date", "Order Type"],
+        values=REQ_QTY,
+        aggfunc="sum",
+        fill_value=0
+    ).reset_index()
+
+    # تسطيح أسماء الأعمدة المركبة
+    flat_cols = []
+    for c in pivot_by_order.columns:
+        if isinstance(c, tuple):
+            date_part, ot_part = c
+            if isinstance(date_part, (pd.Timestamp, datetime.datetime)):
+                flat_cols.append(f"{ot_part} - {date_part.strftime('%d %b')}")
+            else:
+                flat_cols.append(str(date_part) if date_part else str(ot_part))
+        else:
+            flat_cols.append(c)
+    pivot_by_order.columns = flat_cols
+    return pivot_by_order
+
+
+def component_requirements(merged_df, engine="pandas"):
+    """
+    أساس تحليل التغطية: إجمالي الاحتياج لكل مكون × مستوى + أنواع الطلب المرتبطة به
+    """
+    keys = [
+        col("component"), col("component_desc"), col("component_uom"),
+        col("current_stock"), col("component_order_type"),
+        "BOM Level", col("mrp_controller"),
+    ]
+    if engine == "duckdb":
+        return _duckdb_group(
+            merged_df, keys,
+            extra_sql='array_to_string(list_sort(list_distinct(list(CAST("Order Type" AS VARCHAR)))), \', \') AS "Order Type"',
+        )
+    return (
+        merged_df
+        .groupby(keys, as_index=False)
+        .agg(
+            Required_Qty=(REQ_QTY, "sum"),
+            Order_Types=("Order Type", lambda x: ", ".join(sorted(set(str(v) for v in x if pd.notna(v)))))
+        )
+        .rename(columns={
+            "Required_Qty": REQ_QTY,
+            "Order_Types": "Order Type",
+        })
+    )
+
+
+# ==============================================================================
+# 3a-4b. توزيع الرصيد على الاحتياجات حسب الأولوية (Allocation)
+# ==============================================================================
+# الرصيد الحالي لكل مكون يُخصَّص للاحتياجات بالترتيب: يُرتَّب الاحتياج مرة واحدة
+# (مكون ثم مفاتيح الأولوية) ثم مجموع تراكمي لكل مكون — O(n log n) بدون حلقات
+ALLOCATION_PRIORITIES = {
+    "date":       ["Date", "_ot_rank"],   # الأقدم أولاً، ثم نوع الطلب
+    "order_type": ["_ot_rank", "Date"],   # نوع الطلب أولاً (مثلاً التصدير)، ثم التاريخ
+}
+
+
+def allocate_stock(merged_df, priority="date", order_type_rank=None):
+    """
+    توزيع Current Stock لكل مكون على احتياجاته (مكون × نوع الطلب × تاريخ)
+
+    المدخلات:
+        merged_df       : ناتج summarize_requirements
+        priority        : مفتاح من ALLOCATION_PRIORITIES
+        order_type_rank : ترتيب أنواع الطلب (مثلاً ["E", "L"]) — الأنواع غير المذكورة بعدها أبجدياً
+
+    المخرجات: صف لكل احتياج بترتيب التخصيص + Allocated / Shortage / Remaining Stock / Allocation Status
+    """
+    import numpy as np
+
+    comp_col  = col("component")
+    stock_col = col("current_stock")
+    demand = group_sum(merged_df, COMP_KEYS + ["Order Type", "Date"])
+
+    order_types = demand["Order Type"].astype(str)
+    ranked = list(dict.fromkeys(str(ot) for ot in (order_type_rank or [])))
+    ranked += sorted(set(order_types) - set(ranked))
+    demand["_ot_rank"] = order_types.map({ot: i for i, ot in enumerate(ranked)})
+    demand = demand.sort_values(
+        [comp_col] + ALLOCATION_PRIORITIES[priority], kind="mergesort"
+    ).reset_index(drop=True)
+
+    need     = demand[REQ_QTY].astype(float).clip(lower=0)
+    required = need.to_numpy()
+    stock    = demand[stock_col].to_numpy(dtype=float).clip(min=0)
+    cum_need = need.groupby(demand[comp_col], sort=False).cumsum().to_numpy()
+
+    allocated = np.minimum(np.maximum(stock - (cum_need - required), 0.0), required)
+    shortage  = required - allocated
+    covered   = shortage <= 1e-9
+
+    return demand.drop(columns="_ot_rank").assign(**{
+        "Allocated Quantity": allocated,
+        "Shortage Quantity":  np.where(covered, 0.0, shortage),
+        "Remaining Stock":    np.maximum(stock - cum_need, 0.0),
+        "Allocation Status":  np.select(
+            [covered, allocated > 0], ["🟢 مغطى", "🟡 جزئي"], default="🔴 غير مغطى"
+        ),
+    })
+
+
+# ==============================================================================
+# 3a-4c. مصفوفة استخدام المكونات في الموديلات (Component_in_BOMs) — تخزين متفرق
+# ==============================================================================
+# أغلب خلايا (مكون × موديل) فارغة: نحفظ القيم الفعلية فقط بصيغة COO (رقم صف، رقم عمود، كمية)
+# + جدولي أسماء للصفوف والأعمدة. الجدول العريض يُبنى فقط للشريحة المعروضة أو المكتوبة
+USAGE_ROW_KEYS = [col("component"), col("component_desc"), col("mrp_controller"), col("component_uom")]
+
+
+def component_usage_matrix(plan_melted, bom_model, controllers=None):
+    """
+    النمطي التراكمي لكل مكون داخل كل موديل بالخطة (explosion بكمية = 1 لكل موديل × نوع طلب)
+    controllers: (اختياري) مكونات MRP Controllers محددين فقط (نفس نطاق explode_plan)
+
+    المخرجات: قاموس (أو None إذا لم يوجد أي استخدام)
+        rows   : أسماء الصفوف (USAGE_ROW_KEYS) — رقم الصف = موقعه، مرتبة كما في pivot_table
+        models : أسماء الأعمدة: Material | Order Type | plan_qty | Material Description | model_info
+        coo    : row (int32) | col (int32) | qty — الخلايا غير الفارغة فقط
+    """
+    # صف واحد لكل (Material, material_desc, Order Type) بكمية = 1 وتاريخ وهمي ثابت
+    unit_plan = plan_melted[[col("material"), col("material_desc"), col("order_type")]].drop_duplicates()
+    unit_plan = unit_plan.assign(**{"Planned Quantity": 1, "Date": pd.Timestamp("2000-01-01")})
+    unit_result = explode_plan(unit_plan, bom_model, controllers=controllers)
+    if unit_result.empty:
+        return None
+
+    # 🔹 المفتاح: Material + Order Type فقط (بدون material_desc)
+    # السبب: material_desc في unit_result قد يكون فارغاً مما يُفشل الدمج ويُعيد plan_qty = NaN → 0
+    plan_qty_map = (
+        plan_melted
+        .assign(**{col("material"): plan_melted[col("material")].astype(str),
+                   col("order_type"): plan_melted[col("order_type")].astype(str)})
+        .groupby([col("material"), col("order_type")], as_index=False)["Planned Quantity"].sum()
+        .rename(columns={"Planned Quantity": "plan_qty", col("order_type"): "Order Type"})
+    )
+    # material_desc الصحيح من الخطة (يُستخدم في رأس العمود فقط)
+    mat_desc_map = (
+        plan_melted[[col("material"), col("material_desc")]]
+        .drop_duplicates(subset=[col("material")])
+        .astype({col("material"): str})
+    )
+    unit_result = (
+        unit_result
+        .drop(columns=[col("material_desc")])
+        .astype({col("material"): str, "Order Type": str})
+        .merge(plan_qty_map, on=[col("material"), "Order Type"], how="left")
+        .merge(mat_desc_map, on=col("material"), how="left")
+    )
+    # رأس العمود: كود المنتج , الكمية الفعلية , وصفه (نوع الطلب)
+    unit_result["model_info"] = (
+        unit_result[col("material")] + " , " +
+        unit_result["plan_qty"].fillna(0).round(0).astype(int).astype(str) + " , " +
+        unit_result[col("material_desc")].astype(str) + " (" +
+        unit_result["Order Type"] + ")"
+    )
+
+    # ✅ كل المستويات في خلية واحدة — نفس تجميع pivot_table (المفاتيح الفارغة تُستبعد)
+    row_keys = [c for c in USAGE_ROW_KEYS if c in unit_result.columns]
+    cells = unit_result.groupby(row_keys + ["model_info"], as_index=False)[REQ_QTY].sum()
+    if cells.empty:
+        return None
+    row_ids = cells.groupby(row_keys, sort=True).ngroup()
+    col_ids, model_labels = pd.factorize(cells["model_info"], sort=True)
+
+    models = (
+        unit_result
+        .drop_duplicates(subset=["model_info"])
+        .set_index("model_info")
+        .loc[model_labels, [col("material"), "Order Type", "plan_qty", col("material_desc")]]
+        .rename_axis("model_info")
+        .reset_index()
+    )
+    return {
+        "rows":   cells.drop_duplicates(subset=row_keys)[row_keys].reset_index(drop=True),
+        "models": models,
+        "coo":    pd.DataFrame({
+            "row": row_ids.to_numpy(dtype="int32"),
+            "col": col_ids.astype("int32"),
+            "qty": cells[REQ_QTY].to_numpy(dtype=float),
+        }),
+    }
+
+
+def is_usage_matrix(value):
+    return isinstance(value, dict) and "coo" in value
+
+
+def usage_matrix_slice(matrix, controllers=None, materials=None):
+    """شريحة من المصفوفة (نفس جداول الأسماء) — مكونات MRP Controllers محددين و/أو موديلات محددة"""
+    coo = matrix["coo"]
+    if controllers is not None:
+        # مقارنة نصية من الطرفين: أكواد رقمية (101 من Excel) تطابق "101" من الواجهة
+        in_rows = matrix["rows"][col("mrp_controller")].astype(str).isin([str(c) for c in controllers]).to_numpy()
+        coo = coo[in_rows[coo["row"].to_numpy()]]
+    if materials is not None:
+        in_models = matrix["models"][col("material")].isin([str(m) for m in materials]).to_numpy()
+        coo = coo[in_models[coo["col"].to_numpy()]]
+    return {**matrix, "coo": coo}
+
+
+def usage_matrix_labels(matrix):
+    """صفوف الشريحة التي لها قيم فعلية فقط + عمود _row (للعرض صفحةً صفحة بدون الجدول العريض)"""
+    row_ids = pd.unique(matrix["coo"]["row"])
+    row_ids.sort()
+    return matrix["rows"].iloc[row_ids].assign(_row=row_ids).reset_index(drop=True)
+
+
+def usage_matrix_dense(matrix, rows=None):
+    """
+    الجدول العريض (صف لكل مكون، عمود لكل موديل) للشريحة فقط — نفس شكل pivot_table السابق
+    rows: أرقام صفوف محددة (مثلاً الصفحة الظاهرة) — الأعمدة = الموديلات التي لها قيم فيها فقط
+    """
+    import numpy as np
+
+    coo = matrix["coo"]
+    if rows is not None:
+        coo = coo[coo["row"].isin(rows)]
+    if coo.empty:
+        return pd.DataFrame()
+
+    row_ids = np.unique(coo["row"].to_numpy())
+    col_ids = np.unique(coo["col"].to_numpy())
+    grid = np.full((len(row_ids), len(col_ids)), np.nan)
+    grid[np.searchsorted(row_ids, coo["row"].to_numpy()),
+         np.searchsorted(col_ids, coo["col"].to_numpy())] = coo["qty"].to_numpy()
+    return pd.concat([
+        matrix["rows"].iloc[row_ids].reset_index(drop=True),
+        pd.DataFrame(grid, columns=matrix["models"]["model_info"].to_numpy()[col_ids]),
+    ], axis=1)
+
+
+# ==============================================================================
+# 3a-5. محرك التجميع الخارجي (DuckDB — اختياري) للنتائج الضخمة
+# ==============================================================================
+# SQL عمودي داخل نفس العملية: GROUP BY على كل الأنوية، ويكتب الحالة الوسيطة على القرص
+# (spill) عند تجاوز memory_limit بدلاً من استهلاك ذاكرة الخادم بالكامل
+# يُستخدم تلقائياً فوق DUCKDB_AUTO_ROWS صف إذا كانت المكتبة مثبّتة، وإلا يبقى pandas
+DUCKDB_AUTO_ROWS    = 5_000_000
+DUCKDB_MEMORY_LIMIT = os.environ.get("MRP_DUCKDB_MEMORY", "2GB")
+
+
+def duckdb_available():
+    import importlib.util
+
+    return importlib.util.find_spec("duckdb") is not None
+
+
+def choose_agg_engine(n_rows, preference="auto"):
+    """auto → duckdb للنتائج الكبيرة فقط | duckdb غير مثبّت → pandas"""
+    if preference == "pandas" or not duckdb_available():
+        return "pandas"
+    if preference == "duckdb":
+        return "duckdb"
+    return "duckdb" if n_rows >= DUCKDB_AUTO_ROWS else "pandas"
+
+
+def _duckdb_connect():
+    import tempfile
+
+    import duckdb
+
+    return duckdb.connect(config={
+        "memory_limit":             DUCKDB_MEMORY_LIMIT,
+        "temp_directory":           os.path.join(tempfile.gettempdir(), "mrp_duckdb_spill"),
+        "preserve_insertion_order": False,
+    })
+
+
+def _duckdb_group(df, keys, extra_sql=""):
+    """
+    GROUP BY في DuckDB بنفس دلالات pandas: استبعاد المفاتيح الفارغة + ترتيب حسب المفاتيح
+    df: DataFrame أو قائمة ملفات Parquet (نتائج مفرّغة على القرص — تُقرأ مباشرة بدون pandas)
+    """
+    key_sql  = ", ".join(f'"{k}"' for k in keys)
+    not_null = " AND ".join(f'"{k}" IS NOT NULL' for k in keys)
+    select   = f'{key_sql}, COALESCE(SUM("{REQ_QTY}"), 0) AS "{REQ_QTY}"'
+    if extra_sql:
+        select += f", {extra_sql}"
+
+    con = _duckdb_connect()
+    try:
+        if isinstance(df, list):
+            con.execute(f"CREATE VIEW src AS SELECT * FROM read_parquet({df!r}, union_by_name = true)")
+        else:
+            con.register("src", df[[c for c in df.columns if c in keys or c in (REQ_QTY, "Order Type")]])
+        return con.execute(
+            f"SELECT {select} FROM src WHERE {not_null} GROUP BY {key_sql} ORDER BY {key_sql}"
+        ).df()
+    finally:
+        con.close()
+
+# ==============================================================================
+# 3a-6. تشغيل الـ Explosion في الخلفية (تقدم لحظي + نتائج جزئية + إلغاء)
+# ==============================================================================
+class ExplosionCancelled(Exception):
+    """أُلغي الحساب من المستخدم"""
+
+
+class ExplosionJob:
+    """
+    بناء نموذج الـ BOM + التفجير في thread منفصل عن الواجهة
+
+    - snapshot(): المرحلة الحالية + عدد المنتجات المنتهية + المنتج الحالي + الوقت المتبقي المتوقع
+    - partial_need(): الاحتياج المجمّع حتى الآن (مكون × تاريخ) من المنتجات المنتهية فقط
+    - cancel(): إيقاف الحساب قبل المنتج الجذر التالي
+    - bom_model: النموذج المبني — يُعاد استخدامه في باقي الأقسام بدلاً من بنائه مرة أخرى
+      (من سجل النماذج المشترك: نفس ورقة Component في جلسة أخرى ⇐ نفس النموذج بدون إعادة بناء)
+    - component_df: بعد الانتهاء = النسخة المشتركة في السجل (للقراءة فقط)
+
+    bom_key: بصمة ورقة Component إذا كانت محسوبة مسبقاً (bom_fingerprint)
+    controllers: (اختياري) تضييق التفجير على مكونات MRP Controllers محددين (controller_scope)
+    """
+
+    def __init__(self, plan_melted, component_df, spill_rows=None, bom_key=None, controllers=None):
+        self.plan_melted  = plan_melted
+        self.component_df = component_df
+        self.bom_key      = bom_key
+        self.controllers  = controllers
+        self.spill_rows   = spill_rows
+        self.bom_model    = None
+        self.result       = None
+        self.error        = None
+        self._cancel      = threading.Event()
+        self._lock        = threading.Lock()
+        self._partial     = {}
+        self._state       = {"stage": "⏳ في الانتظار", "done": 0, "total": 0, "material": None}
+        self._started     = None
+        self._thread      = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        import time
+
+        self._started = time.monotonic()
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        """انتظار انتهاء الحساب (الخطط الصغيرة تنتهي قبل أول عرض للتقدم)"""
+        self._thread.join(timeout)
+        return not self.running
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    @property
+    def cancelled(self):
+        return isinstance(self.error, ExplosionCancelled)
+
+    def _set_state(self, **state):
+        with self._lock:
+            self._state.update(state)
+
+    def _on_progress(self, done, total, material, new_rows):
+        partial = self._partial
+        if isinstance(new_rows, pd.DataFrame):
+            new_rows = (
+                new_rows.groupby([col("component"), "Date"], as_index=False)[REQ_QTY].sum()
+                .to_dict("records")
+            )
+        with self._lock:
+            for r in new_rows:
+                key = (r[col("component")], r["Date"])
+                partial[key] = partial.get(key, 0.0) + r[REQ_QTY]
+            self._state.update(done=done, total=total, material=material)
+
+    def _run(self):
+        try:
+            self._set_state(stage="🧱 بناء نموذج الـ BOM")
+            self.component_df, self.bom_model = shared_bom_model(self.component_df, self.bom_key)
+            if self._cancel.is_set():
+                raise ExplosionCancelled()
+            self._set_state(stage="🔩 تفجير الخطة")
+            self.result = explode_plan(
+                self.plan_melted, self.bom_model, spill_rows=self.spill_rows,
+                progress=self._on_progress, cancel=self._cancel, controllers=self.controllers,
+            )
+            self._set_state(stage="✅ اكتمل")
+        except Exception as e:
+            self.error = e
+            self._set_state(stage="⛔ أُلغي" if isinstance(e, ExplosionCancelled) else "❌ فشل")
+
+    def snapshot(self):
+        import time
+
+        with self._lock:
+            state = dict(self._state)
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        done, total = state["done"], state["total"]
+        state["elapsed"] = elapsed
+        state["eta"] = elapsed / done * (total - done) if done and total else None
+        return state
+
+    def partial_need(self):
+        with self._lock:
+            items = list(self._partial.items())
+        if not items:
+            return pd.DataFrame()
+        keys, qty = zip(*items)
+        need = pd.DataFrame(list(keys), columns=[col("component"), "Date"]).assign(**{REQ_QTY: qty})
+        pivot = need.pivot_table(index=col("component"), columns="Date", values=REQ_QTY,
+                                 aggfunc="sum", fill_value=0).reset_index()
+        pivot.columns = [
+            c.strftime("%d %b") if isinstance(c, (pd.Timestamp, datetime.datetime)) else c
+            for c in pivot.columns
+        ]
+        return pivot
+
+
+# ==============================================================================
+# 3a-7. سجل نماذج الـ BOM المشترك بين الجلسات (على مستوى العملية + LRU)
+# ==============================================================================
+# عدة مستخدمين يرفعون نفس ورقة Component ⇐ نموذج واحد في الذاكرة بدلاً من نسخة لكل جلسة
+# - المفتاح: bom_fingerprint (محتوى الورقة) — المحتوى المختلف لا يُشارك أبداً
+# - القيمة: ورقة Component المنظفة + النموذج المفهرس — للقراءة فقط
+#   (copy-on-write مفعّل في الواجهة، والإضافات الكسولة مثل bom_arrays نتيجتها واحدة لأي جلسة)
+# - عند تجاوز BOM_REGISTRY_MB يُحذف الأقدم استخداماً (LRU) — الجلسات التي ما زالت
+#   تستخدمه تحتفظ بمرجعها، لكنه لا يُعطى لجلسات جديدة
+BOM_REGISTRY_MB = int(os.environ.get("MRP_BOM_REGISTRY_MB", 2048))
+# الواجهة تحتفظ بالملفات المحمّلة (نفس الإطارات التي يشير إليها السجل) بعدد ومدة محدودين —
+# وإلا يبقى كل ملف مرفوع في الذاكرة طوال عمر العملية ولا يحرر حذف LRU من السجل شيئاً
+BOM_REGISTRY_FILES = int(os.environ.get("MRP_BOM_REGISTRY_FILES", 8))
+BOM_REGISTRY_TTL   = int(os.environ.get("MRP_BOM_REGISTRY_TTL", 3600))    # ثوانٍ
+
+# تقدير تكلفة bom_dict (كائنات Python): tuple + float + خانة القائمة لكل علاقة، قائمة + خانة قاموس لكل أب
+_EDGE_BYTES   = 120
+_PARENT_BYTES = 160
+
+_BOM_REGISTRY      = {}   # bom_key -> entry (الترتيب = ترتيب الاستخدام، الأقدم أولاً)
+_BOM_BUILDS        = {}   # bom_key -> Lock أثناء البناء (جلستان بنفس الورقة ⇐ بناء واحد)
+_BOM_REGISTRY_LOCK = threading.Lock()
+
+
+def _bom_model_nbytes(entry):
+    """الحجم التقديري للمدخل (بايت) — الثابت محسوب عند الإضافة + ما بُني لاحقاً داخل النموذج"""
+    bom_model = entry["bom_model"]
+    nbytes = entry["base_bytes"]
+    if "arrays" in bom_model:
+        nbytes += sum(getattr(v, "nbytes", 0) for v in bom_model["arrays"].values())
+    if "comp_info_index" in bom_model:
+        nbytes += entry["info_bytes"]
+    if "parents_of" in bom_model:
+        nbytes += _EDGE_BYTES * entry["edges"]
+    return nbytes
+
+
+def _evict_bom_models(budget_bytes):
+    """حذف الأقدم استخداماً حتى يصبح الإجمالي ضمن الحد (يبقى الأحدث دائماً حتى لو تجاوز وحده)"""
+    keys = list(_BOM_REGISTRY)
+    total = sum(_bom_model_nbytes(_BOM_REGISTRY[k]) for k in keys)
+    for key in keys[:-1]:
+        if total <= budget_bytes:
+            break
+        total -= _bom_model_nbytes(_BOM_REGISTRY.pop(key))
+
+
+def shared_bom_model(component_df, bom_key=None, budget_mb=None):
+    """
+    النموذج المفهرس لورقة Component من السجل المشترك — يُبنى فقط إذا لم يكن موجوداً
+
+    المخرجات: (component_df, bom_model) — النسخة المشتركة (للقراءة فقط)
+    """
+    key = bom_key or bom_fingerprint(component_df)
+    with _BOM_REGISTRY_LOCK:
+        entry = _BOM_REGISTRY.pop(key, None)
+        if entry is not None:
+            _BOM_REGISTRY[key] = entry          # ← الأحدث استخداماً
+            return entry["component_df"], entry["bom_model"]
+        build_lock = _BOM_BUILDS.setdefault(key, threading.Lock())
+
+    with build_lock:
+        with _BOM_REGISTRY_LOCK:
+            entry = _BOM_REGISTRY.get(key)
+        if entry is None:
+            bom_model = build_bom_model(component_df)
+            bom_dict = bom_model["bom_dict"]
+            info_bytes = int(bom_model["comp_info"].memory_usage(deep=True).sum())
+            edges = sum(len(ch) for tree in bom_dict.values() for ch in tree.values())
+            entry = {
+                "component_df": component_df,
+                "bom_model":    bom_model,
+                "info_bytes":   info_bytes,
+                "edges":        edges,
+                "base_bytes":   int(component_df.memory_usage(deep=True).sum()) + info_bytes
+                                + _EDGE_BYTES * edges
+                                + _PARENT_BYTES * sum(len(tree) for tree in bom_dict.values()),
+            }
+            with _BOM_REGISTRY_LOCK:
+                _BOM_REGISTRY[key] = entry
+                _BOM_BUILDS.pop(key, None)
+                _evict_bom_models((budget_mb or BOM_REGISTRY_MB) * 2**20)
+    return entry["component_df"], entry["bom_model"]
+
+
+def bom_registry_info():
+    """حالة السجل: عدد النماذج + الحجم التقديري + الحد (ميجابايت)"""
+    with _BOM_REGISTRY_LOCK:
+        sizes = {k: _bom_model_nbytes(e) for k, e in _BOM_REGISTRY.items()}
+    return {
+        "models":    len(sizes),
+        "size_mb":   sum(sizes.values()) / 2**20,
+        "budget_mb": BOM_REGISTRY_MB,
+        "keys":      list(sizes),
+    }
+
+
+def clear_bom_registry():
+    with _BOM_REGISTRY_LOCK:
+        _BOM_REGISTRY.clear()
+
+
+# ==============================================================================
+# 3b. دالة BOM Paths — المسارات الأفقية الكاملة لكل مكون
+# ==============================================================================
+# هذه الدالة تقوم بعمل BOM Explosion (تفجير هيكل المنتج)
+# حيث يتم تحويل العلاقة بين Parent و Component
+# إلى مسارات كاملة تبدأ من أعلى مستوى (Root)
+# وتنتهي عند آخر مستوى (Leaf) باستخدام أسلوب الـ Recursion
+# ملاحظة:
+# يتم تطبيق التفجير فقط على الأكواد (Parent) المختارة كـ Root:
+# - إما قائمة صريحة (موديلات الخطة / اختيار المستخدم / MRP Controller)
+# - أو كل الأكواد التي تقع ضمن النطاق ROOT_CODE_RANGE (من 40000000 إلى 499999999)
+# يتم إخراج النتائج أولاً في شكل طولي مضغوط (generate_bom_paths_long):
+# - صف لكل عقدة: Path_ID | Level | Code | Cum_Qty — أرقام فقط بدون نصوص
+# ثم يُبنى الشكل الأفقي عند العرض أو التصدير فقط (bom_paths_to_wide):
+# - كل صف يمثل مسار كامل داخل الـ BOM
+# - كل مستوى في المسار يتم تمثيله في عمود منفصل (Level_1, Level_2, Level_3, ...)
+# كما يتم إضافة أعمدة موازية للأسماء (Name_1, Name_2, ...)
+# بحيث يكون لكل كود (Level) اسمه المقابل بجانبه مباشرة
+# الشكل النهائي يكون أفقي (أعمدة بجوار بعض):
+# Level_1 | Name_1 | Level_2 | Name_2 | Level_3 | Name_3 | ...
+
+ROOT_CODE_RANGE = (40_000_000, 499_999_999)
+
+
+def generate_bom_paths_long(component_df, plan_df=None, roots=None, code_range=ROOT_CODE_RANGE):
+    """
+    BOM Paths بالشكل الطولي المضغوط — صف واحد لكل عقدة في كل مسار
+
+    المدخلات:
+        component_df : DataFrame بعد التحميل والتنظيف من load_and_validate_data
+        plan_df      : (اختياري) لأسماء المنتجات النهائية
+        roots        : (اختياري) أكواد الـ Root المطلوبة فقط — العمل يتناسب مع حجمها
+                       وليس مع حجم الـ BOM الكامل
+        code_range   : (min, max) — يُستخدم فقط إذا لم تُحدَّد roots (السلوك الأصلي)
+
+    المخرجات: (paths_long, path_labels)
+        paths_long  : Path_ID | Level | Code | Cum_Qty | Edge_ID
+                      - أرقام فقط (Code من نوع category) بدون أي نصوص مكررة
+                      - Edge_ID = رقم العلاقة (Parent→Component) لجلب الاسم والوحدة، و -1 للـ Root
+        path_labels : قاموس جداول الأسماء — يُستخدم فقط عند بناء العرض الأفقي (bom_paths_to_wide)
+    """
+    import numpy as np
+    from collections import defaultdict
+
+    # ── 1. تحديد عمود الأب المباشر ─────────────────────────────────────────
+    # الأكواد مُنظفة مسبقاً في clean_component_chunk — لا نسخ ولا تعديل على المدخل
+    has_parent_col = col("parent_material") in component_df.columns
+    parent_col = col("parent_material") if has_parent_col else col("material")
+
+    # ── 2. بناء قاموس العلاقات ───────────────────────────────────────────────
+    # parent -> [(child, edge_id, child_qty), ...]
+    # نأخذ أول صف فريد لكل (parent, component) — الكمية النمطية لكل وحدة من الأب
+    # الاسم والوحدة يُحفظان مرة واحدة لكل علاقة في edge_names / edge_uoms
+    uom_col = col("component_uom")
+    qty_col = col("component_qty")
+    desc_col = col("component_desc")
+
+    dedup_cols = [parent_col, col("component")]
+    bom_core = (
+        component_df
+        .drop_duplicates(subset=dedup_cols, keep="first")
+        [[parent_col, col("component"), desc_col, qty_col, uom_col]]
+    )
+
+    bom_dict   = defaultdict(list)
+    edge_names = []
+    edge_uoms  = []
+    for parent, child, name, qty, uom in zip(
+        bom_core[parent_col], bom_core[col("component")],
+        bom_core[desc_col], bom_core[qty_col], bom_core[uom_col],
+    ):
+        bom_dict[parent].append((child, len(edge_names), float(qty or 1)))
+        edge_names.append(str(name).strip())
+        edge_uoms.append(str(uom).strip())
+
+    # ── 3. تحديد الـ Root nodes ──────────────────────────────────────────────
+    if roots is not None:
+        # قائمة صريحة: نحتفظ فقط بالأكواد التي لها أبناء فعلاً
+        roots = list(dict.fromkeys(str(r).strip() for r in roots))
+        roots = [r for r in roots if r in bom_dict]
+    else:
+        lo, hi = code_range
+
+        def is_valid_root(code):
+            try:
+                val = int(str(code).strip())
+                return lo <= val <= hi
+            except ValueError:
+                return False
+
+        all_parents = component_df[parent_col].unique()
+        roots = [p for p in all_parents if is_valid_root(p)]
+
+    # ── 4. قاموس اسم الـ Root (للـ Roots المختارة فقط) ────────────────────────
+    # الأولوية: plan_df (يحتوي Material Description) ← أكثر دقة للـ Root
+    # الاحتياط: component_df نفسه إذا ظهر الـ Root كمكون في مستوى أعلى
+    root_set = set(roots)
+    root_name_dict = {}
+
+    # أولاً: من component_df — الـ Root قد يظهر كـ component في منتج آخر
+    comp_names = component_df.loc[
+        component_df[col("component")].isin(root_set), [col("component"), desc_col]
+    ].drop_duplicates(subset=[col("component")])
+    for code, name in zip(comp_names[col("component")], comp_names[desc_col]):
+        name = str(name).strip()
+        if name:
+            root_name_dict[code] = name
+
+    # ثانياً: من plan_df — المصدر الأصح لأسماء المنتجات النهائية (يُغلّب على السابق)
+    if plan_df is not None:
+        plan_names = plan_df.drop_duplicates(subset=[col("material")])
+        for code, name in zip(plan_names[col("material")], plan_names[col("material_desc")]):
+            code = str(code).strip()
+            name = str(name).strip()
+            if code in root_set and name:
+                root_name_dict[code] = name
+
+    # ── 5. الدالة التكرارية ───────────────────────────────────────────────────
+    # كل عنصر في المسار: (code, edge_id, cumulative_qty)
+    # الكمية التراكمية = حاصل ضرب كميات كل المستويات من الـ Root حتى هذا المكون
+    # (الـ label النصي لا يُبنى هنا — فقط عند العرض/التصدير الأفقي)
+    def build_paths(node, edge_id, current_path, visited, cumulative_qty):
+        current_path = current_path + [(node, edge_id, cumulative_qty)]
+
+        if node not in bom_dict:
+            return [current_path]
+
+        all_paths = []
+        for child, child_edge, child_qty in bom_dict[node]:
+            if child in visited:
+                continue
+
+            # الكمية التراكمية = كمية الأب × كمية هذا المكون لكل وحدة من الأب
+            child_paths = build_paths(
+                child, child_edge, current_path,
+                visited | {node}, cumulative_qty * child_qty
+            )
+            all_paths.extend(child_paths)
+
+        if not all_paths:
+            return [current_path]
+
+        return all_paths
+
+    # ── 6. جمع كل المسارات (بدون تكرار) ──────────────────────────────────────
+    all_paths = []
+    seen = set()
+    for root in roots:
+        for path in build_paths(root, -1, [], set(), cumulative_qty=1.0):
+            key = tuple(path)
+            if key not in seen:
+                seen.add(key)
+                all_paths.append(path)
+
+    # ── 7. عدد الآباء المباشرين الفريدين لكل مكون ────────────────────────────
+    #
+    # المنطق: لكل مكون في أي مستوى → كم أب مختلف يدخل فيه؟
+    # المصدر: bom_core (العلاقات الأصلية قبل بناء المسارات)
+    # مثال:
+    #   خامة جلد → أب: لون أحمر , لون أزرق           → العدد = 2
+    #   لون أحمر  → أب: منتج A فقط                   → العدد = 1
+    #   خيط        → أب: لون أحمر , لون أزرق , كيس    → العدد = 3
+    parent_count = (
+        bom_core
+        .groupby(col("component"))[parent_col]
+        .nunique()
+        .to_dict()
+    )
+
+    path_labels = {
+        "edge_names":   edge_names,
+        "edge_uoms":    edge_uoms,
+        "root_names":   root_name_dict,
+        "parent_count": parent_count,
+    }
+
+    if not all_paths:
+        return pd.DataFrame(columns=["Path_ID", "Level", "Code", "Cum_Qty", "Edge_ID"]), path_labels
+
+    # ── 8. تحويل إلى جدول طولي مضغوط ─────────────────────────────────────────
+    lengths = np.fromiter((len(p) for p in all_paths), dtype=np.int64, count=len(all_paths))
+    starts  = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    codes, edges, qtys = zip(*(node for path in all_paths for node in path))
+
+    paths_long = pd.DataFrame({
+        "Path_ID": np.repeat(np.arange(len(all_paths), dtype=np.int32), lengths),
+        "Level":   (np.arange(lengths.sum()) - starts + 1).astype(np.int16),
+        "Code":    pd.Categorical(codes),
+        "Cum_Qty": np.asarray(qtys, dtype=float),
+        "Edge_ID": np.asarray(edges, dtype=np.int32),
+    })
+    return paths_long, path_labels
+
+
+def _format_path_qty(qty):
+    """تنسيق الكمية: إزالة الأصفار الزائدة مع الحفاظ على 3 أرقام عشرية كحد أقصى"""
+    return f"{qty:.0f}" if qty == int(qty) else f"{qty:.3f}".rstrip("0")
+
+
+def bom_paths_to_wide(paths_long, path_labels, path_ids=None):
+    """
+    بناء العرض الأفقي (Level_N | Name_N) من الجدول الطولي
+
+    path_ids : (اختياري) بناء المسارات المطلوبة فقط — مثل الصفحة الظاهرة في الواجهة
+
+    الشكل الناتج:
+        Level_1 | Name_1                        | Level_2  | Name_2                   | ...
+        40000001| منتج نهائي                    | 50000001 | مكون أ , 2.500 KG        | ...
+
+        - الـ Root (Level_1) لا يحمل كمية (لأنه لا يوجد أب فوقه)
+        - كل مستوى تالٍ: "اسم المكون , الكمية النمطية الوحدة"
+        - الفاصل بين الاسم والكمية: " , "
+    """
+    sub = paths_long if path_ids is None else paths_long[paths_long["Path_ID"].isin(path_ids)]
+    if sub.empty:
+        return pd.DataFrame()
+
+    edge_names = path_labels["edge_names"]
+    edge_uoms  = path_labels["edge_uoms"]
+    root_names = path_labels["root_names"]
+
+    codes  = sub["Code"].astype(object)
+    labels = [
+        root_names.get(code, "") if edge < 0 else
+        f"{edge_names[edge]} , {_format_path_qty(qty)}"
+        + (f" {edge_uoms[edge]}" if edge_uoms[edge] else "")
+        for code, edge, qty in zip(codes, sub["Edge_ID"], sub["Cum_Qty"])
+    ]
+
+    nodes = pd.DataFrame({
+        "Path_ID": sub["Path_ID"].to_numpy(),
+        "Level":   sub["Level"].to_numpy(),
+        "Code":    codes.to_numpy(),
+        "Name":    labels,
+    })
+    wide_codes = nodes.pivot(index="Path_ID", columns="Level", values="Code")
+    wide_names = nodes.pivot(index="Path_ID", columns="Level", values="Name")
+
+    df_paths = pd.DataFrame(index=wide_codes.index)
+    for lvl in wide_codes.columns:
+        df_paths[f"Level_{lvl}"] = wide_codes[lvl]
+        df_paths[f"Name_{lvl}"]  = wide_names[lvl]
+    df_paths = df_paths.reset_index(drop=True)
+
+    # عدد آباء المكون المباشر — يُطبق على Level_2 ويُضاف كعمود A:A في بداية الجدول
+    # نختار Level_2 لأنه المكون المباشر الأكثر فائدة للتحليل
+    if "Level_2" in df_paths.columns:
+        df_paths.insert(
+            0, "عدد آباء المكون المباشر",
+            df_paths["Level_2"].astype(str).str.strip()
+            .map(path_labels["parent_count"]).fillna(1).astype(int)
+        )
+    else:
+        df_paths.insert(0, "عدد آباء المكون المباشر", 1)
+
+    return df_paths
+
+
+def bom_paths_index(paths_long):
+    """فهرس مختصر: صف واحد لكل مسار (الـ Root، الـ Leaf، العمق، كمية الـ Leaf) — للبحث والتقسيم لصفحات"""
+    return (
+        paths_long
+        .groupby("Path_ID", sort=False)
+        .agg(
+            Root=("Code", "first"),
+            Leaf=("Code", "last"),
+            Depth=("Level", "max"),
+            Leaf_Qty=("Cum_Qty", "last"),
+        )
+        .reset_index()
+    )
+
+
+def generate_bom_paths(component_df, plan_df=None, roots=None, code_range=ROOT_CODE_RANGE):
+    """BOM Paths — العرض الأفقي الكامل لكل المسارات (generate_bom_paths_long + bom_paths_to_wide)"""
+    return bom_paths_to_wide(*generate_bom_paths_long(component_df, plan_df, roots, code_range))
+
+
+# ==============================================================================
+# 3b-1. مستكشف شجرة الـ BOM — تحميل أبناء العقدة عند فتحها فقط
+# ==============================================================================
+# بديل تفاعلي لـ BOM Paths عند تصفح منتج واحد: لا يُعدَّد أي مسار مسبقاً،
+# كل فتح لعقدة = بحث واحد في bom_dict (نفس قواعد explode_plan) + أسماء أبنائها فقط
+def _comp_info_index(bom_model):
+    """comp_info مفهرس بكود المكون (يُبنى مرة واحدة ويُحفظ داخل النموذج)"""
+    if "comp_info_index" not in bom_model:
+        bom_model["comp_info_index"] = bom_model["comp_info"].set_index("_comp_key")
+    return bom_model["comp_info_index"]
+
+
+def bom_tree_children(bom_model, root_material, path, qty=1.0):
+    """
+    أبناء آخر عقدة في path داخل شجرة root_material
+
+    path : أكواد المسار من الجذر حتى العقدة المفتوحة (path[0] = root_material)
+    qty  : الكمية التراكمية للعقدة المفتوحة (كمية الجذر × كميات المسار)
+
+    المخرجات: صف لكل ابن
+        Component | Component Quantity | Cum Qty | Has Children | الوصف | الوحدة | MRP Controller
+        Has Children = يمكن فتحه (له أبناء، ليس حلقة، ولم يتجاوز EXPLODE_MAX_LEVEL)
+    """
+    bom_dict = bom_model["bom_dict"]
+    children = _bom_children(bom_dict, root_material, path[-1]) if len(path) <= EXPLODE_MAX_LEVEL else []
+    if not children or path[-1] in path[:-1]:
+        return pd.DataFrame()
+
+    codes = [c for c, _ in children]
+    comp_qty = pd.Series([q for _, q in children], dtype=float)
+    can_open = len(path) + 1 <= EXPLODE_MAX_LEVEL
+    info = _comp_info_index(bom_model).reindex(codes)
+    return pd.DataFrame({
+        col("component"):      codes,
+        col("component_qty"):  comp_qty,
+        "Cum Qty":             comp_qty * qty,
+        "Has Children":        [
+            can_open and c not in path and bool(_bom_children(bom_dict, root_material, c)) for c in codes
+        ],
+        col("component_desc"): info[col("component_desc")].to_numpy(),
+        col("component_uom"):  info[col("component_uom")].to_numpy(),
+        col("mrp_controller"): info[col("mrp_controller")].to_numpy(),
+    })
+
+
+# ==============================================================================
+# 3c. مخزن الـ BOM المحلي (SQLite) — حفظ ورقة Component مرة واحدة واستخدامها مع ملفات الخطة فقط
+# ==============================================================================
+# - جدول component: نفس أعمدة ورقة Component بعد التنظيف (القيم تُحفظ كما هي بدون تحويل نوع)
+#   + مفاتيح نصية مفهرسة (_material_key / _parent_key / _component_key) = astype(str).strip()
+# - جدول store_meta: بصمة المحتوى + وقت الحفظ + عدد الصفوف + اسم الملف المصدر
+# - القراءة عبر استعلام تعاودي (WITH RECURSIVE) يبدأ من موديلات الخطة ويتبع المكونات
+#   التي لها BOM مستقل (نصف مصنّع) — فلا يُبنى bom_dict إلا للفروع المطلوبة
+BOM_STORE_PATH = os.environ.get("MRP_BOM_STORE", "mrp_bom_store.sqlite")
+_STORE_KEYS = {
+    "_material_key":  "material",
+    "_parent_key":    "parent_material",
+    "_component_key": "component",
+}
+
+
+def _store_connect(path):
+    import sqlite3
+
+    return sqlite3.connect(path or BOM_STORE_PATH)
+
+
+def save_bom_store(component_df, path=None, source=""):
+    """حفظ ورقة Component (بعد التنظيف) في المخزن — يستبدل المحتوى السابق بالكامل"""
+    df = component_df.copy()
+    for key_col, name in _STORE_KEYS.items():
+        src = col(name) if col(name) in df.columns else col("material")
+        df[key_col] = df[src].astype(str).str.strip()
+
+    info = {
+        "fingerprint": bom_fingerprint(component_df),
+        "saved_at":    datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "rows":        str(len(component_df)),
+        "source":      str(source),
+    }
+    with _store_connect(path) as con:
+        # BLOB = بدون affinity في SQLite → الأكواد الرقمية تبقى أرقاماً والنصية تبقى نصوصاً
+        df.to_sql("component", con, if_exists="replace", index=False,
+                  dtype={c: "BLOB" for c in df.columns if df[c].dtype == object})
+        for key_col in _STORE_KEYS:
+            con.execute(f'CREATE INDEX IF NOT EXISTS "ix{key_col}" ON component ("{key_col}")')
+        con.execute("DROP TABLE IF EXISTS store_meta")
+        con.execute("CREATE TABLE store_meta (key TEXT PRIMARY KEY, value TEXT)")
+        con.executemany("INSERT INTO store_meta VALUES (?, ?)", info.items())
+    con.close()
+    return info
+
+
+def bom_store_info(path=None):
+    """بيانات المخزن (بصمة / وقت الحفظ / عدد الصفوف) — None إذا لم يكن موجوداً"""
+    import sqlite3
+
+    if not os.path.exists(path or BOM_STORE_PATH):
+        return None
+    try:
+        con = _store_connect(path)
+        try:
+            return dict(con.execute("SELECT key, value FROM store_meta").fetchall()) or None
+        finally:
+            con.close()
+    except sqlite3.DatabaseError:
+        return None
+
+
+def load_bom_subset(materials, path=None):
+    """
+    صفوف الـ BOM التي يمكن أن يصل إليها التفجير من هذه الموديلات فقط
+
+    الاستعلام التعاودي يجمع: الموديلات نفسها + كل مكون داخل شجرة مجموعة له BOM مستقل
+    (نفس منطق الرجوع إلى bom_dict[parent] في explode_plan)
+    الترتيب الأصلي للصفوف محفوظ (rowid) لأن drop_duplicates في التنظيف يعتمد عليه
+    """
+    roots = pd.Series(materials).dropna().astype(str).str.strip().unique().tolist()
+    con = _store_connect(path)
+    try:
+        con.execute("CREATE TEMP TABLE plan_roots (mat TEXT PRIMARY KEY)")
+        con.executemany("INSERT OR IGNORE INTO plan_roots VALUES (?)", [(m,) for m in roots])
+        df = pd.read_sql_query(
+            """
+            WITH RECURSIVE reach(mat) AS (
+                SELECT mat FROM plan_roots
+                UNION
+                SELECT c._component_key
+                FROM component c JOIN reach r ON c._material_key = r.mat
+            )
+            SELECT * FROM component
+            WHERE _material_key IN (SELECT mat FROM reach)
+            ORDER BY rowid
+            """,
+            con,
+        )
+    finally:
+        con.close()
+    return _from_store(df)
+
+
+def load_bom_store(path=None):
+    """كل صفوف المخزن بترتيبها الأصلي (للخدمات التي تحتفظ بالـ BOM كاملاً في الذاكرة)"""
+    con = _store_connect(path)
+    try:
+        df = pd.read_sql_query("SELECT * FROM component ORDER BY rowid", con)
+    finally:
+        con.close()
+    return _from_store(df)
+
+
+def _from_store(df):
+    # المخازن القديمة قد تحتفظ بأكواد رقمية — نعيدها بنفس شكل clean_component_chunk
+    df = df.drop(columns=list(_STORE_KEYS))
+    for code_col in (col("material"), col("component"), col("parent_material")):
+        if code_col in df.columns:
+            df[code_col] = df[code_col].astype(str).str.strip()
+    return df
+
+
+# ==============================================================================
+# 5. المعالجة الدفعية — مجلد ملفات (مصانع / إصدارات خطة) في Process Pool
+# ==============================================================================
+# المرحلة 1: قراءة كل الملفات بالتوازي (كل عملية تقرأ ملفاً)
+# المرحلة 2: بناء نموذج BOM واحد لكل ورقة Component مختلفة (بصمة المحتوى)
+#            — الملفات التي تشترك في نفس الـ Component master تستخدم نفس النموذج
+# المرحلة 3: تفجير الخطط بالتوازي — خطط كل نموذج تُقسم على workers مجموعة على الأكثر
+#            وكل مجموعة تحمل نموذجها فقط ⇐ ذاكرة العمليات ≈ workers × نموذج واحد وليس × كل النماذج
+# الملف الذي يحتوي Component بدون plan يُعتبر Master مشتركاً للملفات التي بلا Component
+BATCH_FILE_PATTERNS = ("*.xlsx",)
+
+
+def bom_fingerprint(component_df):
+    """بصمة محتوى ورقة Component — نفس المحتوى ⇐ نفس النموذج"""
+    import hashlib
+
+    digest = hashlib.sha1("|".join(map(str, component_df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(component_df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+def read_plan_sheet(path):
+    """ورقة plan فقط (لملفات الخطة التي تعتمد على Master مشترك)"""
+    plan_df = normalize_columns(pd.read_excel(path, sheet_name="plan", engine="openpyxl"), COLUMN_NAMES)
+    required_plan_cols = [col("material"), col("material_desc"), col("order_type")]
+    if not all(c in plan_df.columns for c in required_plan_cols):
+        raise DataValidationError(f"❌ جدول الخطة ناقص أعمدة: {required_plan_cols}")
+    return plan_df
+
+
+def read_workbook_master(path):
+    """ملف Master: ورقة Component (+ Lead Time) بدون plan — المخرجات: (component_df, zero_base)"""
+    component_df = normalize_columns(pd.read_excel(path, sheet_name="Component", engine="openpyxl"), COLUMN_NAMES)
+    known_cols = [aliases[0] for aliases in COLUMN_NAMES.values()]
+    required_comp_cols = [col("material"), col("component"), col("component_qty")]
+    if not all(c in component_df.columns for c in required_comp_cols):
+        raise DataValidationError(f"❌ جدول المكونات ناقص أعمدة: {required_comp_cols}")
+    component_df = component_df[[c for c in component_df.columns if c in known_cols]]
+    component_df, zero_base = clean_component_chunk(component_df)
+    sheets = workbook_sheet_names(path)
+    lead_df = (
+        normalize_columns(pd.read_excel(path, sheet_name=LEAD_TIME_SHEET, engine="openpyxl"), COLUMN_NAMES)
+        if LEAD_TIME_SHEET in sheets
+        else None
+    )
+    return apply_lead_times(component_df, lead_df), zero_base
+
+
+def _load_batch_workbook(path):
+    """قراءة ملف واحد داخل عملية مستقلة — الأخطاء تُعاد كنص بدلاً من إيقاف الدفعة"""
+    import os
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        sheets = workbook_sheet_names(path)
+        if "plan" not in sheets and "Component" in sheets:
+            component_df, _ = read_workbook_master(path)
+            return {"name": name, "role": "master", "component_df": component_df}
+        if "Component" not in sheets:
+            return {"name": name, "role": "plan", "plan_df": read_plan_sheet(path), "component_df": None}
+        plan_df, component_df, _, _ = read_workbook(path)
+        return {"name": name, "role": "plan", "plan_df": plan_df, "component_df": component_df}
+    except Exception as e:
+        return {"name": name, "role": "error", "error": str(e)}
+
+
+def _run_batch_plan(bom_model, task):
+    """تفجير خطة واحدة على نموذج مجموعتها"""
+    name, plan_melted, weekmask = task
+    result_df = explode_plan(plan_melted, bom_model)
+    if result_df.empty:
+        return name, pd.DataFrame()
+    if weekmask:
+        result_df = offset_requirement_dates(result_df, weekmask=weekmask)
+    return name, summarize_requirements(result_df)
+
+
+def _run_batch_group(group):
+    """مجموعة خطط تشترك في نموذج BOM واحد يصل معها — تُنفَّذ داخل عملية من الـ Pool"""
+    bom_model, tasks = group
+    return [_run_batch_plan(bom_model, task) for task in tasks]
+
+
+def _process_pool(workers, initializer=None, initargs=()):
+    """
+    Process Pool — fork عند توفره بدون خيوط نشطة (مشاركة الذاكرة copy-on-write)
+    مع خيوط نشطة (خادم Streamlit): forkserver أو spawn صراحةً — fork هنا يورّث أقفالاً
+    مقفولة من الخيوط الأخرى وقد يعلق العامل (والافتراضي على Linux هو fork)
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    methods = multiprocessing.get_all_start_methods()
+    if "fork" in methods and threading.active_count() == 1:
+        ctx = multiprocessing.get_context("fork")
+    elif "forkserver" in methods:
+        ctx = multiprocessing.get_context("forkserver")
+        # خادم العمليات يستورد هذا الملف فقط (دوال العمال كلها هنا) ثم يتفرع منه كل عامل —
+        # الافتراضي ['__main__'] يشغّل سكربت الواجهة داخل الخادم
+        ctx.set_forkserver_preload([__name__])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=ctx,
+        initializer=initializer, initargs=initargs,
+    )
+
+
+def run_batch(paths, workers=None, bucket="D", calendar_starts=None, weekmask="Sun Mon Tue Wed Thu"):
+    """
+    معالجة مجموعة ملفات دفعة واحدة
+
+    paths     : مسارات ملفات Excel (خطط كاملة أو خطط بلا Component + ملف Master واحد)
+    workers   : عدد العمليات (None = عدد المعالجات)
+    bucket    : تجميع الخطة زمنياً قبل التفجير (انظر bucket_plan)
+    weekmask  : أيام العمل لإزاحة مدة التوريد — None لتعطيل الإزاحة
+
+    المخرجات: قاموس
+        results      : {اسم الملف: merged_df} — نتيجة مستقلة لكل ملف
+        consolidated : merged_df مجمّع لكل الملفات مع عمود Source
+        summary      : جدول حالة لكل ملف (عدد الصفوف / نموذج الـ BOM / الأخطاء)
+    """
+    from collections import defaultdict
+
+    paths = sorted(map(str, paths))
+    if not paths:
+        return {"results": {}, "consolidated": pd.DataFrame(), "summary": pd.DataFrame()}
+
+    # --- المرحلة 1: القراءة بالتوازي ---
+    with _process_pool(workers) as pool:
+        loaded = list(pool.map(_load_batch_workbook, paths))
+
+    masters = [w for w in loaded if w["role"] == "master"]
+    if len(masters) > 1:
+        raise DataValidationError(
+            f"❌ يوجد أكثر من ملف Master (Component بدون plan): {', '.join(w['name'] for w in masters)}"
+        )
+    master_df = masters[0]["component_df"] if masters else None
+
+    # --- المرحلة 2: نموذج BOM واحد لكل ورقة Component مختلفة ---
+    models, tasks, summary = {}, defaultdict(list), []
+    for w in loaded:
+        if w["role"] == "master":
+            continue
+        if w["role"] == "error":
+            summary.append({"Source": w["name"], "الحالة": w["error"]})
+            continue
+        component_df = w["component_df"] if w["component_df"] is not None else master_df
+        if component_df is None:
+            summary.append({"Source": w["name"], "الحالة": "❌ لا توجد ورقة Component ولا ملف Master"})
+            continue
+        date_cols = plan_date_columns(w["plan_df"])
+        if not date_cols:
+            summary.append({"Source": w["name"], "الحالة": "❌ لم يتم العثور على أعمدة تواريخ في ورقة الخطة."})
+            continue
+
+        model_key = bom_fingerprint(component_df)
+        if model_key not in models:
+            models[model_key] = build_bom_model(component_df)
+        plan_melted = bucket_plan(melt_plan(w["plan_df"], date_cols), bucket, calendar_starts)
+        tasks[model_key].append((w["name"], plan_melted, weekmask))
+        summary.append({"Source": w["name"], "BOM Model": model_key, "Plan Rows": len(plan_melted)})
+
+    # --- المرحلة 3: التفجير بالتوازي — مجموعات لكل نموذج بعدد العمليات على الأكثر ---
+    results = {}
+    if tasks:
+        slots = workers or os.cpu_count() or 1
+        groups = []
+        for model_key, model_tasks in tasks.items():
+            k = min(slots, len(model_tasks))
+            groups += [(models[model_key], model_tasks[i::k]) for i in range(k)]
+        with _process_pool(workers) as pool:
+            done = dict(pair for group in pool.map(_run_batch_group, groups) for pair in group)
+        # ترتيب الملفات كما في المدخلات (وليس ترتيب المجموعات)
+        results = {row["Source"]: done[row["Source"]] for row in summary if row["Source"] in done}
+
+    for row in summary:
+        merged_df = results.get(row["Source"])
+        if merged_df is None:
+            continue
+        row["Requirement Rows"] = len(merged_df)
+        row["Components"] = merged_df[col("component")].nunique() if not merged_df.empty else 0
+        row["الحالة"] = "✅" if not merged_df.empty else "⚠️ لا توجد مكونات مطابقة"
+
+    frames = [df.assign(Source=name) for name, df in results.items() if not df.empty]
+    return {
+        "results":      results,
+        "consolidated": pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(),
+        "summary":      pd.DataFrame(summary),
+    }
+
+
+def batch_results_to_zip(batch):
+    """ملف ZIP: ملف Excel لكل مدخل + Consolidated.xlsx للعرض المجمّع"""
+    import zipfile
+    from io import BytesIO
+
+    def to_xlsx(sheets):
+        return sheets_to_xlsx(sheets, list(sheets), skip_empty=False)
+
+    out = BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, merged_df in batch["results"].items():
+            if merged_df.empty:
+                continue
+            zf.writestr(f"{name}.xlsx", to_xlsx({
+                "Need_By_Date":   pivot_need_by_date(merged_df),
+                "BOM_All_Levels": merged_df,
+            }))
+
+        consolidated = batch["consolidated"]
+        sheets = {"Batch_Summary": batch["summary"]}
+        if not consolidated.empty:
+            by_source = (
+                consolidated
+                .groupby([col("component"), col("component_desc"), col("component_uom"), "Source"], as_index=False)
+                ["Required Component Quantity"].sum()
+                .pivot_table(index=[col("component"), col("component_desc"), col("component_uom")],
+                             columns="Source", values="Required Component Quantity",
+                             aggfunc="sum", fill_value=0)
+                .reset_index()
+            )
+            sheets = {
+                "Need_By_Date":  pivot_need_by_date(consolidated),
+                "By_Source":     by_source,
+                **sheets,
+            }
+        zf.writestr("Consolidated.xlsx", to_xlsx(sheets))
+    return out.getvalue()
+
+
+def list_batch_files(folder):
+    """ملفات Excel داخل المجلد (مع تجاهل الملفات المؤقتة ~$ التي ينشئها Excel)"""
+    from pathlib import Path
+
+    return sorted(
+        p for pattern in BATCH_FILE_PATTERNS
+        for p in Path(folder).glob(pattern)
+        if not p.name.startswith("~$")
+    )
+
+
+# ==============================================================================
+# 5a. التصدير — ملف Excel واحد أو ملف لكل MRP Controller (بالتوازي في ZIP)
+# ==============================================================================
+_EXPORT_SHEETS = {}
+
+
+def filter_sheets_by_controllers(sheet_data_map, controllers):
+    """تطبيق فلتر MRP Controller على كل ورقة تحتوي العمود — الأوراق الأخرى كما هي (مقارنة نصية)"""
+    mrp_controller_col = col("mrp_controller")
+    wanted = [str(c) for c in controllers]
+    return {
+        name: (usage_matrix_slice(df, controllers=controllers) if is_usage_matrix(df)
+               else df[df[mrp_controller_col].astype(str).isin(wanted)]
+               if not df.empty and mrp_controller_col in df.columns else df)
+        for name, df in sheet_data_map.items()
+    }
+
+
+def sheets_to_xlsx(sheet_data_map, chosen, skip_empty=True):
+    """
+    كتابة الأوراق المختارة (بترتيب chosen) في ملف Excel — None إذا كانت كلها فارغة
+    قيمة الورقة DataFrame أو مصفوفة استخدام (component_usage_matrix)
+    """
+    from io import BytesIO
+
+    sheets = [(name, sheet_data_map.get(name, pd.DataFrame())) for name in chosen]
+    # مصفوفة الاستخدام المتفرقة → الجدول العريض لشريحتها فقط وقت الكتابة
+    sheets = [(name, usage_matrix_dense(df) if is_usage_matrix(df) else df) for name, df in sheets]
+    if skip_empty:
+        sheets = [(name, df) for name, df in sheets if not df.empty]
+    if not sheets:
+        return None
+
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+        for sheet_name, df in sheets:
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return buf.getvalue()
+
+
+def _init_export_worker(sheet_data_map, chosen):
+    """initializer: كل الأوراق تصل لكل عملية مرة واحدة — كل مهمة تحمل اسم Controller فقط"""
+    global _EXPORT_SHEETS
+    _EXPORT_SHEETS = {"sheets": sheet_data_map, "chosen": chosen}
+
+
+def _write_controller_workbook(controller):
+    """
+    ملف Excel لـ Controller واحد — تُكتب شريحته فقط من كل ورقة
+    الأوراق بدون عمود MRP Controller (Original_Plan, Summary) تُنسخ كما هي ولا تكفي وحدها لإنشاء ملف:
+    Controller بلا صفوف في كل الأوراق المفلترة ⇐ None
+    """
+    source, chosen = _EXPORT_SHEETS["sheets"], _EXPORT_SHEETS["chosen"]
+    sheets = filter_sheets_by_controllers(source, [controller])
+    filtered = [
+        sheets[name] for name in chosen
+        if name in source and (is_usage_matrix(source[name]) or col("mrp_controller") in source[name].columns)
+    ]
+    if all((df["coo"] if is_usage_matrix(df) else df).empty for df in filtered):
+        return controller, None
+    return controller, sheets_to_xlsx(sheets, chosen)
+
+
+def controller_workbooks_zip(sheet_data_map, chosen, controllers, workers=None, file_prefix="MRP_Results"):
+    """
+    ملف Excel لكل MRP Controller في عمليات متوازية، داخل ZIP واحد
+
+    - كل ملف يُضاف للـ ZIP فور انتهائه (as_completed) → الزمن الكلي ≈ زمن أكبر ملف
+    - المخرجات: (zip_bytes, controllers_without_data)
+    """
+    import re
+    import zipfile
+    from concurrent.futures import as_completed
+    from io import BytesIO
+
+    out, skipped = BytesIO(), []
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        with _process_pool(workers, _init_export_worker, (sheet_data_map, chosen)) as pool:
+            futures = [pool.submit(_write_controller_workbook, c) for c in controllers]
+            for future in as_completed(futures):
+                controller, data = future.result()
+                if data is None:
+                    skipped.append(controller)
+                    continue
+                safe_name = re.sub(r'[\\/:*?"<>|\s]+', "_", str(controller)).strip("_") or "NA"
+                zf.writestr(f"{file_prefix}_{safe_name}.xlsx", data)
+    return out.getvalue(), sorted(skipped, key=str)
+
+
+# ==============================================================================
+# 6. التشغيل من سطر الأوامر
+# ==============================================================================
+# python mrp_engine.py batch <folder> --out results.zip --workers 4 --bucket W
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MRP batch — BOM Explosion لمجلد ملفات Excel")
+    sub = parser.add_subparsers(dest="command", required=True)
+    batch_cmd = sub.add_parser("batch", help="معالجة كل ملفات المجلد في Process Pool")
+    batch_cmd.add_argument("folder")
+    batch_cmd.add_argument("--out", default="mrp_batch_results.zip")
+    batch_cmd.add_argument("--workers", type=int, default=None)
+    batch_cmd.add_argument("--bucket", choices=["D", "W", "M", "custom"], default="D")
+    batch_cmd.add_argument("--calendar", default="", help="تواريخ بداية الفترات لـ custom (مفصولة بفاصلة)")
+    batch_cmd.add_argument("--weekmask", default="Sun Mon Tue Wed Thu")
+    batch_cmd.add_argument("--no-lead-time", action="store_true", help="تعطيل إزاحة التواريخ بمدة التوريد")
+    args = parser.parse_args()
+
+    calendar_starts = [d.strip() for d in args.calendar.split(",") if d.strip()] or None
+    batch = run_batch(
+        list_batch_files(args.folder), workers=args.workers, bucket=args.bucket,
+        calendar_starts=calendar_starts, weekmask=None if args.no_lead_time else args.weekmask,
+    )
+    with open(args.out, "wb") as f:
+        f.write(batch_results_to_zip(batch))
+    print(batch["summary"].to_string(index=False))
+    print(f"✅ {args.out}")
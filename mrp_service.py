@@ -0,0 +1,315 @@
+# ==============================================================================
+# MRP Service — خدمة HTTP محلية بنموذج BOM جاهز في الذاكرة
+# ==============================================================================
+# لأدوات أخرى لا تستخدم واجهة Streamlit (سكربتات الـ ERP / شاشة خط الإنتاج):
+# - الـ BOM يُقرأ ويُفهرس مرة واحدة عند التشغيل (ملف Excel أو مخزن SQLite)
+# - كل طلب يدفع فقط ثمن خطته: بدون قراءة ملف ولا إعادة بناء النموذج
+#
+# python mrp_service.py <workbook.xlsx | mrp_bom_store.sqlite> --port 8765
+#
+#   GET  /health                          بصمة الـ BOM + عدد الصفوف + وقت التحميل
+#   POST /explode                         الاحتياج (مكون × نوع الطلب × تاريخ × مستوى)
+#   GET  /where-used?component=<code>     الموديلات التي تستخدم المكون (مباشرة وعبر نصف مصنّع)
+#   POST /coverage                        الاحتياج الكلي مقابل الرصيد + أول تاريخ عجز لكل مكون
+#
+# جسم POST (JSON):
+#   {"plan": [{"Material": "40000001", "Date": "2026-03-01", "Planned Quantity": 10,
+#              "Order Type": "E", "Material Description": "..."}, ...],
+#    "bucket": "D", "lead_time": true, "weekmask": "Sun Mon Tue Wed Thu",
+#    "detail": false,                       (explode: الصفوف التفصيلية بدل المجمّعة)
+#    "date_from": "2026-03-01", "date_to": "2026-03-31", "order_types": ["E"],
+#    "models": ["40000001"], "controllers": ["M01"],   (نطاق الحساب قبل التفجير — اختياري)
+#    "priority": "date", "order_type_rank": ["E", "L"]}   (coverage: ترتيب التخصيص)
+#
+# الناتج JSON (قائمة صفوف) افتراضياً، أو Arrow IPC stream مع ?format=arrow
+# أو Accept: application/vnd.apache.arrow.stream
+# ==============================================================================
+import datetime
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from mrp_engine import (
+    ALLOCATION_PRIORITIES,
+    COLUMN_NAMES,
+    COMP_KEYS,
+    REQ_QTY,
+    DataValidationError,
+    allocate_stock,
+    arrow_safe_frame,
+    bom_arrays,
+    bom_fingerprint,
+    bom_parents,
+    bucket_plan,
+    build_bom_model,
+    col,
+    explode_kernel_available,
+    explode_plan,
+    load_bom_store,
+    normalize_columns,
+    offset_requirement_dates,
+    read_workbook_master,
+    scope_plan,
+    summarize_requirements,
+)
+
+SERVICE_HOST = os.environ.get("MRP_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("MRP_SERVICE_PORT", 8765))
+ARROW_MIME   = "application/vnd.apache.arrow.stream"
+DEFAULT_WEEKMASK = "Sun Mon Tue Wed Thu"
+
+# النموذج الجاهز — يُملأ مرة واحدة في load_service_model ويُقرأ فقط بعدها
+_SERVICE = {}
+
+
+# ==============================================================================
+# 1. تحميل الـ BOM وتجهيز الفهارس (مرة واحدة)
+# ==============================================================================
+def load_service_model(source):
+    """
+    قراءة الـ BOM من ملف Excel (ورقة Component + Lead Time) أو من مخزن SQLite
+    ثم بناء نموذج الـ explosion وفهرس where-used وتسخين النواة المُجمّعة إن وُجدت
+    كل الفهارس الكسولة داخل النموذج تُبنى هنا — خيوط الطلبات تقرؤها فقط
+    """
+    if source.lower().endswith((".sqlite", ".db")):
+        component_df = load_bom_store(source)
+    else:
+        component_df, _ = read_workbook_master(source)
+
+    bom_model = build_bom_model(component_df)
+    bom_parents(bom_model)                  # فلتر controllers في /explode و /coverage
+    if explode_kernel_available():
+        bom_arrays(bom_model)
+        # أول استدعاء يُترجم النواة — نتحمله هنا بدلاً من أول طلب
+        warm_mat = next(iter(bom_model["bom_dict"]), None)
+        if warm_mat is not None:
+            explode_plan(_plan_frame([{col("material"): warm_mat, "Date": "2000-01-01",
+                                       "Planned Quantity": 1}]), bom_model)
+
+    _SERVICE.clear()
+    _SERVICE.update({
+        "component_df": component_df,
+        "bom_model":    bom_model,
+        # where-used: كود المكون ← مواقع صفوفه في ورقة Component
+        "used_in":      component_df.groupby(col("component"), sort=False).indices,
+        "fingerprint":  bom_fingerprint(component_df),
+        "loaded_at":    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "source":       os.path.basename(source),
+    })
+    return _SERVICE
+
+
+# ==============================================================================
+# 2. العمليات — كل دالة تأخذ جسم الطلب وتعيد DataFrame
+# ==============================================================================
+def _plan_frame(records):
+    """صفوف الخطة من JSON → نفس شكل melt_plan (الأعمدة البديلة مقبولة كما في ملفات Excel)"""
+    if not isinstance(records, list) or not records:
+        raise DataValidationError("❌ الحقل plan يجب أن يكون قائمة صفوف غير فارغة")
+    plan = normalize_columns(pd.DataFrame(records), COLUMN_NAMES)
+    missing = [c for c in (col("material"), "Date", "Planned Quantity") if c not in plan.columns]
+    if missing:
+        raise DataValidationError(f"❌ صفوف الخطة ناقصة الحقول: {missing}")
+    for c, default in ((col("material_desc"), ""), (col("order_type"), "")):
+        if c not in plan.columns:
+            plan[c] = default
+    plan[col("material")] = plan[col("material")].astype(str).str.strip()
+    plan["Date"] = pd.to_datetime(plan["Date"], errors="coerce")
+    plan["Planned Quantity"] = pd.to_numeric(plan["Planned Quantity"], errors="coerce").fillna(0)
+    return plan[(plan["Planned Quantity"] > 0) & plan["Date"].notna()]
+
+
+def _explode_body(body):
+    """تفجير خطة الطلب على النموذج الجاهز (+ التجميع الزمني وإزاحة مدة التوريد حسب الطلب)"""
+    plan = scope_plan(
+        _plan_frame(body.get("plan")), body.get("date_from"), body.get("date_to"),
+        body.get("order_types"), body.get("models"),
+    )
+    plan = bucket_plan(plan, body.get("bucket", "D"), body.get("calendar"))
+    result_df = explode_plan(plan, _SERVICE["bom_model"], controllers=body.get("controllers"))
+    if not result_df.empty and body.get("lead_time", True):
+        result_df = offset_requirement_dates(result_df, weekmask=body.get("weekmask", DEFAULT_WEEKMASK))
+    return result_df
+
+
+def explode(body):
+    result_df = _explode_body(body)
+    if result_df.empty or body.get("detail"):
+        return result_df
+    return summarize_requirements(result_df)
+
+
+def where_used(component):
+    """
+    صفوف Component التي يظهر فيها الكود — مباشرة، أو عبر نصف مصنّع يحتويه (صعوداً حتى الموديل)
+    Used Via = الكود الذي وُجد داخل الموديل (الكود نفسه للاستخدام المباشر)
+    """
+    component_df = _SERVICE["component_df"]
+    used_in      = _SERVICE["used_in"]
+
+    frames, seen, frontier = [], {component}, [component]
+    while frontier:
+        next_frontier = []
+        for code in frontier:
+            rows = used_in.get(code)
+            if rows is None:
+                continue
+            frames.append(component_df.iloc[rows].assign(**{"Used Via": code}))
+            for mat in component_df[col("material")].iloc[rows].unique():
+                if mat not in seen:
+                    seen.add(mat)
+                    next_frontier.append(mat)
+        frontier = next_frontier
+
+    if not frames:
+        return pd.DataFrame()
+    keep = [c for c in (col("material"), col("parent_material"), col("component"),
+                        col("component_desc"), col("component_qty"), col("component_uom"))
+            if c in component_df.columns]
+    return pd.concat(frames, ignore_index=True)[keep + ["Used Via"]]
+
+
+def coverage(body):
+    """الاحتياج الكلي لكل مكون مقابل الرصيد + أول تاريخ لا يغطيه الرصيد (حسب ترتيب التخصيص)"""
+    result_df = _explode_body(body)
+    if result_df.empty:
+        return result_df
+    priority = body.get("priority", "date")
+    if priority not in ALLOCATION_PRIORITIES:
+        raise DataValidationError(f"❌ priority غير معروف: {priority} — المتاح: {list(ALLOCATION_PRIORITIES)}")
+
+    allocation = allocate_stock(summarize_requirements(result_df), priority, body.get("order_type_rank"))
+    summary = (
+        allocation
+        .groupby(COMP_KEYS, as_index=False)[[REQ_QTY, "Allocated Quantity", "Shortage Quantity"]]
+        .sum()
+    )
+    summary["Coverage Percentage"] = (
+        summary[col("current_stock")] / summary[REQ_QTY].replace(0, pd.NA) * 100
+    ).astype(float).round(1).fillna(0)
+    first_short = (
+        allocation[allocation["Shortage Quantity"] > 0]
+        .groupby(col("component"))["Date"].min()
+    )
+    summary["First Shortage Date"] = summary[col("component")].map(first_short)
+    return summary
+
+
+# ==============================================================================
+# 3. خادم HTTP
+# ==============================================================================
+def _encode(df, want_arrow):
+    """DataFrame → (bytes, content type) — Arrow IPC stream أو JSON (قائمة صفوف)"""
+    if want_arrow:
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(arrow_safe_frame(df), preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), ARROW_MIME
+    body = df.to_json(orient="records", date_format="iso", force_ascii=False)
+    return body.encode("utf-8"), "application/json; charset=utf-8"
+
+
+class MRPRequestHandler(BaseHTTPRequestHandler):
+    """توجيه الطلبات إلى العمليات أعلاه — الأخطاء تعود JSON: {"error": ...}"""
+
+    server_version = "MRPService/1.0"
+
+    def do_GET(self):
+        self._dispatch(self._get)
+
+    def do_POST(self):
+        self._dispatch(self._post)
+
+    def _dispatch(self, handler):
+        """أي استثناء غير متوقع (بما فيه ترميز النتيجة) ⇐ JSON 500 بدلاً من قطع الاتصال بدون رد"""
+        try:
+            handler(urlparse(self.path))
+        except ConnectionError:
+            raise
+        except Exception as e:
+            import traceback
+
+            traceback.print_exc()
+            self._send_json({"error": f"❌ خطأ داخلي في الخادم: {e}"}, status=500)
+
+    def _get(self, url):
+        query = parse_qs(url.query)
+        if url.path == "/health":
+            return self._send_json({
+                "fingerprint": _SERVICE["fingerprint"],
+                "rows":        len(_SERVICE["component_df"]),
+                "models":      len(_SERVICE["bom_model"]["bom_dict"]),
+                "loaded_at":   _SERVICE["loaded_at"],
+                "source":      _SERVICE["source"],
+                "kernel":      "arrays" in _SERVICE["bom_model"],
+            })
+        if url.path == "/where-used":
+            code = (query.get("component") or [""])[0].strip()
+            if not code:
+                return self._send_json({"error": "❌ المعامل component مطلوب"}, status=400)
+            return self._send_frame(where_used(code), query)
+        self._send_json({"error": f"❌ مسار غير معروف: {url.path}"}, status=404)
+
+    def _post(self, url):
+        routes = {"/explode": explode, "/coverage": coverage}
+        if url.path not in routes:
+            return self._send_json({"error": f"❌ مسار غير معروف: {url.path}"}, status=404)
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise DataValidationError("❌ جسم الطلب يجب أن يكون كائن JSON")
+            df = routes[url.path](body)
+        except (DataValidationError, ValueError, TypeError) as e:
+            return self._send_json({"error": str(e)}, status=400)
+        self._send_frame(df, parse_qs(url.query))
+
+    def _send_frame(self, df, query):
+        want_arrow = (
+            (query.get("format") or [""])[0] == "arrow"
+            or ARROW_MIME in (self.headers.get("Accept") or "")
+        )
+        payload, content_type = _encode(df, want_arrow)
+        self._send(payload, content_type)
+
+    def _send_json(self, obj, status=200):
+        self._send(json.dumps(obj, ensure_ascii=False).encode("utf-8"),
+                   "application/json; charset=utf-8", status)
+
+    def _send(self, payload, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(source, host=SERVICE_HOST, port=SERVICE_PORT):
+    """تحميل الـ BOM ثم تشغيل الخادم (خيط لكل طلب — النموذج للقراءة فقط)"""
+    info = load_service_model(source)
+    server = ThreadingHTTPServer((host, port), MRPRequestHandler)
+    print(f"✅ {info['source']} — {len(info['component_df']):,} سطر BOM ({info['fingerprint']})")
+    print(f"🌐 http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MRP service — BOM Explosion عبر HTTP بنموذج جاهز في الذاكرة")
+    parser.add_argument("source", help="ملف Excel يحتوي ورقة Component أو مخزن الـ BOM (SQLite)")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    args = parser.parse_args()
+    serve(args.source, args.host, args.port)
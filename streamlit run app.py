@@ -10,529 +10,307 @@
 # -------------------------------
 import streamlit as st
 import pandas as pd
+import numpy as np
 import datetime
+import os
 from io import BytesIO
 import calendar
-import plotly.express as px
-
-# ==============================================================================
-# 2. إعداد التكوين والأعمدة
-# ==============================================================================
-COLUMN_NAMES = {
-    "material":             ["Material", "Item", "code", "Code", "المادة", "Product"],
-    "material_desc":        ["Material Description", "Description", "وصف"],
-    "order_type":           ["Order Type", "OT", "نوع الطلب", "Sales Org."],
-    "component":            ["Component", "Comp", "المكون"],
-    "component_desc":       ["Component Description", "Comp Desc", " المسمى", "وصف المكون"],
-    "component_uom":        ["Component UoM", "UoM", "الوحدة"],
-    "component_qty":        ["Component Quantity", "Qty", "كمية المكون"],
-    "base_qty":             ["Base Quantity", "Base Qty", "الكمية الأساسية"],
-    "mrp_controller":       ["MRP Controller", "مسؤول MRP"],
-    "current_stock":        ["Current Stock", "Stock", "المخزون الحالي", "Unrestricted"],
-    "component_order_type": ["Component Order Type", "Order Category", "نوع أمر المكون", "Procurement Type"],
-    "hierarchy_level":      ["Hierarchy Level", "Level", "المستوى الهرمي"],
-    "parent_material":      ["Parent Material", "Direct Parent", "الأب المباشر"],
-}
-
-def col(name_key):
-    """إرجاع اسم العمود الرئيسي"""
-    return COLUMN_NAMES[name_key][0]
-
-def normalize_columns(df, column_map):
-    """توحيد أسماء الأعمدة إلى الاسم الرئيسي"""
-    rename_dict = {}
-    for key, aliases in column_map.items():
-        for alias in aliases:
-            if alias in df.columns and alias != aliases[0]:
-                rename_dict[alias] = aliases[0]
-    return df.rename(columns=rename_dict)
+# plotly يُستورد داخل أقسام الرسوم البيانية فقط (عند تفعيلها) — لا يدفع ثمنه من يريد التصدير فقط
+
+# Copy-on-Write: الجداول المحملة مرة واحدة تُشارك بين كل الأقسام بدون نسخ —
+# أي تعديل لاحق ينشئ نسخة من الجزء المعدّل فقط ولا يمس البيانات الأصلية
+pd.set_option("mode.copy_on_write", True)
+
+# المحرك (قراءة البيانات + الـ BOM Explosion) في وحدة مستقلة بدون Streamlit
+# حتى تستطيع عمليات المعالجة الدفعية استدعاءه مباشرة
+from mrp_engine import (
+    ALLOCATION_PRIORITIES,
+    BOM_REGISTRY_FILES,
+    BOM_REGISTRY_TTL,
+    BOM_STORE_PATH,
+    DUCKDB_AUTO_ROWS,
+    ROOT_CODE_RANGE,
+    SPILL_ROWS,
+    STREAMING_AUTO_BYTES,
+    STREAMING_CHUNK_ROWS,
+    DataValidationError,
+    ExplosionJob,
+    SpilledResult,
+    allocate_stock,
+    batch_results_to_zip,
+    bom_fingerprint,
+    bom_paths_index,
+    bom_paths_to_wide,
+    bom_registry_info,
+    bom_tree_children,
+    bom_store_info,
+    bucket_plan,
+    choose_agg_engine,
+    component_requirements,
+    component_usage_matrix,
+    duckdb_available,
+    filter_sheets_by_controllers,
+    col,
+    controller_workbooks_zip,
+    generate_bom_paths_long,
+    list_batch_files,
+    melt_plan,
+    offset_requirement_dates,
+    pivot_need_by_date,
+    pivot_need_by_order,
+    plan_date_columns,
+    profile_data_quality,
+    read_workbook,
+    run_batch,
+    save_bom_store,
+    scope_plan,
+    sheets_to_xlsx,
+    summarize_requirements,
+    usage_matrix_dense,
+    usage_matrix_labels,
+    usage_matrix_slice,
+    validate_bom_graph as _validate_bom_graph,
+)
+
+# ⚙️ عمليات المعالجة المتوازية (forkserver / spawn) تعيد استيراد __main__ من مساره في كل عامل —
+# وتحت Streamlit هذا السكربت هو __main__ فتُعاد الواجهة كاملة داخل العامل. دوال العمال كلها في
+# mrp_engine، لذلك يعلن السكربت نفسه غير قابل لإعادة الاستيراد (مثل python -c / python -m)
+from importlib.machinery import ModuleSpec
+__spec__ = ModuleSpec("__main__", None)
 
 # ==============================================================================
 # 3. دالة تحميل البيانات والتحقق منها
 # ==============================================================================
-@st.cache_data
-def load_and_validate_data(uploaded_file):
+# 🧠 cache_resource: نفس الإطارات لكل الجلسات ولكل rerun بدلاً من نسخة (unpickle) لكل جلسة
+# محدود بعدد الملفات ومدة البقاء — نفس الإطارات يشير إليها سجل نماذج الـ BOM (BOM_REGISTRY_MB)
+# ⚠️ الإطارات هنا مشتركة بين كل الجلسات: للقراءة فقط — لا df[col] = … ولا كتابة في .attrs
+#    الاستدعاء يكون عبر load_and_validate_data (نسخ سطحية لكل جلسة) وليس مباشرة
+@st.cache_resource(max_entries=BOM_REGISTRY_FILES, ttl=BOM_REGISTRY_TTL)
+def _load_shared_workbook(uploaded_file, streaming, bom_store, store_version):
+    # store_version: بصمة المخزن — لإعادة القراءة عند تحديث المخزن فقط (مفتاح الـ cache)
+    # bom_key: بصمة ورقة Component محسوبة مرة واحدة عند التحميل (المخزن + مفتاح الحساب)
     try:
-        xls = pd.ExcelFile(uploaded_file, engine='openpyxl')
-
-        # --- التحقق من الأوراق ---
-        required_sheets = ["plan", "Component"]
-        missing_sheets = [s for s in required_sheets if s not in xls.sheet_names]
-        if missing_sheets:
-            st.error(f"❌ الملف لا يحتوي على الأوراق المطلوبة: {', '.join(missing_sheets)}")
-            st.stop()
-
-        # --- تحميل البيانات ---
-        plan_df      = normalize_columns(xls.parse("plan"),      COLUMN_NAMES)
-        component_df = normalize_columns(xls.parse("Component"), COLUMN_NAMES)
-        mrp_df = (
-            normalize_columns(xls.parse("MRP Controller"), COLUMN_NAMES)
-            if "MRP Controller" in xls.sheet_names
-            else pd.DataFrame()
-        )
+        plan_df, component_df, mrp_df, zero_base = read_workbook(uploaded_file, streaming, bom_store)
 
-        # ✅ إزالة الأعمدة الزائدة غير المعروفة من ورقة Component
-        known_cols = [aliases[0] for aliases in COLUMN_NAMES.values()]
-        extra_cols = [c for c in component_df.columns if c not in known_cols]
-        if extra_cols:
-            component_df.drop(columns=extra_cols, inplace=True)
-
-        # --- التحقق من الأعمدة الأساسية ---
-        required_plan_cols = [col("material"), col("material_desc"), col("order_type")]
-        if not all(c in plan_df.columns for c in required_plan_cols):
-            st.error(f"❌ جدول الخطة ناقص أعمدة: {required_plan_cols}")
-            st.stop()
-
-        required_comp_cols = [col("material"), col("component"), col("component_qty")]
-        if not all(c in component_df.columns for c in required_comp_cols):
-            st.error(f"❌ جدول المكونات ناقص أعمدة: {required_comp_cols}")
-            st.stop()
-
-        # --- تنظيف الأعمدة الرقمية في component_df ---
-        comp_qty_col = col("component_qty")
-        base_qty_col = col("base_qty")
-
-        component_df[comp_qty_col] = pd.to_numeric(component_df[comp_qty_col], errors='coerce').fillna(0)
-
-        # ✅ FIX 1: تطبيق Base Qty بشكل صحيح (خارج except)
-        if base_qty_col in component_df.columns:
-            component_df[base_qty_col] = (
-                pd.to_numeric(component_df[base_qty_col], errors='coerce')
-                .fillna(1).replace(0, 1)
-            )
-            # ⚠️ تحذير عند وجود أصفار في Base Quantity
-            zero_base = (pd.to_numeric(xls.parse("Component").get(base_qty_col, pd.Series(dtype=float)),
-                                       errors='coerce') == 0).sum() if base_qty_col in xls.parse("Component").columns else 0
-            if zero_base > 0:
-                st.warning(f"⚠️ يوجد {zero_base} قيمة صفرية في عمود Base Quantity — تم استبدالها بـ 1 تلقائياً. تحقق من البيانات.")
-            component_df[comp_qty_col] = component_df[comp_qty_col] / component_df[base_qty_col]
-            component_df.drop(columns=[base_qty_col], inplace=True)
-
-        # --- الأعمدة الاختيارية مع قيم افتراضية ---
-        if col("current_stock") not in component_df.columns:
-            component_df[col("current_stock")] = 0
-        else:
-            component_df[col("current_stock")] = pd.to_numeric(
-                component_df[col("current_stock")], errors='coerce'
-            ).fillna(0)
+        # ⚠️ تحذير عند وجود أصفار في Base Quantity
+        if zero_base > 0:
+            st.warning(f"⚠️ يوجد {zero_base} قيمة صفرية في عمود Base Quantity — تم استبدالها بـ 1 تلقائياً. تحقق من البيانات.")
 
-        if col("component_order_type") not in component_df.columns:
-            component_df[col("component_order_type")] = "غير محدد"
+        return plan_df, component_df, mrp_df, zero_base, bom_fingerprint(component_df)
 
-        if col("hierarchy_level") not in component_df.columns:
-            component_df[col("hierarchy_level")] = 1
-        else:
-            component_df[col("hierarchy_level")] = pd.to_numeric(
-                component_df[col("hierarchy_level")], errors='coerce'
-            ).fillna(1).astype(int)
+    except DataValidationError as e:
+        st.error(str(e))
+        st.stop()
+    except Exception as e:
+        st.error(f"❌ فشل تحميل الملف: {str(e)}")
+        st.stop()
 
-        if col("component_desc") not in component_df.columns:
-            component_df[col("component_desc")] = ""
 
-        if col("component_uom") not in component_df.columns:
-            component_df[col("component_uom")] = ""
+def load_and_validate_data(uploaded_file, streaming=False, bom_store=None, store_version=None):
+    """نسخة سطحية لكل جلسة من الإطارات المشتركة — تعديل أعمدتها أو .attrs لا يصل لجلسة أخرى"""
+    plan_df, component_df, mrp_df, zero_base, bom_key = _load_shared_workbook(
+        uploaded_file, streaming, bom_store, store_version
+    )
+    return plan_df.copy(deep=False), component_df.copy(deep=False), mrp_df.copy(deep=False), zero_base, bom_key
 
-        if col("mrp_controller") not in component_df.columns:
-            component_df[col("mrp_controller")] = "غير محدد"
 
-        # ✅ تنظيف عمود Parent Material إن وُجد
-        # هذا العمود يحتوي على الأب المباشر الفعلي لكل مكون (من SAP CS12)
-        if col("parent_material") in component_df.columns:
-            component_df[col("parent_material")] = (
-                component_df[col("parent_material")].astype(str).str.strip()
-            )
-        # إذا لم يكن موجوداً → نُنشئه من Material (fallback للتوافق مع ملفات قديمة)
-        else:
-            component_df[col("parent_material")] = component_df[col("material")]
+@st.cache_data(show_spinner=False)
+def validate_bom_graph(_component_df, bom_key):
+    """فحص سلامة هيكل الـ BOM — مرة واحدة لكل ملف (cached ببصمة الورقة بدلاً من hash للجدول كل rerun)"""
+    return _validate_bom_graph(_component_df)
 
-        # ✅ توحيد وحدات الوزن إلى كيلوجرام
-        # أي مكون وحدته G أو g أو GM أو gram → نقسم الكمية والرصيد على 1000 ونغير الوحدة إلى KG
-        gram_variants = {"g", "gm", "gr", "gram", "grams", "جرام", "جم"}
-        uom_col = col("component_uom")
-        qty_col = col("component_qty")
-        stk_col = col("current_stock")
 
-        is_gram = component_df[uom_col].astype(str).str.strip().str.lower().isin(gram_variants)
+# ==============================================================================
+# 3a. خيارات التجميع الزمني وأيام العمل ومحرك التجميع (قوائم الواجهة)
+# ==============================================================================
+BUCKET_OPTIONS = {
+    "D":      "📆 يومي (بدون تجميع)",
+    "W":      "🗓️ أسبوعي (بداية الأسبوع: الإثنين)",
+    "M":      "📅 شهري",
+    "custom": "✏️ تقويم مخصص",
+}
 
-        if is_gram.any():
-            component_df.loc[is_gram, qty_col] = component_df.loc[is_gram, qty_col] / 1000
-            component_df.loc[is_gram, stk_col] = component_df.loc[is_gram, stk_col] / 1000
-            component_df.loc[is_gram, uom_col] = "KG"
+WORKWEEK_OPTIONS = {
+    "Sun Mon Tue Wed Thu":         "الأحد – الخميس",
+    "Mon Tue Wed Thu Fri":         "الإثنين – الجمعة",
+    "Sat Sun Mon Tue Wed Thu":     "السبت – الخميس",
+    "Mon Tue Wed Thu Fri Sat Sun": "كل أيام الأسبوع",
+}
 
-        # ✅ NEW: توحيد وحدات المساحة من CM2 إلى M2
-        cm2_variants = {"cm2", "cm^2", "cm²", "سم2", "سم²"}
-        is_cm2 = component_df[uom_col].astype(str).str.strip().str.lower().isin(cm2_variants)
+EXPORT_MODE_OPTIONS = {
+    "single":         "📊 ملف Excel واحد",
+    "per_controller": "🗂️ ملف لكل MRP Controller (ZIP)",
+}
 
-        if is_cm2.any():
-            component_df.loc[is_cm2, qty_col] = component_df.loc[is_cm2, qty_col] / 10000
-            component_df.loc[is_cm2, stk_col] = component_df.loc[is_cm2, stk_col] / 10000
-            component_df.loc[is_cm2, uom_col] = "M2"
+ALLOCATION_PRIORITY_LABELS = {
+    "date":       "📆 التاريخ أولاً (الأقدم ثم نوع الطلب)",
+    "order_type": "📦 نوع الطلب أولاً (حسب الترتيب المختار ثم التاريخ)",
+}
 
-        return plan_df, component_df, mrp_df
+AGG_ENGINE_OPTIONS = {
+    "auto":   f"⚙️ تلقائي (DuckDB فوق {DUCKDB_AUTO_ROWS:,} صف)",
+    "pandas": "🐼 pandas (في الذاكرة)",
+    "duckdb": "🦆 DuckDB (متعدد الأنوية + كتابة على القرص عند الحاجة)",
+}
 
-    except Exception as e:
-        st.error(f"❌ فشل تحميل الملف: {str(e)}")
-        st.stop()
 
 # ==============================================================================
-# ✅ FIX 2: دالة BOM Explosion متعددة المستويات (الإصلاح الجوهري)
+# 3b. أدوات العرض — جداول مقسّمة لصفحات (Server-side Pagination)
 # ==============================================================================
-def bom_explosion(plan_melted, component_df):
-    """
-    Multi-Level BOM Explosion — النهج الصحيح لـ SAP CS12
+# لا يُرسَل للمتصفح إلا الصفحة الظاهرة من كل جدول؛ البحث والترتيب يتمّان على الخادم
+PAGE_SIZE_OPTIONS = [50, 200, 1000]
 
-    المفتاح الذهبي:  Material + Parent Material + Component
-    ✔ يمنع دمج نفس (Parent→Component) من منتجات مختلفة
-    ✔ يجمع الكميات داخل نفس المنتج فقط
-    ✔ يعزل bom_dict لكل Material → explosion آمن بدون تلوث
 
-    الخوارزمية:
-    1. groupby(Material + Parent + Component) → bom_core فريد لكل منتج
-    2. bom_dict per Material → tree[parent] = [(comp, qty), ...]
-    3. explode تعاودي لكل صف في الخطة مستقلاً
+def show_paginated(df, key, search_cols=None, format_page=None):
     """
-    from collections import defaultdict
-
-    component_df = component_df.copy()
-    component_df[col("component")] = component_df[col("component")].astype(str).str.strip()
-    component_df[col("material")]  = component_df[col("material")].astype(str).str.strip()
+    عرض DataFrame كبير صفحةً صفحة مع بحث نصي على الخادم
 
-    # تحديد عمود الأب المباشر
-    has_parent_col = col("parent_material") in component_df.columns
-    if has_parent_col:
-        component_df[col("parent_material")] = component_df[col("parent_material")].astype(str).str.strip()
-        parent_col = col("parent_material")
-    else:
-        parent_col = col("material")
-
-    # ✅ STEP 1: تنظيف ثم groupby(Material + Parent + Component) + sum
-    #
-    # SAP CS12 يصدر أحياناً صفوفاً مكررة حرفياً لنفس الزوج (Parent→Component)
-    # بنفس الكمية — هذه نسخ وليست كميات إضافية حقيقية.
-    # الحل الصحيح: خطوتان:
-    #   1. drop_duplicates على كل الأعمدة → يحذف النسخ الحرفية
-    #   2. groupby(Material+Parent+Component)+sum → يجمع الكميات الحقيقية المختلفة
-    #      داخل نفس المنتج، مع عزل كامل بين المنتجات المختلفة
-    component_df = component_df.drop_duplicates(
-        subset=[col("material"), parent_col, col("component"), col("component_qty")],
-        keep="first"
-    )
-    bom_core = component_df.groupby(
-        [col("material"), parent_col, col("component")],
-        as_index=False
-    )[col("component_qty")].sum()
-
-    # ✅ STEP 2: بناء bom_dict منفصل لكل Material
-    # tree[material][parent] = [(component, qty), ...]
-    bom_dict = {}
-    for mat, group in bom_core.groupby(col("material")):
-        tree = defaultdict(list)
-        for _, row in group.iterrows():
-            tree[row[parent_col]].append(
-                (row[col("component")], row[col("component_qty")])
-            )
-        bom_dict[mat] = tree
-
-    # معلومات وصفية للمكونات
-    comp_info = (
-        component_df
-        .drop_duplicates(subset=[col("component")], keep="last")
-        .set_index(col("component"))[[
-            col("component_desc"),
-            col("component_uom"),
-            col("mrp_controller"),
-            col("current_stock"),
-            col("component_order_type"),
-        ]]
+    key          : بادئة فريدة لمفاتيح عناصر الواجهة
+    search_cols  : الأعمدة التي يتم البحث فيها (افتراضياً: كل الأعمدة غير العشرية)
+    format_page  : دالة تنسيق تُطبَّق على الصفحة الظاهرة فقط (مثل round / fillna)
+    """
+    c_search, c_size, c_page = st.columns([3, 1, 1])
+    with c_search:
+        query = st.text_input("🔎 بحث", key=f"{key}_search", placeholder="كود أو وصف...").strip()
+    with c_size:
+        page_size = st.selectbox("صفوف/صفحة", PAGE_SIZE_OPTIONS, index=1, key=f"{key}_size")
+
+    view = df
+    if query:
+        if search_cols is None:
+            search_cols = [c for c in df.columns if not pd.api.types.is_float_dtype(df[c])]
+        mask = pd.Series(False, index=df.index)
+        for c in search_cols:
+            if c in df.columns:
+                mask |= df[c].astype(str).str.contains(query, case=False, regex=False, na=False)
+        view = df[mask]
+
+    n_pages = max((len(view) - 1) // page_size + 1, 1)
+    with c_page:
+        page = st.number_input("صفحة", min_value=1, max_value=n_pages, value=1, step=1, key=f"{key}_page")
+    page = min(int(page), n_pages)
+
+    start = (page - 1) * page_size
+    page_df = view.iloc[start:start + page_size]
+    if format_page is not None:
+        page_df = format_page(page_df)
+
+    st.dataframe(page_df, use_container_width=True, hide_index=True)
+    st.caption(
+        f"الصفوف {start + 1 if len(view) else 0:,}–{start + len(page_df):,} من {len(view):,}"
+        + (f" (نتائج البحث من أصل {len(df):,})" if query else "")
+        + f" | صفحة {page} من {n_pages}"
     )
 
-    # ✅ STEP 3: دالة explosion تعاودية آمنة
-    def explode(root_material, parent, qty, path, level, row_buf):
-        """
-        root_material : المنتج الجذر (لجلب bom_dict الصحيح)
-        parent        : الأب الحالي الذي نبحث عن أبنائه
-        qty           : الكمية المطلوبة من الأب الحالي
-        path          : مسار العقد التي مررنا بها (لمنع الحلقات)
-        level         : المستوى الهرمي الحالي
-        row_buf       : مخزن الصفوف الناتجة
-
-        المنطق الصحيح لحساب الكميات:
-        - نبحث أولاً في bom_dict[root_material] عن أبناء parent
-        - إذا لم نجد (مكون وسيط له BOM مستقل)، نبحث في bom_dict[parent]
-        - الكمية المطلوبة = qty_from_parent × qty_of_this_child
-        """
-        if parent in path or level > 10:
-            return
-
-        # البحث في شجرة المنتج الجذر أولاً، ثم في شجرة الأب نفسه (نصف مصنّع)
-        tree = bom_dict.get(root_material, {})
-        children = tree.get(parent, [])
-
-        if not children:
-            # المكون الوسيط قد يكون له BOM مستقل (semi-finished product)
-            tree = bom_dict.get(parent, {})
-            children = tree.get(parent, [])
-
-        if not children:
-            return
-
-        new_path = path | {parent}
-        for comp, comp_qty in children:
-            # ✅ الكمية الصحيحة: كمية الأب × كمية المكون لكل وحدة من الأب
-            needed = qty * comp_qty
-            row_buf.append({
-                "Parent":                        parent,
-                col("component"):                comp,
-                col("component_qty"):            comp_qty,
-                "Required Component Quantity":   needed,
-                "BOM Level":                     level,
-            })
-            # 🔁 الاستدعاء العودي الصحيح:
-            # - نمرر comp كـ parent الجديد (الأب للمستوى التالي)
-            # - نمرر needed كـ qty (الكمية المطلوبة من comp)
-            # - نحاول أولاً داخل شجرة root_material، وإلا داخل شجرة comp نفسه
-            explode(root_material, comp, needed, new_path, level + 1, row_buf)
-
-    # ✅ STEP 4: تشغيل الـ explosion لكل صف في الخطة
-    all_rows = []
-    for _, plan_row in plan_melted[plan_melted["Planned Quantity"] > 0].iterrows():
-        mat  = str(plan_row[col("material")]).strip()
-        qty  = plan_row["Planned Quantity"]
-        ot   = plan_row[col("order_type")]
-        date = plan_row["Date"]
-
-        row_buf = []
-        explode(mat, mat, qty, set(), level=1, row_buf=row_buf)
-        mat_desc = str(plan_row.get(col("material_desc"), "")).strip()
-        for r in row_buf:
-            r[col("material")]      = mat
-            r[col("material_desc")] = mat_desc
-            r["Order Type"]         = ot
-            r["Date"]               = date
-        all_rows.extend(row_buf)
-
-    if not all_rows:
-        return pd.DataFrame()
-
-    result = pd.DataFrame(all_rows)
-
-    # إضافة الأعمدة الوصفية
-    comp_info_clean = (
-        comp_info.reset_index()
-        .rename(columns={col("component"): "_comp_key"})
-        .drop_duplicates(subset=["_comp_key"])
-    )
-    result = result.merge(
-        comp_info_clean,
-        left_on=col("component"),
-        right_on="_comp_key",
-        how="left"
-    ).drop(columns=["_comp_key"], errors="ignore")
 
-    return result
+@st.fragment(run_every=1.0)
+def explosion_progress(job):
+    """لوحة تقدم الحساب — تتحدث كل ثانية بدون إعادة تشغيل الصفحة كاملة"""
+    if not job.running:
+        st.rerun()
 
-# ==============================================================================
-# 3b. دالة BOM Paths — المسارات الأفقية الكاملة لكل مكون
-# ==============================================================================
-# هذه الدالة تقوم بعمل BOM Explosion (تفجير هيكل المنتج)
-# حيث يتم تحويل العلاقة بين Parent و Component
-# إلى مسارات كاملة تبدأ من أعلى مستوى (Root)
-# وتنتهي عند آخر مستوى (Leaf) باستخدام أسلوب الـ Recursion
-# ملاحظة:
-# يتم تطبيق التفجير فقط على الأكواد (Parent)
-# التي تقع ضمن النطاق من 40000000 إلى 499999999
-# يتم إخراج النتائج في شكل DataFrame:
-# - كل صف يمثل مسار كامل داخل الـ BOM
-# - كل مستوى في المسار يتم تمثيله في عمود منفصل (Level_1, Level_2, Level_3, ...)
-# كما يتم إضافة أعمدة موازية للأسماء (Name_1, Name_2, ...)
-# بحيث يكون لكل كود (Level) اسمه المقابل بجانبه مباشرة
-# الشكل النهائي يكون أفقي (أعمدة بجوار بعض):
-# Level_1 | Name_1 | Level_2 | Name_2 | Level_3 | Name_3 | ...
-
-def generate_bom_paths(component_df, plan_df=None):
-    """
-    BOM Paths — تفجير هيكل المنتج وإنشاء مسارات أفقية كاملة
+    snap = job.snapshot()
+    done, total = snap["done"], snap["total"]
+    st.progress(done / total if total else 0.0, text=snap["stage"])
+    eta = f"{snap['eta']:,.0f} ث" if snap["eta"] is not None else "—"
+    st.caption(
+        f"المنتجات المنتهية: {done:,} من {total:,} | الحالي: {snap['material'] or '—'} | "
+        f"المنقضي: {snap['elapsed']:,.0f} ث | المتبقي المتوقع: {eta}"
+    )
+    if st.button("⛔ إلغاء الحساب", key="explosion_cancel"):
+        job.cancel()
 
-    المدخلات:
-        component_df : DataFrame بعد التحميل والتنظيف من load_and_validate_data
+    partial = job.partial_need()
+    if not partial.empty:
+        st.markdown("**📅 Need by Date — نتائج جزئية (المنتجات المنتهية فقط، قبل إزاحة Lead Time)**")
+        show_paginated(partial, key="partial_need")
 
-    المخرجات:
-        DataFrame أفقي بالشكل:
-        Level_1 | Name_1                        | Level_2  | Name_2                   | ...
-        40000001| منتج نهائي                    | 50000001 | مكون أ , 2.500 KG        | ...
 
-        - الـ Root (Level_1) لا يحمل كمية (لأنه لا يوجد أب فوقه)
-        - كل مستوى تالٍ: "اسم المكون , الكمية النمطية الوحدة"
-        - الكمية = الكمية التراكمية من الـ Root (حاصل ضرب كل المستويات)
-        - الفاصل بين الاسم والكمية: " , "
+@st.fragment
+def bom_tree_explorer(bom_model, models):
     """
-    from collections import defaultdict
-
-    component_df = component_df.copy()
-
-    # ── 1. تحديد عمود الأب المباشر ─────────────────────────────────────────
-    has_parent_col = col("parent_material") in component_df.columns
-    parent_col = col("parent_material") if has_parent_col else col("material")
-
-    # تنظيف الأكواد من المسافات الزائدة
-    component_df[col("component")]   = component_df[col("component")].astype(str).str.strip()
-    component_df[col("material")]    = component_df[col("material")].astype(str).str.strip()
-    component_df[parent_col]         = component_df[parent_col].astype(str).str.strip()
-
-    # ── 2. بناء قاموس العلاقات ───────────────────────────────────────────────
-    # parent -> [(child, child_name, child_qty, child_uom), ...]
-    # نأخذ أول صف فريد لكل (parent, component) — الكمية النمطية لكل وحدة من الأب
-    uom_col = col("component_uom")
-    qty_col = col("component_qty")
-    desc_col = col("component_desc")
-
-    dedup_cols = [parent_col, col("component")]
-    bom_core = (
-        component_df
-        .drop_duplicates(subset=dedup_cols, keep="first")
-        [[parent_col, col("component"), desc_col, qty_col, uom_col]]
-    )
+    شجرة منتج واحد — أبناء العقدة تُحمَّل عند فتحها فقط
+    (فتح/إغلاق عقدة يُعيد تشغيل هذا الجزء فقط وليس الصفحة كاملة)
 
-    # قاموس: parent -> [(child, name, qty, uom), ...]
-    bom_dict = defaultdict(list)
-    for _, row in bom_core.iterrows():
-        parent     = row[parent_col]
-        child      = row[col("component")]
-        child_name = str(row.get(desc_col, "")).strip()
-        child_qty  = float(row.get(qty_col, 1) or 1)
-        child_uom  = str(row.get(uom_col, "")).strip()
-        bom_dict[parent].append((child, child_name, child_qty, child_uom))
-
-    # ── 3. قاموس اسم الـ Root ────────────────────────────────────────────────
-    # الأولوية: plan_df (يحتوي Material Description) ← أكثر دقة للـ Root
-    # الاحتياط: component_df نفسه إذا ظهر الـ Root كمكون في مستوى أعلى
-    root_name_dict = {}
-
-    # أولاً: من component_df — الـ Root قد يظهر كـ component في منتج آخر
-    for _, row in component_df.drop_duplicates(subset=[col("component")]).iterrows():
-        code = str(row[col("component")]).strip()
-        name = str(row.get(col("component_desc"), "")).strip()
-        if code and name:
-            root_name_dict[code] = name
-
-    # ثانياً: من plan_df — المصدر الأصح لأسماء المنتجات النهائية (يُغلّب على السابق)
-    if plan_df is not None:
-        for _, row in plan_df.drop_duplicates(subset=[col("material")]).iterrows():
-            code = str(row[col("material")]).strip()
-            name = str(row.get(col("material_desc"), "")).strip()
-            if code and name:
-                root_name_dict[code] = name
-
-    # ── 4. تحديد الـ Root nodes (40000000 – 499999999) ───────────────────────
-    def is_valid_root(code):
-        try:
-            val = int(str(code).strip())
-            return 40_000_000 <= val <= 499_999_999
-        except ValueError:
-            return False
-
-    all_parents = component_df[parent_col].unique()
-    roots = [p for p in all_parents if is_valid_root(p)]
-
-    # ── 5. الدالة التكرارية ───────────────────────────────────────────────────
-    # كل عنصر في المسار: (code, label)
-    # label للـ Root  = اسم المنتج فقط (بدون كمية)
-    # label للبقية   = "الاسم , الكمية_التراكمية الوحدة"
-    # الكمية التراكمية = حاصل ضرب كميات كل المستويات من الـ Root حتى هذا المكون
-    def build_paths(node, node_label, current_path, visited, cumulative_qty):
-        current_path = current_path + [(node, node_label)]
-
-        if node not in bom_dict:
-            return [current_path]
-
-        all_paths = []
-        for child, child_name, child_qty, child_uom in bom_dict[node]:
-            if child in visited:
-                continue
-
-            # الكمية التراكمية = كمية الأب × كمية هذا المكون لكل وحدة من الأب
-            new_cumulative = cumulative_qty * child_qty
-
-            # تنسيق الكمية: إزالة الأصفار الزائدة مع الحفاظ على 3 أرقام عشرية كحد أقصى
-            qty_str = (
-                f"{new_cumulative:.0f}"
-                if new_cumulative == int(new_cumulative)
-                else f"{new_cumulative:.3f}".rstrip("0")
+    models: {كود المنتج: الوصف} — المنتجات التي لها BOM
+    """
+    c_root, c_qty = st.columns([3, 1])
+    with c_root:
+        root = st.selectbox(
+            "المنتج:", options=list(models),
+            format_func=lambda m: f"{m} — {models[m]}", key="bom_tree_root",
+        )
+    with c_qty:
+        root_qty = st.number_input("الكمية", min_value=0.0, value=1.0, step=1.0, key="bom_tree_qty")
+    if root is None:
+        return
+
+    loaded = [0]
+
+    def fmt_qty(qty):
+        return f"{qty:,.3f}".rstrip("0").rstrip(".")
+
+    def render(path, qty):
+        children = bom_tree_children(bom_model, root, path, qty)
+        loaded[0] += len(children)
+        depth = len(path) - 1
+        for child in children.to_dict("records"):
+            code = child[col("component")]
+            label = (
+                f"**{code}** — {child[col('component_desc')] if pd.notna(child[col('component_desc')]) else ''}"
+                f" | {fmt_qty(child['Cum Qty'])} {child[col('component_uom')] if pd.notna(child[col('component_uom')]) else ''}"
+                f" (×{fmt_qty(child[col('component_qty')])})"
             )
-            uom_str = f" {child_uom}" if child_uom else ""
-            child_label = f"{child_name} , {qty_str}{uom_str}"
+            cell = st.columns([depth, 40])[1] if depth else st.container()
+            if not child["Has Children"]:
+                cell.markdown(f"▫️ {label}")
+            elif cell.checkbox(label, key="bom_tree::" + "::".join(map(str, path + (code,)))):
+                render(path + (code,), child["Cum Qty"])
 
-            child_paths = build_paths(
-                child, child_label, current_path,
-                visited | {node}, new_cumulative
-            )
-            all_paths.extend(child_paths)
-
-        if not all_paths:
-            return [current_path]
-
-        return all_paths
-
-    # ── 6. جمع كل المسارات ───────────────────────────────────────────────────
-    all_paths = []
-    for root in roots:
-        root_label = root_name_dict.get(root, "")
-        paths = build_paths(root, root_label, [], set(), cumulative_qty=1.0)
-        all_paths.extend(paths)
-
-    if not all_paths:
-        return pd.DataFrame()
-
-    # ── 7. تحويل إلى DataFrame أفقي ─────────────────────────────────────────
-    max_depth = max(len(p) for p in all_paths)
-
-    columns = []
-    for i in range(1, max_depth + 1):
-        columns.append(f"Level_{i}")
-        columns.append(f"Name_{i}")
-
-    rows = []
-    for path in all_paths:
-        row = {}
-        for i, (code, label) in enumerate(path, start=1):
-            row[f"Level_{i}"] = code
-            row[f"Name_{i}"]  = label
-        rows.append(row)
-
-    df_paths = pd.DataFrame(rows, columns=columns)
-    df_paths = df_paths.drop_duplicates().reset_index(drop=True)
-
-    # ── 8. عدد الآباء المباشرين الفريدين لكل مكون ────────────────────────────
-    #
-    # المنطق: لكل مكون في أي مستوى → كم أب مختلف يدخل فيه؟
-    # المصدر: bom_core (العلاقات الأصلية قبل بناء المسارات)
-    # مثال:
-    #   خامة جلد → أب: لون أحمر , لون أزرق           → العدد = 2
-    #   لون أحمر  → أب: منتج A فقط                   → العدد = 1
-    #   خيط        → أب: لون أحمر , لون أزرق , كيس    → العدد = 3
-    #
-    # يُحسب مرة واحدة من bom_core ويُطبق على كل عمود Level في df_paths
-
-    # قاموس: component → عدد آبائه الفريدين
-    parent_count = (
-        bom_core
-        .groupby(col("component"))[parent_col]
-        .nunique()
-        .to_dict()
+    render((root,), root_qty)
+    st.caption(
+        f"🌳 العقد المحملة: {loaded[0]:,} — تُقرأ الأبناء عند فتح العقدة فقط "
+        f"(▫️ = مكون بدون أبناء) | الكمية = الكمية التراكمية لكل {fmt_qty(root_qty)} وحدة من المنتج"
     )
 
-    # تطبيقه على أول عمود Level يحتوي بيانات (Level_2 في الغالب)
-    # وإضافته كعمود A:A في بداية الجدول
-    # نختار Level_2 لأنه المكون المباشر الأكثر فائدة للتحليل
-    if "Level_2" in df_paths.columns:
-        df_paths.insert(
-            0, "عدد آباء المكون المباشر",
-            df_paths["Level_2"].astype(str).str.strip().map(parent_count).fillna(1).astype(int)
-        )
-    else:
-        df_paths.insert(0, "عدد آباء المكون المباشر", 1)
+# ==============================================================================
+# 3c. بيانات الرسوم البيانية — مجمّعة مسبقاً ومخزنة مع حالة الفلاتر
+# ==============================================================================
+# كل رسم يستلم المجموعات التي يعرضها فقط (عشرات الصفوف) بدلاً من كل صفوف التحليل
+# ولأن الدالة cached بمحتوى الجدول المفلتر: نفس الفلاتر ⇐ نفس البيانات بدون إعادة حساب
+@st.cache_data(show_spinner=False)
+def coverage_chart_data(filtered_analysis):
+    """
+    المخرجات: قاموس
+        status      : عدد المكونات لكل Coverage Status           (الدائرة)
+        critical    : أقل 10 مكونات في نسبة التغطية               (الأعمدة)
+        sunburst    : الاحتياج لكل MRP Controller × مستوى × حالة  (Sunburst)
+        order_types : عدد المكونات لكل نوع طلب                    (الدائرة)
+    """
+    req_col = "Required Component Quantity"
+
+    def count_by(key):
+        return filtered_analysis.groupby(key, as_index=False).size().rename(columns={"size": "Components"})
+
+    critical = filtered_analysis.nsmallest(10, "Coverage Percentage")[
+        [col("component"), col("component_desc"), req_col, "Coverage Percentage"]
+    ]
+    critical = critical.assign(Short_Label=(
+        critical[col("component")].astype(str) + " - " +
+        critical[col("component_desc")].astype(str).str[:25]
+    )).sort_values(req_col, ascending=True)
+
+    return {
+        "status":      count_by("Coverage Status"),
+        "critical":    critical[["Short_Label", req_col, "Coverage Percentage"]],
+        "sunburst":    (
+            filtered_analysis
+            .groupby([col("mrp_controller"), "BOM Level", "Coverage Status"], as_index=False)[req_col]
+            .sum()
+        ),
+        "order_types": count_by(col("component_order_type")),
+    }
 
-    return df_paths
 
 # ==============================================================================
 # 4. واجهة المستخدم
@@ -545,6 +323,7 @@ with st.expander("📖 دليل الاستخدام"):
     ### كيفية استخدام البرنامج:
     - حمّل ملف **Excel** يحتوي على أوراق **(plan و Component و MRP Controller)**
     - احفظ وصدّر النتائج بصيغة Excel
+    - 💾 بعد حفظ ورقة Component في **مخزن الـ BOM المحلي** يكفي رفع ملف يحتوي ورقة **plan** فقط
 
     #### 📋 الأعمدة الأساسية:
     **ورقة plan:**
@@ -562,22 +341,100 @@ with st.expander("📖 دليل الاستخدام"):
     - `Hierarchy Level` — المستوى الهرمي (1، 2، 3، ...)
     - `Current Stock` — الرصيد الحالي
     - `Component Order Type` — F (شراء) أو E (تصنيع)
+    - `Lead Time` *(اختياري)* — مدة التوريد بأيام العمل (أو ورقة مستقلة **Lead Time**: `Component` | `Lead Time`)
     """)
 
 st.markdown("<p style='font-size:16px; font-weight:bold;'>📂 اختر ملف الخطة الشهرية Excel</p>", unsafe_allow_html=True)
 uploaded_file = st.file_uploader("", type=["xlsx"])
 
+# 🗂️ المعالجة الدفعية: مجلد ملفات (مصانع / إصدارات خطة) مع نموذج BOM مشترك
+with st.expander("🗂️ معالجة دفعية لمجلد ملفات Excel"):
+    st.caption(
+        "كل ملف يُعالج في عملية مستقلة. الملفات التي تشترك في نفس ورقة Component تستخدم نموذج BOM واحداً. "
+        "ملف يحتوي Component بدون plan يُعتبر Master للملفات التي لا تحتوي Component."
+    )
+    batch_folder = st.text_input("📁 مسار المجلد على الخادم:", key="batch_folder")
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        batch_bucket = st.selectbox(
+            "🗓️ التجميع الزمني:", options=[k for k in BUCKET_OPTIONS if k != "custom"],
+            format_func=BUCKET_OPTIONS.get, key="batch_bucket",
+        )
+    with c2:
+        batch_workweek = st.selectbox(
+            "⏱️ أيام العمل (Lead Time):", options=list(WORKWEEK_OPTIONS),
+            format_func=WORKWEEK_OPTIONS.get, key="batch_workweek",
+        )
+    with c3:
+        batch_workers = st.number_input("عدد العمليات:", min_value=1, max_value=32,
+                                        value=min(4, os.cpu_count() or 1), key="batch_workers")
+
+    if st.button("▶️ تشغيل المعالجة الدفعية", key="batch_run"):
+        batch_files = list_batch_files(batch_folder) if batch_folder and os.path.isdir(batch_folder) else []
+        if not batch_files:
+            st.error("❌ لا توجد ملفات xlsx في هذا المسار.")
+        else:
+            with st.spinner(f"⏳ جاري معالجة {len(batch_files)} ملف..."):
+                try:
+                    st.session_state["batch_result"] = run_batch(
+                        batch_files, workers=int(batch_workers),
+                        bucket=batch_bucket, weekmask=batch_workweek,
+                    )
+                except DataValidationError as e:
+                    st.error(str(e))
+
+    batch = st.session_state.get("batch_result")
+    if batch is not None:
+        st.dataframe(batch["summary"], use_container_width=True, hide_index=True)
+        if not batch["consolidated"].empty:
+            st.markdown("**📊 العرض المجمّع لكل الملفات**")
+            show_paginated(pivot_need_by_date(batch["consolidated"]), key="batch_consolidated")
+        st.download_button(
+            "📥 تحميل النتائج (ZIP: ملف لكل مدخل + Consolidated)",
+            data=batch_results_to_zip(batch),
+            file_name=f"MRP_Batch_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+            mime="application/zip",
+            key="batch_download",
+        )
+
 if not uploaded_file:
     st.stop()
 
+# ⚡ الملفات الكبيرة تُقرأ على دفعات في وضع read-only لتثبيت استهلاك الذاكرة
+streaming_mode = st.checkbox(
+    "⚡ قراءة متدفقة للملفات الكبيرة (Read-only / على دفعات)",
+    value=uploaded_file.size > STREAMING_AUTO_BYTES,
+    help=f"تُقرأ ورقتا plan و Component على دفعات من {STREAMING_CHUNK_ROWS:,} صف مع تنظيف كل دفعة فوراً.",
+)
+
 # --- تحميل البيانات ---
-plan_df, component_df, mrp_df = load_and_validate_data(uploaded_file)
-plan_df_orig      = plan_df.copy()
-component_df_orig = component_df.copy()
-mrp_df_orig       = mrp_df.copy()
+# 💾 ملف خطة بدون ورقة Component → الـ BOM من المخزن المحلي (إن وُجد)
+store_info = bom_store_info()
+plan_df, component_df, mrp_df, zero_base_count, bom_key = load_and_validate_data(
+    uploaded_file, streaming=streaming_mode,
+    bom_store=BOM_STORE_PATH if store_info else None,
+    store_version=f"{store_info['fingerprint']}@{store_info['saved_at']}" if store_info else None,
+)
+
+with st.expander("💾 مخزن الـ BOM المحلي"):
+    if store_info:
+        st.caption(
+            f"آخر حفظ: {store_info['saved_at']} | الملف: {store_info['source']} | "
+            f"سطور الـ BOM: {int(store_info['rows']):,}"
+        )
+    else:
+        st.caption("المخزن فارغ — احفظ ورقة Component مرة واحدة ثم ارفع ملفات تحتوي ورقة plan فقط.")
+
+    if component_df.attrs.get("bom_store"):
+        st.info(f"📦 ورقة Component غير موجودة بالملف — تم استخدام فروع موديلات الخطة من المخزن ({len(component_df):,} سطر).")
+    elif store_info and store_info["fingerprint"] == bom_key:
+        st.success("✅ ورقة Component في هذا الملف مطابقة للمخزن.")
+    elif st.button("💾 حفظ ورقة Component الحالية في المخزن", key="bom_store_save"):
+        saved = save_bom_store(component_df, source=uploaded_file.name)
+        st.success(f"✅ تم حفظ {int(saved['rows']):,} سطر — ملفات الخطة القادمة يمكن أن تحتوي ورقة plan فقط.")
 
 # --- استخراج أعمدة التواريخ ---
-date_cols = [c for c in plan_df.columns if isinstance(c, (datetime.datetime, pd.Timestamp))]
+date_cols = plan_date_columns(plan_df)
 
 if not date_cols:
     st.error("❌ لم يتم العثور على أعمدة تواريخ في ورقة الخطة.")
@@ -588,21 +445,71 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     # ==============================================================================
     # A. تجهيز الخطة (Melt)
     # ==============================================================================
-    plan_melted = plan_df.melt(
-        id_vars=[col("material"), col("material_desc"), col("order_type")],
-        value_vars=date_cols,
-        var_name="Date",
-        value_name="Planned Quantity"
-    )
-    plan_melted["Date"] = pd.to_datetime(plan_melted["Date"], errors='coerce')
-    plan_melted["Planned Quantity"] = pd.to_numeric(
-        plan_melted["Planned Quantity"], errors="coerce"
-    ).fillna(0)
-    # إزالة الصفوف بكمية صفر أو تاريخ مجهول
-    plan_melted = plan_melted[
-        (plan_melted["Planned Quantity"] > 0) &
-        (plan_melted["Date"].notna())
-    ].copy()
+    # إزالة الصفوف بكمية صفر أو تاريخ مجهول داخل melt_plan
+    # plan_daily (بدون تجميع زمني) يُستخدم أيضاً في جدول الكميات الشهرية (القسم H)
+    plan_daily = melt_plan(plan_df, date_cols)
+
+    # 🎯 نطاق الحساب — يُطبَّق على الخطة والـ BOM قبل الـ Explosion وليس على النتائج بعده
+    with st.expander("🎯 نطاق الحساب (قبل الـ BOM Explosion)"):
+        s1, s2 = st.columns(2)
+        with s1:
+            scope_dates = st.date_input(
+                "فترة التواريخ:",
+                value=(plan_daily["Date"].min().date(), plan_daily["Date"].max().date())
+                if not plan_daily.empty else (),
+                key="scope_dates",
+            )
+            scope_order_types = st.multiselect(
+                "أنواع الطلب:", sorted(plan_daily[col("order_type")].dropna().astype(str).unique()),
+                key="scope_order_types", placeholder="الكل",
+            )
+        with s2:
+            scope_models = st.multiselect(
+                "الموديلات:", sorted(plan_daily[col("material")].astype(str).str.strip().unique()),
+                key="scope_models", placeholder="الكل",
+            )
+            scope_controllers = st.multiselect(
+                "MRP Controller:", sorted(component_df[col("mrp_controller")].dropna().astype(str).unique()),
+                key="scope_controllers", placeholder="الكل",
+                help="التفجير لا ينزل في الفروع التي لا تحتوي مكونات لهؤلاء الـ Controllers",
+            )
+        plan_scoped = scope_plan(
+            plan_daily,
+            date_from=scope_dates[0] if len(scope_dates) > 0 else None,
+            date_to=scope_dates[-1] if len(scope_dates) > 0 else None,
+            order_types=scope_order_types or None,
+            materials=scope_models or None,
+        )
+        st.caption(f"صفوف الخطة داخل النطاق: {len(plan_scoped):,} من {len(plan_daily):,}")
+    if plan_scoped.empty:
+        st.warning("⚠️ لا توجد صفوف خطة داخل النطاق المختار.")
+        st.stop()
+
+    # 🗓️ تجميع الخطة زمنياً قبل الـ Explosion (يقلل عدد مرات التفجير وحجم النتائج)
+    b1, b2 = st.columns([1, 2])
+    with b1:
+        bucket_freq = st.selectbox(
+            "🗓️ تجميع الخطة زمنياً قبل الحساب:",
+            options=list(BUCKET_OPTIONS),
+            format_func=BUCKET_OPTIONS.get,
+            key="plan_bucket_freq",
+        )
+    calendar_starts = None
+    if bucket_freq == "custom":
+        with b2:
+            calendar_text = st.text_input(
+                "تواريخ بداية الفترات (مفصولة بفاصلة):",
+                placeholder="2026-01-01, 2026-01-15, 2026-02-01",
+                key="plan_bucket_calendar",
+            )
+        calendar_starts = [d.strip() for d in calendar_text.split(",") if d.strip()]
+        try:
+            pd.to_datetime(calendar_starts)
+        except (ValueError, TypeError):
+            st.error("❌ تواريخ التقويم المخصص غير صحيحة — استخدم الصيغة YYYY-MM-DD.")
+            calendar_starts = None
+
+    plan_melted = bucket_plan(plan_scoped, bucket_freq, calendar_starts)
 
     # ==============================================================================
     # ✅ B. تشغيل Multi-Level BOM Explosion
@@ -610,29 +517,80 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
 #    st.markdown("---")
 #    st.subheader("🔩 نتائج BOM Explosion — جميع المستويات الهرمية")
 
-    result_df = bom_explosion(plan_melted, component_df)
+    # ⏳ الحساب في الخلفية: تقدم لكل منتج جذر + نتائج جزئية + إلغاء
+    # يُعاد الحساب فقط عند تغيّر الخطة أو الـ BOM — وليس مع كل تفاعل في الواجهة
+    # 💽 فوق SPILL_ROWS صف تُكتب النتائج على القرص (Parquet) وتُعالج جزءاً جزءاً
+    job_key = (bom_fingerprint(plan_melted), bom_key, tuple(scope_controllers))
+    job = st.session_state.get("explosion_job")
+    if job is None or st.session_state.get("explosion_job_key") != job_key:
+        if job is not None:
+            job.cancel()
+        job = ExplosionJob(
+            plan_melted, component_df, spill_rows=SPILL_ROWS, bom_key=bom_key,
+            controllers=scope_controllers or None,
+        ).start()
+        st.session_state["explosion_job"]     = job
+        st.session_state["explosion_job_key"] = job_key
+
+    if not job.wait(timeout=1.0):
+        explosion_progress(job)
+        st.stop()
+    if job.cancelled:
+        st.warning("⛔ تم إلغاء الحساب.")
+        if st.button("🔄 إعادة الحساب", key="explosion_restart"):
+            del st.session_state["explosion_job"]
+            st.rerun()
+        st.stop()
+    if job.error is not None:
+        st.error(f"❌ فشل حساب الـ BOM Explosion: {job.error}")
+        st.stop()
+
+    # 🧠 ورقة Component + النموذج المفهرس من السجل المشترك بين الجلسات (للقراءة فقط)
+    # نفس الورقة عند مستخدم آخر ⇐ نفس النسخة في الذاكرة بدلاً من نسخة لكل جلسة
+    component_df = job.component_df
+    registry = bom_registry_info()
+    st.caption(
+        f"🧠 نماذج BOM مشتركة بين الجلسات: {registry['models']} "
+        f"(~{registry['size_mb']:,.1f} MB من {registry['budget_mb']:,} MB)"
+    )
+
+    result_df = job.result
+    if isinstance(result_df, SpilledResult):
+        st.caption(
+            f"💽 {len(result_df):,} صف احتياج خام — حُفظت على القرص في "
+            f"{len(result_df.paths)} جزء لتثبيت استهلاك الذاكرة"
+        )
+
+    # ⏱️ إزاحة التواريخ بمدة التوريد — متاحة فقط عند وجود عمود أو ورقة Lead Time
+    if "Cum Lead Time" in result_df.columns:
+        l1, l2 = st.columns([1, 1])
+        with l1:
+            apply_lead_time = st.toggle(
+                "⏱️ إزاحة تواريخ الاحتياج بمدة التوريد (Lead Time)",
+                value=True, key="apply_lead_time",
+            )
+        with l2:
+            workweek = st.selectbox(
+                "أيام العمل:", options=list(WORKWEEK_OPTIONS),
+                format_func=WORKWEEK_OPTIONS.get, key="lead_time_workweek",
+            )
+        if apply_lead_time:
+            result_df = offset_requirement_dates(result_df, weekmask=workweek)
+
+    # 🧮 محرك التجميع: DuckDB (إن وُجد) للنتائج الضخمة — ذاكرة محدودة + كتابة على القرص
+    agg_preference = "auto"
+    if duckdb_available():
+        agg_preference = st.selectbox(
+            "🧮 محرك التجميع:", options=list(AGG_ENGINE_OPTIONS),
+            format_func=AGG_ENGINE_OPTIONS.get, key="agg_engine",
+        )
+    agg_engine = choose_agg_engine(len(result_df), agg_preference)
 
     if result_df.empty:
         st.warning("⚠️ لم يتم العثور على مكونات مطابقة بين الخطة والـ BOM.")
     else:
-        # تجميع إجمالي لكل مكون × تاريخ × نوع الطلب
-        # ✅ نعتمد على BOM Level (المحسوب تعاودياً) وليس hierarchy_level من ورقة Component
-        merged_df = (
-            result_df
-            .groupby([
-                col("component"),
-                col("component_desc"),
-                col("component_uom"),
-                col("mrp_controller"),
-                col("current_stock"),
-                col("component_order_type"),
-                "Order Type",
-                "Date",
-                "BOM Level",
-            ], as_index=False)
-            ["Required Component Quantity"]
-            .sum()
-        )
+        # تجميع إجمالي لكل مكون × تاريخ × نوع الطلب × مستوى
+        merged_df = summarize_requirements(result_df, agg_engine)
 
         actual_levels = sorted(merged_df["BOM Level"].unique())
 #        st.success(
@@ -641,13 +599,17 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
    #         f"المستويات المحسوبة: {actual_levels}"
     #    )
 
-        # 🔍 DEBUG: مساعدة في التشخيص — يمكن إخفاؤه بعد التحقق
-        with st.expander("🔍 تشخيص: عيّنة من نتائج result_df الخام (قبل التجميع)"):
-            debug_sample = result_df[["Parent", col("component"), "Order Type", "Date",
-                                      col("component_qty"), "Required Component Quantity", "BOM Level"]].copy()
+        # 🔍 DEBUG: مساعدة في التشخيص — تُحسب فقط عند طلبها (الترتيب على كامل result_df مكلف)
+        if st.checkbox("🔍 تشخيص: عيّنة من نتائج result_df الخام (قبل التجميع)", key="show_debug_sample"):
+            debug_cols = ["Parent", col("component"), "Order Type", "Date",
+                          col("component_qty"), "Required Component Quantity", "BOM Level"]
+            debug_by   = ["BOM Level", "Parent", col("component")]
+            if isinstance(result_df, SpilledResult):
+                debug_sample = result_df.sorted_head(debug_cols, debug_by, 100)
+            else:
+                debug_sample = result_df[debug_cols].sort_values(debug_by).head(100)
             debug_sample["Date"] = debug_sample["Date"].astype(str)
-            st.dataframe(debug_sample.sort_values(["BOM Level", "Parent", col("component")]).head(100),
-                         use_container_width=True)
+            st.dataframe(debug_sample, use_container_width=True)
             st.caption(f"إجمالي الصفوف الخام: {len(result_df):,}")
 
         # عرض مبسط بالمستوى
@@ -665,44 +627,26 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     # C. الملخص السريع
     # ==============================================================================
     st.markdown("---")
-    total_models     = plan_df[col("material")].nunique()
-    total_components = component_df[col("component")].nunique()
-    total_boms       = len(component_df)
-    empty_mrp_count  = mrp_df[col("component")].isna().sum() if not mrp_df.empty else 0
-
-    diff_uom = component_df.groupby(col("component"))[col("component_uom")].nunique()
-    diff_uom = diff_uom[diff_uom > 1]
-    total_diff_uom = len(diff_uom)
-
-    # اضافة المسمى جانب الكود لاكثر من وحدة
-#    diff_uom_str   = ", ".join(map(str, diff_uom.index)) if total_diff_uom > 0 else "لا يوجد"
-    diff_uom_str = ", ".join(
-        f"{comp_code} ({component_df.loc[component_df[col('component')] == comp_code, 'Component Description'].iloc[0]})"
-        for comp_code in diff_uom.index) if total_diff_uom > 0 else "لا يوجد"
-
-    diff_uom_color = "red" if total_diff_uom > 0 else "green"
-
-    missing_boms      = set(plan_df[col("material")]) - set(component_df[col("material")])
-    total_missing_boms = len(missing_boms)
-    missing_boms_html  = (
+    dq = profile_data_quality(plan_df, component_df, mrp_df, zero_base_count)
+
+    total_models        = dq["total_models"]
+    total_components    = dq["total_components"]
+    total_boms          = dq["total_boms"]
+    empty_mrp_count     = dq["empty_mrp_count"]
+    total_diff_uom      = dq["total_diff_uom"]
+    diff_uom_str        = dq["diff_uom_str"]
+    diff_uom_color      = "red" if total_diff_uom > 0 else "green"
+    missing_boms        = dq["missing_boms"]
+    total_missing_boms  = len(missing_boms)
+    missing_boms_html   = (
         f"<span style='color:red;'>{', '.join(map(str, missing_boms))}</span>"
         if missing_boms else "<span style='color:green;'>لا يوجد</span>"
     )
-
-    # إحصائيات نوع الطلب
-    order_type_map = {"F": "شراء", "E": "تصنيع"}
-    component_df["Order_Type_Label"] = component_df[col("component_order_type")].map(order_type_map).fillna("غير محدد")
-    purchase_count      = component_df.loc[component_df["Order_Type_Label"] == "شراء",    col("component")].nunique()
-    manufacturing_count = component_df.loc[component_df["Order_Type_Label"] == "تصنيع",   col("component")].nunique()
-    undefined_count     = component_df.loc[component_df["Order_Type_Label"] == "غير محدد", col("component")].nunique()
-
-    # المستويات الهرمية الموجودة
-    levels_summary = (
-        component_df.groupby(col("hierarchy_level"))[col("component")]
-        .nunique()
-        .reset_index()
-        .rename(columns={col("component"): "عدد المكونات", col("hierarchy_level"): "المستوى"})
-    )
+    zero_base_count     = dq["zero_base_count"]
+    purchase_count      = dq["purchase_count"]
+    manufacturing_count = dq["manufacturing_count"]
+    undefined_count     = dq["undefined_count"]
+    levels_summary      = dq["levels_summary"]
 
     st.markdown(f"""
     <div style="direction:rtl; text-align:right; font-size:18px;">
@@ -714,6 +658,7 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
       <li>{"❌" if empty_mrp_count>0 else "✅"} <b style="color:{'red' if empty_mrp_count>0 else 'green'};">{empty_mrp_count}</b> مكونات بدون MRP Controller</li>
       <li>{"⚠️" if total_diff_uom>0 else "✅"} <b style="color:{'red' if total_diff_uom>0 else 'green'};">{total_diff_uom}</b> مكونات لها أكثر من وحدة: <span style="color:{diff_uom_color};">{diff_uom_str}</span></li>
       <li>{"⚠️" if total_missing_boms>0 else "✅"} <b style="color:{'red' if total_missing_boms>0 else 'green'};">{total_missing_boms}</b> منتجات بالخطة بدون BOM: {missing_boms_html}</li>
+      <li>{"⚠️" if zero_base_count>0 else "✅"} <b style="color:{'red' if zero_base_count>0 else 'green'};">{zero_base_count}</b> قيم صفرية في Base Quantity (استُبدلت بـ 1)</li>
     </ul>
     </div>
     """, unsafe_allow_html=True)
@@ -732,6 +677,20 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     st.subheader("📊 توزيع المكونات على المستويات الهرمية")
     st.dataframe(levels_summary, use_container_width=True,hide_index=True)
 
+    # ── فحص سلامة هيكل الـ BOM (مرة واحدة لكل ملف — cached) ─────────────────
+    bom_issues = validate_bom_graph(component_df, bom_key)
+    st.subheader("🧪 فحص سلامة هيكل الـ BOM")
+    if bom_issues.empty:
+        st.success("✅ لا توجد حلقات أو آباء غير موجودين أو فروع منفصلة في الـ BOM.")
+    else:
+        issue_counts = bom_issues["نوع المشكلة"].value_counts()
+        st.warning(
+            "⚠️ هذه السطور لا تدخل في حساب الاحتياج أو تُقطع أثناء التفجير: "
+            + " | ".join(f"{k}: {v:,}" for k, v in issue_counts.items())
+        )
+        with st.expander("📋 تفاصيل مشاكل الـ BOM"):
+            show_paginated(bom_issues, key="bom_issues")
+
     # ==============================================================================
     # D. Need_By_Date — الاحتياج حسب التاريخ
     # ==============================================================================
@@ -739,36 +698,8 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     st.subheader("📅 Need by Date — الاحتياج الكلي لكل مكون حسب التاريخ")
 
     if not result_df.empty:
-        # تجميع كل المستويات: لكل مكون × تاريخ → جمع الاحتياجات
-        result_date = (
-            merged_df
-            .groupby([
-                col("component"), col("component_desc"), col("component_uom"),
-                col("mrp_controller"), col("current_stock"), col("component_order_type"),
-                "Date"
-            ], as_index=False)
-            ["Required Component Quantity"]
-            .sum()
-        )
-
-        pivot_by_date = result_date.pivot_table(
-            index=[
-                col("component"), col("component_desc"), col("component_uom"),
-                col("mrp_controller"), col("current_stock"), col("component_order_type"),
-            ],
-            columns="Date",
-            values="Required Component Quantity",
-            aggfunc="sum",
-            fill_value=0
-        ).reset_index()
-
-        # تنسيق أسماء أعمدة التواريخ
-        pivot_by_date.columns = [
-            c.strftime("%d %b") if isinstance(c, (pd.Timestamp, datetime.datetime)) else c
-            for c in pivot_by_date.columns
-        ]
-
-        st.dataframe(pivot_by_date, use_container_width=True,hide_index=True)
+        pivot_by_date = pivot_need_by_date(merged_df, agg_engine)
+        show_paginated(pivot_by_date, key="pivot_by_date")
 
     # ==============================================================================
     # E. Need_By_Order_Type — الاحتياج حسب التاريخ ونوع الطلب (E / L)
@@ -777,42 +708,9 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     st.subheader("📦 Need by Order Type — الاحتياج مقسّم حسب نوع الطلب والتاريخ")
 
     if not result_df.empty:
-        result_order = (
-            merged_df
-            .groupby([
-                col("component"), col("component_desc"), col("component_uom"),
-                col("mrp_controller"), col("current_stock"), col("component_order_type"),
-                "Order Type", "Date"
-            ], as_index=False)
-            ["Required Component Quantity"]
-            .sum()
-        )
+        pivot_by_order = pivot_need_by_order(merged_df, agg_engine)
 
-        pivot_by_order = result_order.pivot_table(
-            index=[
-                col("component"), col("component_desc"), col("component_uom"),
-                col("mrp_controller"), col("current_stock"), col("component_order_type"),
-            ],
-            columns=["Date", "Order Type"],
-            values="Required Component Quantity",
-            aggfunc="sum",
-            fill_value=0
-        ).reset_index()
-
-        # تسطيح أسماء الأعمدة المركبة
-        flat_cols = []
-        for c in pivot_by_order.columns:
-            if isinstance(c, tuple):
-                date_part, ot_part = c
-                if isinstance(date_part, (pd.Timestamp, datetime.datetime)):
-                    flat_cols.append(f"{ot_part} - {date_part.strftime('%d %b')}")
-                else:
-                    flat_cols.append(str(date_part) if date_part else str(ot_part))
-            else:
-                flat_cols.append(c)
-        pivot_by_order.columns = flat_cols
-
-        st.dataframe(pivot_by_order, use_container_width=True,hide_index=True)
+        show_paginated(pivot_by_order, key="pivot_by_order")
 
     # ==============================================================================
     # F. تحليل الرصيد والتغطية
@@ -821,22 +719,7 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     st.subheader("📊 تحليل حرجية الرصيد ونسبة التغطية")
 
     if not result_df.empty:
-        component_analysis = (
-            merged_df
-            .groupby([
-                col("component"), col("component_desc"), col("component_uom"),
-                col("current_stock"), col("component_order_type"),
-                "BOM Level", col("mrp_controller"),
-            ], as_index=False)
-            .agg(
-                Required_Qty=("Required Component Quantity", "sum"),
-                Order_Types=("Order Type", lambda x: ", ".join(sorted(set(str(v) for v in x if pd.notna(v)))))
-            )
-            .rename(columns={
-                "Required_Qty": "Required Component Quantity",
-                "Order_Types": "Order Type",
-            })
-        )
+        component_analysis = component_requirements(merged_df, agg_engine)
 
 
         # 🔹 تنظيف وتحويل الأعمدة الرقمية
@@ -856,13 +739,13 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
 
 
 
-        component_analysis["Coverage Status"] = component_analysis["Coverage Percentage"].apply(
-            lambda x: "🟢 كافية" if x >= 100 else ("🟡 جزئية" if x >= 50 else "🔴 غير كافية")
+        coverage = component_analysis["Coverage Percentage"]
+        component_analysis["Coverage Status"] = np.select(
+            [coverage >= 100, coverage >= 50], ["🟢 كافية", "🟡 جزئية"], default="🔴 غير كافية"
         )
-        component_analysis["Priority"] = component_analysis.apply(
-            lambda row: "🔥 عاجل" if row["Coverage Percentage"] < 30 and row["Required Component Quantity"] > 1000
-            else ("⚠️ متوسط" if row["Coverage Percentage"] < 50 else "✅ منخفض"),
-            axis=1
+        component_analysis["Priority"] = np.select(
+            [(coverage < 30) & (component_analysis["Required Component Quantity"] > 1000), coverage < 50],
+            ["🔥 عاجل", "⚠️ متوسط"], default="✅ منخفض"
         )
 
         # --- فلاتر ---
@@ -883,7 +766,7 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
             component_analysis["BOM Level"].isin(selected_lv)
         ]
 
-        st.dataframe(filtered_analysis.sort_values("Coverage Percentage"), use_container_width=True,hide_index=True)
+        show_paginated(filtered_analysis.sort_values("Coverage Percentage"), key="filtered_analysis")
 
         # إحصائيات التغطية
         tc  = max(len(filtered_analysis), 1)
@@ -904,56 +787,90 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
         </div>
         """, unsafe_allow_html=True)
 
-        # رسوم بيانية
-        fig_pie = px.pie(
-            filtered_analysis,
-            names="Coverage Status",
-            title="توزيع المكونات حسب حالة التغطية",
-            color="Coverage Status",
-            color_discrete_map={"🟢 كافية": "green", "🟡 جزئية": "orange", "🔴 غير كافية": "red"}
-        )
-        st.plotly_chart(fig_pie, use_container_width=True)
-
-        top_critical = filtered_analysis.nsmallest(10, "Coverage Percentage").copy()
-        if not top_critical.empty:
-            top_critical[col("component")]      = top_critical[col("component")].astype(str)
-            top_critical[col("component_desc")] = top_critical[col("component_desc")].astype(str)
-            top_critical["Short_Label"] = (
-                top_critical[col("component")] + " - " +
-                top_critical[col("component_desc")].str[:25]
+        # رسوم بيانية — تُبنى وتُرسل للمتصفح فقط عند طلبها
+        if st.toggle("📈 عرض الرسوم البيانية للتغطية", key="show_coverage_charts"):
+            import plotly.express as px
+
+            chart_data = coverage_chart_data(filtered_analysis)
+            fig_pie = px.pie(
+                chart_data["status"],
+                names="Coverage Status",
+                values="Components",
+                title="توزيع المكونات حسب حالة التغطية",
+                color="Coverage Status",
+                color_discrete_map={"🟢 كافية": "green", "🟡 جزئية": "orange", "🔴 غير كافية": "red"}
+            )
+            st.plotly_chart(fig_pie, use_container_width=True)
+
+            top_critical = chart_data["critical"]
+            if not top_critical.empty:
+                fig_crit = px.bar(
+                    top_critical,
+                    y="Short_Label",
+                    x="Required Component Quantity",
+                    color="Coverage Percentage",
+                    orientation='h',
+                    title="أقل 10 مكونات في نسبة التغطية",
+                    labels={"Required Component Quantity": "كمية الطلب", "Short_Label": "المكون", "Coverage Percentage": "نسبة التغطية %"},
+                    color_continuous_scale="RdYlGn_r"
+                )
+                fig_crit.update_layout(height=450)
+                st.plotly_chart(fig_crit, use_container_width=True)
+
+            # تحليل حسب MRP Controller والمستوى
+            if len(selected_mrp) > 1:
+                fig_sunburst = px.sunburst(
+                    chart_data["sunburst"],
+                    path=[col("mrp_controller"), "BOM Level", "Coverage Status"],
+                    values="Required Component Quantity",
+                    title="توزيع الاحتياج حسب MRP Controller والمستوى وحالة التغطية"
+                )
+                st.plotly_chart(fig_sunburst, use_container_width=True)
+
+            # تحليل حسب نوع الطلب
+            fig_ot = px.pie(
+                chart_data["order_types"],
+                names=col("component_order_type"),
+                values="Components",
+                title="توزيع المكونات حسب نوع الطلب"
             )
-            top_critical = top_critical.sort_values("Required Component Quantity", ascending=True)
-
-            fig_crit = px.bar(
-                top_critical,
-                y="Short_Label",
-                x="Required Component Quantity",
-                color="Coverage Percentage",
-                orientation='h',
-                title="أقل 10 مكونات في نسبة التغطية",
-                labels={"Required Component Quantity": "كمية الطلب", "Short_Label": "المكون", "Coverage Percentage": "نسبة التغطية %"},
-                color_continuous_scale="RdYlGn_r"
+            st.plotly_chart(fig_ot, use_container_width=True)
+
+        # 🎯 توزيع الرصيد على الاحتياجات بالترتيب: أي طلبات (E / L) وأي تواريخ تُغطّى فعلاً
+        st.markdown("#### 🎯 توزيع الرصيد حسب الأولوية")
+        a1, a2 = st.columns(2)
+        with a1:
+            allocation_priority = st.selectbox(
+                "ترتيب التخصيص:",
+                options=list(ALLOCATION_PRIORITIES),
+                format_func=ALLOCATION_PRIORITY_LABELS.get,
+                key="allocation_priority",
             )
-            fig_crit.update_layout(height=450)
-            st.plotly_chart(fig_crit, use_container_width=True)
-
-        # تحليل حسب MRP Controller والمستوى
-        if len(selected_mrp) > 1:
-            fig_sunburst = px.sunburst(
-                filtered_analysis,
-                path=[col("mrp_controller"), "BOM Level", "Coverage Status"],
-                values="Required Component Quantity",
-                title="توزيع الاحتياج حسب MRP Controller والمستوى وحالة التغطية"
+        with a2:
+            plan_order_types = sorted(merged_df["Order Type"].dropna().astype(str).unique())
+            order_type_rank = st.multiselect(
+                "أولوية أنواع الطلب (بترتيب الاختيار):",
+                options=plan_order_types,
+                default=plan_order_types,
+                key="allocation_order_types",
             )
-            st.plotly_chart(fig_sunburst, use_container_width=True)
+        stock_allocation = allocate_stock(merged_df, allocation_priority, order_type_rank)
 
-        # تحليل حسب نوع الطلب
-        fig_ot = px.pie(
-            filtered_analysis,
-            names=col("component_order_type"),
-            title="توزيع المكونات حسب نوع الطلب"
+        allocation_by_type = (
+            stock_allocation
+            .groupby("Order Type", as_index=False)[
+                ["Required Component Quantity", "Allocated Quantity", "Shortage Quantity"]
+            ]
+            .sum()
         )
-        st.plotly_chart(fig_ot, use_container_width=True)
+        allocation_by_type["Coverage Percentage"] = (
+            allocation_by_type["Allocated Quantity"]
+            / allocation_by_type["Required Component Quantity"].replace(0, np.nan) * 100
+        ).round(1).fillna(0)
+        st.dataframe(allocation_by_type, use_container_width=True, hide_index=True)
+
+        with st.expander("📋 تفاصيل التخصيص (مكون × نوع الطلب × تاريخ)"):
+            show_paginated(stock_allocation, key="stock_allocation", search_cols=[col("component")])
 
     # ==============================================================================
     # G. Component in BOMs — النمطي التراكمي لكل مكون داخل منتج تام = 1 وحدة
@@ -961,89 +878,73 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     st.markdown("---")
     st.subheader("📋 قائمة الموديلات التي تستخدم كل مكون (نمطي لكل منتج تام = 1)")
  
-    if not result_df.empty:
-        # نُنشئ plan_unit: صف واحد لكل (Material, material_desc, Order Type) بكمية = 1
-        unit_plan = (
-            plan_melted[[col("material"), col("material_desc"), col("order_type")]]
-            .drop_duplicates()
-            .copy()
-        )
-        unit_plan["Planned Quantity"] = 1
-        unit_plan["Date"] = pd.Timestamp("2000-01-01")   # تاريخ وهمي ثابت
- 
-        # نُشغّل explosion بكمية = 1 → يعطي النمطي التراكمي لكل منتج
-        unit_result = bom_explosion(unit_plan, component_df)
- 
-        if not unit_result.empty:
-            # 🔹 المفتاح: Material + Order Type فقط (بدون material_desc)
-            # السبب: material_desc في unit_result يأتي من bom_explosion وقد يكون فارغاً
-            # مما يُفشل الدمج ويُعيد plan_qty = NaN → 0
-            plan_qty_map = (
-                plan_melted.groupby([col("material"), col("order_type")])["Planned Quantity"]
-                .sum()
-                .reset_index()
-                .rename(columns={"Planned Quantity": "plan_qty"})
-            )
-            # نُحضّر material_desc الصحيح من plan_melted بشكل منفصل
-            mat_desc_map = (
-                plan_melted[[col("material"), col("material_desc")]]
-                .drop_duplicates(subset=[col("material")])
-                .copy()
-            )
+    # النمطي محفوظ كمصفوفة متفرقة (مكون × موديل) — الجدول العريض يُبنى للصفحة الظاهرة فقط
+    # (بنفس نموذج الـ BOM المبني في القسم B — بدون إعادة بنائه)
+    component_usage = (
+        component_usage_matrix(plan_melted, job.bom_model, scope_controllers or None)
+        if not result_df.empty else None
+    )
 
-            # 🔹 توحيد الأنواع
-            unit_result[col("material")] = unit_result[col("material")].astype(str)
-            unit_result["Order Type"]    = unit_result["Order Type"].astype(str)
-            plan_qty_map[col("material")]   = plan_qty_map[col("material")].astype(str)
-            plan_qty_map[col("order_type")] = plan_qty_map[col("order_type")].astype(str)
-            mat_desc_map[col("material")]   = mat_desc_map[col("material")].astype(str)
-
-            # 🔹 دمج plan_qty بـ Material + Order Type ← يضمن إيجاد الكمية دائماً
-            unit_result = unit_result.merge(
-                plan_qty_map,
-                left_on=[col("material"), "Order Type"],
-                right_on=[col("material"), col("order_type")],
-                how="left",
-                suffixes=("", "_plan")
+    if component_usage is not None:
+        c_ctrl, c_models = st.columns(2)
+        with c_ctrl:
+            usage_controllers = st.multiselect(
+                "MRP Controller",
+                sorted(component_usage["rows"][col("mrp_controller")].dropna().astype(str).unique())
+                if col("mrp_controller") in component_usage["rows"].columns else [],
+                key="usage_controllers",
+                placeholder="الكل",
             )
-            # 🔹 دمج material_desc الصحيح (يُستخدم في رأس العمود فقط)
-            if col("material_desc") in unit_result.columns:
-                unit_result.drop(columns=[col("material_desc")], inplace=True)
-            unit_result = unit_result.merge(
-                mat_desc_map,
-                on=col("material"),
-                how="left"
+        with c_models:
+            usage_models = st.multiselect(
+                "الموديلات",
+                sorted(component_usage["models"][col("material")].unique()),
+                key="usage_models",
+                placeholder="الكل",
             )
- 
-            # رأس العمود: كود المنتج , الكمية الفعلية , وصفه (نوع الطلب)
-            unit_result["model_info"] = (
-                unit_result[col("material")].astype(str) + " , " +
-                unit_result["plan_qty"].fillna(0).round(0).astype(int).astype(str) + " , " +
-                unit_result[col("material_desc")].astype(str).fillna("") + " (" +
-                unit_result["Order Type"].astype(str).fillna("") + ")"
-            )
- 
-            # ✅ نُلغي BOM Level من الـ pivot — نجمع كل المستويات في صف واحد
-            pivot_index = [col("component"), col("component_desc"),
-                           col("mrp_controller"), col("component_uom")]
-            pivot_index = [c for c in pivot_index if c in unit_result.columns]
- 
-            component_bom_pivot = unit_result.pivot_table(
-                index=pivot_index,
-                columns="model_info",
-                values="Required Component Quantity",
-                aggfunc="sum"
-            ).reset_index()
-            component_bom_pivot.columns.name = None
- 
-            st.dataframe(component_bom_pivot.round(3).fillna(""), use_container_width=True)
-        else:
-            component_bom_pivot = pd.DataFrame()
-            st.info("لا توجد بيانات لعرضها في جدول النمطي.")
+        usage_slice = usage_matrix_slice(
+            component_usage,
+            controllers=usage_controllers or None,
+            materials=usage_models or None,
+        )
+        usage_rows = usage_matrix_labels(usage_slice)
+
+        n_cells = len(component_usage["rows"]) * len(component_usage["models"])
+        st.caption(
+            f"🧮 {len(component_usage['rows']):,} مكون × {len(component_usage['models']):,} موديل"
+            f" — قيم فعلية {len(component_usage['coo']):,}"
+            f" ({len(component_usage['coo']) / n_cells:.1%} من الخلايا)"
+            + (f" | الشريحة المختارة: {len(usage_slice['coo']):,}" if usage_controllers or usage_models else "")
+        )
+        show_paginated(
+            usage_rows, key="component_bom_pivot",
+            search_cols=[c for c in usage_rows.columns if c != "_row"],
+            format_page=lambda page: usage_matrix_dense(usage_slice, rows=page["_row"]).round(3).fillna(""),
+        )
+    elif not result_df.empty:
+        st.info("لا توجد بيانات لعرضها في جدول النمطي.")
     else:
-        component_bom_pivot = pd.DataFrame()
         st.info("لا توجد نتائج BOM لعرض النمطي.")
  
+    # ==============================================================================
+    # G1. مستكشف شجرة الـ BOM — منتج واحد، فتح العقد عند الطلب
+    # ==============================================================================
+    st.markdown("---")
+    st.subheader("🌳 مستكشف شجرة الـ BOM")
+    tree_models = (
+        plan_melted[[col("material"), col("material_desc")]]
+        .astype({col("material"): str})
+        .drop_duplicates(subset=[col("material")])
+    )
+    tree_models = tree_models[tree_models[col("material")].isin(job.bom_model["bom_dict"])]
+    if tree_models.empty:
+        st.info("لا توجد موديلات في الخطة لها BOM.")
+    else:
+        bom_tree_explorer(
+            job.bom_model,
+            dict(zip(tree_models[col("material")], tree_models[col("material_desc")].fillna("").astype(str))),
+        )
+
     # ==============================================================================
     # G2. المسارات الأفقية الكاملة للـ BOM (BOM Horizontal Paths)
     # ==============================================================================
@@ -1054,35 +955,83 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
         "يتم تمثيل كل مستوى بعمودين: الكود (Level_N) واسمه (Name_N) بجانبه مباشرة."
     )
 
-    df_bom_paths = generate_bom_paths(component_df, plan_df)
+    # ── اختيار الـ Roots: العمل يتناسب مع الخطة وليس مع الـ BOM الكامل ─────
+    root_modes = {
+        "plan":  "📋 موديلات الخطة الحالية",
+        "pick":  "✋ اختيار موديلات محددة",
+        "mrp":   "👤 موديلات تحتوي مكونات MRP Controller محدد",
+        "range": "🔢 نطاق أكواد (كل الـ BOM)",
+    }
+    root_mode = st.radio(
+        "🌱 نطاق توليد المسارات:",
+        options=list(root_modes),
+        format_func=root_modes.get,
+        horizontal=True,
+        key="bom_paths_root_mode",
+    )
+
+    path_roots = None
+    path_range = ROOT_CODE_RANGE
+    bom_materials = component_df[col("material")].astype(str).str.strip()
+    if root_mode == "plan":
+        path_roots = plan_melted[col("material")].astype(str).str.strip().unique().tolist()
+    elif root_mode == "pick":
+        pick_opts = sorted(set(plan_df[col("material")].astype(str).str.strip()) | set(bom_materials.unique()))
+        path_roots = st.multiselect("اختر الموديلات:", options=pick_opts, key="bom_paths_pick")
+    elif root_mode == "mrp":
+        mrp_root_opts = sorted(component_df[col("mrp_controller")].dropna().astype(str).unique())
+        chosen_mrp = st.multiselect("اختر MRP Controller:", options=mrp_root_opts, key="bom_paths_mrp")
+        path_roots = bom_materials[
+            component_df[col("mrp_controller")].astype(str).isin(chosen_mrp)
+        ].unique().tolist()
+    else:
+        r1, r2 = st.columns(2)
+        with r1:
+            range_lo = st.number_input("من كود", value=ROOT_CODE_RANGE[0], step=1, key="bom_paths_lo")
+        with r2:
+            range_hi = st.number_input("إلى كود", value=ROOT_CODE_RANGE[1], step=1, key="bom_paths_hi")
+        path_range = (int(range_lo), int(range_hi))
+
+    paths_long, path_labels = generate_bom_paths_long(
+        component_df, plan_df, roots=path_roots, code_range=path_range
+    )
 
-    if df_bom_paths.empty:
-        st.warning("⚠️ لا توجد مسارات — تحقق من نطاق الكودات (40000000–499999999) أو بيانات الـ BOM.")
+    if paths_long.empty:
+        if root_mode == "range":
+            st.warning(f"⚠️ لا توجد مسارات — تحقق من نطاق الكودات ({path_range[0]}–{path_range[1]}) أو بيانات الـ BOM.")
+        else:
+            st.warning("⚠️ لا توجد مسارات — لم يتم اختيار موديلات لها BOM.")
     else:
-        max_level_found = len([c for c in df_bom_paths.columns if c.startswith("Level_")])
         st.success(
-            f"✅ تم إنشاء **{len(df_bom_paths):,}** مسار كامل | "
-            f"أقصى عمق هرمي: **{max_level_found}** مستويات"
+            f"✅ تم إنشاء **{paths_long['Path_ID'].nunique():,}** مسار كامل | "
+            f"أقصى عمق هرمي: **{int(paths_long['Level'].max())}** مستويات"
+        )
+        paths_view = st.radio(
+            "شكل العرض:",
+            options=["wide", "long"],
+            format_func={"wide": "↔️ أفقي (Level_N | Name_N)", "long": "↕️ طولي (Path_ID | Level | Code)"}.get,
+            horizontal=True,
+            key="bom_paths_view",
         )
-        st.dataframe(df_bom_paths, use_container_width=True, hide_index=True)
+        if paths_view == "wide":
+            # البحث والتقسيم على فهرس المسارات، والأسماء تُبنى للصفحة الظاهرة فقط
+            show_paginated(
+                bom_paths_index(paths_long), key="df_bom_paths",
+                search_cols=["Root", "Leaf"],
+                format_page=lambda page: bom_paths_to_wide(paths_long, path_labels, page["Path_ID"]),
+            )
+        else:
+            show_paginated(paths_long.drop(columns=["Edge_ID"]), key="bom_paths_long", search_cols=["Code"])
 
     # ==============================================================================
     # H. جدول الكميات الشهرية + الرسم البياني
-    # نستخدم plan_df_orig لأن plan_df تم تحويل أعمدة التواريخ فيه إلى نصوص
+    # نستخدم plan_daily (ناتج melt_plan في القسم A) بدلاً من melt ثانٍ للخطة
     # ==============================================================================
     st.markdown("---")
     if date_cols:
-        orders_summary = plan_df_orig.melt(
-            id_vars=[col("material"), col("material_desc"), col("order_type")],
-            value_vars=date_cols,
-            var_name="Month",
-            value_name="Quantity"
+        orders_summary = plan_daily.assign(Month=plan_daily["Date"].dt.month_name()).rename(
+            columns={"Planned Quantity": "Quantity"}
         )
-        orders_summary["Quantity"] = pd.to_numeric(orders_summary["Quantity"], errors="coerce").fillna(0)
-        try:
-            orders_summary["Month"] = pd.to_datetime(orders_summary["Month"]).dt.month_name()
-        except Exception:
-            pass
 
         orders_grouped = (
             orders_summary
@@ -1126,14 +1075,17 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
         html_table += "</table>"
         st.markdown(f"<div style='direction:rtl;'>{html_table}</div>", unsafe_allow_html=True)
 
-        fig_bar = px.bar(
-            pivot_monthly, x="Month", y=["E", "L"],
-            barmode="group", text_auto=True,
-            title="رسم بياني لتوزيع الكميات الشهرية",
-            labels={"value": "الكمية", "variable": "نوع الأمر", "Month": "الشهر"},
-            template="streamlit"
-        )
-        st.plotly_chart(fig_bar, use_container_width=True)
+        if st.toggle("📈 عرض الرسم البياني الشهري", key="show_monthly_chart"):
+            import plotly.express as px
+
+            fig_bar = px.bar(
+                pivot_monthly, x="Month", y=["E", "L"],
+                barmode="group", text_auto=True,
+                title="رسم بياني لتوزيع الكميات الشهرية",
+                labels={"value": "الكمية", "variable": "نوع الأمر", "Month": "الشهر"},
+                template="streamlit"
+            )
+            st.plotly_chart(fig_bar, use_container_width=True)
 
     # ==============================================================================
     # I. إعداد ملف الـ Summary للتصدير
@@ -1174,7 +1126,8 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
         ["سطور BOM", total_boms, ""],
         ["مكونات بدون MRP Controller", empty_mrp_count, ""],
         ["مكونات بأكثر من وحدة", total_diff_uom, diff_uom_str],
-        ["منتجات بالخطة بدون BOM", total_missing_boms, ""],
+        ["منتجات بالخطة بدون BOM", total_missing_boms, ", ".join(map(str, missing_boms))],
+        ["قيم صفرية في Base Quantity", zero_base_count, "استُبدلت بـ 1"],
         ["", "", ""],
         ["مكونات شراء (F)", purchase_count, ""],
         ["مكونات تصنيع (E)", manufacturing_count, ""],
@@ -1189,11 +1142,9 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     summary_df = pd.DataFrame(summary_data, columns=["البند", "القيمة", "ملاحظات"])
 
     # تنسيق plan_df للتصدير
-    plan_df_export = plan_df.copy()
-    plan_df_export.columns = [
+    plan_df_export = plan_df.rename(columns=lambda c: (
         c.strftime("%d %b") if isinstance(c, (datetime.datetime, pd.Timestamp)) else c
-        for c in plan_df_export.columns
-    ]
+    ))
     # ==============================================================================
     # J. تصدير Excel — مع اختيار المستخدم للأوراق ولـ MRP Controller
     # ==============================================================================
@@ -1205,7 +1156,11 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
     if not mrp_df.empty and mrp_controller_col in mrp_df.columns:
         mrp_options = sorted(mrp_df[mrp_controller_col].dropna().unique().tolist())
     elif not result_df.empty and mrp_controller_col in result_df.columns:
-        mrp_options = sorted(result_df[mrp_controller_col].dropna().unique().tolist())
+        raw_controllers = (
+            result_df.unique(mrp_controller_col) if isinstance(result_df, SpilledResult)
+            else result_df[mrp_controller_col].unique()
+        )
+        mrp_options = sorted(pd.Series(raw_controllers).dropna().tolist())
     else:
         mrp_options = []
 
@@ -1232,11 +1187,13 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
         "📅 الاحتياج بالتاريخ (Need_By_Date)":      ("Need_By_Date",            not result_df.empty),
         "📦 الاحتياج بنوع الأمر (Need_By_Order)":   ("Need_By_Order_Type",      not result_df.empty),
         "🔍 تحليل التغطية (Stock_Coverage)":        ("Stock_Coverage_Analysis", not result_df.empty),
+        "🎯 توزيع الرصيد (Stock_Allocation)":       ("Stock_Allocation",        not result_df.empty),
         "🌳 BOM الكامل (BOM_All_Levels)":           ("BOM_All_Levels",          not result_df.empty),
-        "📊 النمطي لكل منتج (Component_in_BOMs)":   ("Component_in_BOMs",       not component_bom_pivot.empty),
-        "🌿 المسارات الأفقية للمكونات (BOM_Paths)":          ("BOM_Paths",               not df_bom_paths.empty),
+        "📊 النمطي لكل منتج (Component_in_BOMs)":   ("Component_in_BOMs",       component_usage is not None),
+        "🌿 المسارات الأفقية للمكونات (BOM_Paths)":          ("BOM_Paths",               not paths_long.empty),
         "🗂️ المكونات الأصلية (Original_Component)": ("Original_Component",      True),
         "👤 MRP Controller":                        ("MRP_Controller",       not mrp_df.empty),
+        "🧪 فحص هيكل الـ BOM (BOM_Validation)":     ("BOM_Validation",       not bom_issues.empty),
 
     }
 
@@ -1273,7 +1230,15 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
 
 
 
-    # ── 4. زر التصدير ────────────────────────────────────────────────────
+    # ── 4. طريقة التصدير: ملف واحد أو ملف لكل MRP Controller ─────────────
+    export_mode = "single"
+    if mrp_options:
+        export_mode = st.radio(
+            "📦 طريقة التصدير:", options=list(EXPORT_MODE_OPTIONS),
+            format_func=EXPORT_MODE_OPTIONS.get, horizontal=True, key="export_mode",
+        )
+
+    # ── 5. زر التصدير ────────────────────────────────────────────────────
     if st.button("🗜️ اضغط هنا لإنشاء النسخة الكاملة"):
         chosen = [k for k, v in selected_sheets.items() if v]
         if not chosen:
@@ -1290,35 +1255,58 @@ with st.spinner("⏳ جاري معالجة البيانات..."):
                     "Need_By_Date":            pivot_by_date          if not result_df.empty        else pd.DataFrame(),
                     "Need_By_Order_Type":      pivot_by_order         if not result_df.empty        else pd.DataFrame(),
                     "Stock_Coverage_Analysis": component_analysis     if not result_df.empty        else pd.DataFrame(),
+                    "Stock_Allocation":        stock_allocation       if not result_df.empty        else pd.DataFrame(),
                     "BOM_All_Levels":          merged_df              if not result_df.empty        else pd.DataFrame(),
-                    "Component_in_BOMs":       component_bom_pivot    if not component_bom_pivot.empty else pd.DataFrame(),
-                    "BOM_Paths":               df_bom_paths           if not df_bom_paths.empty     else pd.DataFrame(),
-                    "Original_Component":      component_df_orig,
+                    "Component_in_BOMs":       component_usage        if component_usage is not None else pd.DataFrame(),
+                    "BOM_Paths":               bom_paths_to_wide(paths_long, path_labels) if "BOM_Paths" in chosen else pd.DataFrame(),
+                    "Original_Component":      component_df,
                     "MRP_Controller":          mrp_df                 if not mrp_df.empty           else pd.DataFrame(),
+                    "BOM_Validation":          bom_issues,
                 }
 
-                # ── تطبيق فلتر MRP Controller على كل ورقة تحتوي العمود ─
-                if selected_mrp:
-                    for sname, sdf in sheet_data_map.items():
-                        if not sdf.empty and mrp_controller_col in sdf.columns:
-                            sheet_data_map[sname] = sdf[sdf[mrp_controller_col].isin(selected_mrp)]
-
-                # ── الكتابة ──────────────────────────────────────────────
-                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                    for sheet_name in chosen:
-                        df_to_write = sheet_data_map.get(sheet_name, pd.DataFrame())
-                        if not df_to_write.empty:
-                            df_to_write.to_excel(writer, sheet_name=sheet_name, index=False)
-
-                excel_buffer.seek(0)
-                st.download_button(
-                    label="📊 تحميل ملف Excel الكامل",
-                    data=excel_buffer,
-                    file_name=f"MRP_Results_{current_date}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
-                st.balloons()
-                st.success(f"✅ تم إنشاء الملف بنجاح — {len(chosen)} ورقة: {', '.join(chosen)}")
+                # ── ملف لكل MRP Controller: عمليات متوازية → ZIP واحد ─────
+                if export_mode == "per_controller":
+                    export_controllers = selected_mrp or mrp_options
+                    zip_bytes, skipped = controller_workbooks_zip(
+                        sheet_data_map, chosen, export_controllers,
+                        file_prefix=f"MRP_Results_{current_date}",
+                    )
+                    if len(skipped) == len(export_controllers):
+                        st.warning("⚠️ لا توجد صفوف لأي MRP Controller في الأوراق المختارة.")
+                    else:
+                        st.download_button(
+                            label="🗂️ تحميل ملفات الـ MRP Controllers (ZIP)",
+                            data=zip_bytes,
+                            file_name=f"MRP_Results_by_Controller_{current_date}.zip",
+                            mime="application/zip"
+                        )
+                        st.balloons()
+                        st.success(
+                            f"✅ تم إنشاء {len(export_controllers) - len(skipped)} ملف — "
+                            f"{len(chosen)} ورقة لكل ملف: {', '.join(chosen)}"
+                        )
+                        if skipped:
+                            st.info(f"ℹ️ لا توجد بيانات في الأوراق المختارة لـ: {', '.join(map(str, skipped))}")
+                else:
+                    # ── تطبيق فلتر MRP Controller على كل ورقة تحتوي العمود ─
+                    if selected_mrp:
+                        sheet_data_map = filter_sheets_by_controllers(sheet_data_map, selected_mrp)
+
+                    # ── الكتابة ──────────────────────────────────────────
+                    excel_bytes = sheets_to_xlsx(sheet_data_map, chosen)
+                    if excel_bytes is None:
+                        st.warning("⚠️ كل الأوراق المختارة فارغة بعد تطبيق الفلتر.")
+                    else:
+                        excel_buffer.write(excel_bytes)
+                        excel_buffer.seek(0)
+                        st.download_button(
+                            label="📊 تحميل ملف Excel الكامل",
+                            data=excel_buffer,
+                            file_name=f"MRP_Results_{current_date}.xlsx",
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                        )
+                        st.balloons()
+                        st.success(f"✅ تم إنشاء الملف بنجاح — {len(chosen)} ورقة: {', '.join(chosen)}")
 
 # --- التذييل ---
 st.markdown("""
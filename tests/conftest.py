@@ -0,0 +1,90 @@
+# ==============================================================================
+# بيانات الاختبارات — BOM عشوائي (مع حلقات ونصف مصنّع ونسخ مكررة) وخطة مفككة
+# ==============================================================================
+# الكميات من مضاعفات 0.5 فقط ⇐ حاصل الضرب على طول أي مسار دقيق في float
+# فتُقارن النتائج تماماً بدون سماحية تقريب
+# ==============================================================================
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mrp_engine import clean_component_chunk, col  # noqa: E402
+
+CONTROLLERS = ["M01", "M02", "M03"]
+UNIT_QTYS   = [0.5, 1.0, 2.0, 3.0, 4.0]
+
+
+def random_component_df(seed, n_models=6, n_codes=30, n_semis=5):
+    """
+    ورقة Component عشوائية بعد التنظيف (clean_component_chunk)
+    - أول n_semis كوداً نصف مصنّع له BOM مستقل (Material = Parent = الكود)
+    - بعض الأبناء يُختارون من عقد الشجرة نفسها ⇐ حلقات داخل المنتج وعبر أنصاف المصنّع
+    - سلاسل عميقة ⇐ بعض المسارات تُقطع عند EXPLODE_MAX_LEVEL
+    - صفوف مكررة حرفياً + نفس (Parent→Component) بكمية مختلفة
+    """
+    rng    = np.random.default_rng(seed)
+    models = [str(40_000_000 + i) for i in range(n_models)]
+    codes  = [str(10_000 + i) for i in range(n_codes)]
+
+    rows = []
+    for mat in models + codes[:n_semis]:
+        nodes = [mat]
+        for _ in range(int(rng.integers(2, 13))):
+            # نصف الأبناء تحت آخر عقدة ⇐ سلاسل تتجاوز EXPLODE_MAX_LEVEL أحياناً
+            parent = nodes[-1] if rng.random() < 0.5 else nodes[int(rng.integers(len(nodes)))]
+            if rng.random() < 0.15:
+                comp = nodes[int(rng.integers(len(nodes)))]
+            else:
+                comp = codes[int(rng.integers(n_codes))]
+            rows.append({
+                col("material"):        mat,
+                col("parent_material"): parent,
+                col("component"):       comp,
+                col("component_qty"):   float(rng.choice(UNIT_QTYS)),
+            })
+            nodes.append(comp)
+            if rng.random() < 0.1:
+                rows.append(dict(rows[-1]))
+            if rng.random() < 0.1:
+                rows.append({**rows[-1], col("component_qty"): float(rng.choice(UNIT_QTYS))})
+
+    component_df = pd.DataFrame(rows)
+    comps = component_df[col("component")]
+    component_df[col("component_desc")] = "وصف " + comps
+    component_df[col("component_uom")]  = "PC"
+    component_df[col("mrp_controller")] = comps.map(lambda c: CONTROLLERS[int(c) % len(CONTROLLERS)])
+    component_df[col("current_stock")]  = comps.map(lambda c: float(int(c) % 7) * 10)
+    return clean_component_chunk(component_df)[0]
+
+
+def random_plan(component_df, seed, n_dates=3):
+    """خطة مفككة (شكل melt_plan) لكل المنتجات الجذرية + كود غير موجود في الـ BOM"""
+    rng   = np.random.default_rng(seed)
+    roots = sorted(component_df[col("material")].unique()) + ["49999999"]
+    dates = pd.date_range("2026-03-01", periods=n_dates, freq="7D")
+    rows = [
+        {
+            col("material"):      mat,
+            col("material_desc"): f"موديل {mat}",
+            col("order_type"):    str(rng.choice(["E", "L"])),
+            "Date":               date,
+            "Planned Quantity":   float(rng.integers(1, 20)),
+        }
+        for mat in roots for date in dates if rng.random() < 0.7
+    ]
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def component_df():
+    return random_component_df(seed=7)
+
+
+@pytest.fixture
+def plan_melted(component_df):
+    return random_plan(component_df, seed=7)
@@ -0,0 +1,240 @@
+# ==============================================================================
+# اختبارات المحرك — التفجير مقابل الخوارزمية الأصلية، نطاق Controllers، المخزن،
+# مصفوفة الاستخدام، فحص الحلقات، توزيع الرصيد
+# ==============================================================================
+from collections import defaultdict
+
+import pandas as pd
+import pytest
+
+from conftest import random_component_df, random_plan
+from mrp_engine import (
+    allocate_stock,
+    bom_fingerprint,
+    bom_store_info,
+    build_bom_model,
+    component_usage_matrix,
+    explode_plan,
+    load_bom_store,
+    load_bom_subset,
+    save_bom_store,
+    summarize_requirements,
+    usage_matrix_dense,
+    usage_matrix_slice,
+    validate_bom_graph,
+    col,
+)
+
+KERNELS = ["off", "auto"]
+
+
+def reference_explosion(plan_melted, component_df):
+    """
+    bom_explosion كما كانت قبل الفهرسة والـ memo والنواة المُجمّعة (تفجير تعاودي لكل صف خطة)
+    — المرجع الذي يجب أن يطابقه explode_plan في كل المسارات
+    """
+    parent_col = col("parent_material")
+    component_df = component_df.drop_duplicates(
+        subset=[col("material"), parent_col, col("component"), col("component_qty")], keep="first"
+    )
+    bom_core = component_df.groupby(
+        [col("material"), parent_col, col("component")], as_index=False
+    )[col("component_qty")].sum()
+
+    bom_dict = {}
+    for mat, group in bom_core.groupby(col("material")):
+        tree = defaultdict(list)
+        for _, row in group.iterrows():
+            tree[row[parent_col]].append((row[col("component")], row[col("component_qty")]))
+        bom_dict[mat] = tree
+
+    comp_info = (
+        component_df
+        .drop_duplicates(subset=[col("component")], keep="last")
+        .set_index(col("component"))[[
+            col("component_desc"), col("component_uom"), col("mrp_controller"),
+            col("current_stock"), col("component_order_type"),
+        ]]
+        .reset_index()
+        .rename(columns={col("component"): "_comp_key"})
+    )
+
+    def explode(root_material, parent, qty, path, level, row_buf):
+        if parent in path or level > 10:
+            return
+        children = bom_dict.get(root_material, {}).get(parent, [])
+        if not children:
+            children = bom_dict.get(parent, {}).get(parent, [])
+        if not children:
+            return
+        new_path = path | {parent}
+        for comp, comp_qty in children:
+            needed = qty * comp_qty
+            row_buf.append({
+                "Parent":                      parent,
+                col("component"):              comp,
+                col("component_qty"):          comp_qty,
+                "Required Component Quantity": needed,
+                "BOM Level":                   level,
+            })
+            explode(root_material, comp, needed, new_path, level + 1, row_buf)
+
+    all_rows = []
+    for _, plan_row in plan_melted[plan_melted["Planned Quantity"] > 0].iterrows():
+        mat = str(plan_row[col("material")]).strip()
+        row_buf = []
+        explode(mat, mat, plan_row["Planned Quantity"], set(), 1, row_buf)
+        for r in row_buf:
+            r[col("material")]      = mat
+            r[col("material_desc")] = str(plan_row.get(col("material_desc"), "")).strip()
+            r["Order Type"]         = plan_row[col("order_type")]
+            r["Date"]               = plan_row["Date"]
+        all_rows.extend(row_buf)
+
+    if not all_rows:
+        return pd.DataFrame()
+    return pd.DataFrame(all_rows).merge(
+        comp_info, left_on=col("component"), right_on="_comp_key", how="left"
+    ).drop(columns=["_comp_key"])
+
+
+def assert_same_rows(expected, actual):
+    """نفس الصفوف بغض النظر عن ترتيبها (التفجير الحالي مجمّع حسب المنتج الجذر)"""
+    assert sorted(expected.columns) == sorted(actual.columns)
+    keys = sorted(expected.columns)
+
+    def canonical(df):
+        return df[keys].sort_values(keys, kind="mergesort").reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(canonical(expected), canonical(actual), check_dtype=False)
+
+
+# ==============================================================================
+# 1. التفجير مقابل المرجع — 300 BOM عشوائي فيها حلقات
+# ==============================================================================
+@pytest.mark.parametrize("kernel", KERNELS)
+@pytest.mark.parametrize("seed", range(300))
+def test_explosion_matches_reference(seed, kernel):
+    component_df = random_component_df(seed)
+    plan_melted  = random_plan(component_df, seed)
+    expected = reference_explosion(plan_melted, component_df)
+    actual   = explode_plan(plan_melted, build_bom_model(component_df), kernel=kernel)
+    assert len(expected) > 0
+    assert_same_rows(expected, actual)
+
+
+# ==============================================================================
+# 2. نطاق MRP Controllers قبل التفجير = التفجير الكامل ثم الفلترة
+# ==============================================================================
+@pytest.mark.parametrize("kernel", KERNELS)
+@pytest.mark.parametrize("seed", range(0, 300, 15))
+@pytest.mark.parametrize("controllers", [["M01"], ["M02", "M03"], ["XX"]])
+def test_scoped_explosion_matches_post_filter(seed, kernel, controllers):
+    component_df = random_component_df(seed)
+    plan_melted  = random_plan(component_df, seed)
+    bom_model    = build_bom_model(component_df)
+
+    full   = explode_plan(plan_melted, bom_model, kernel=kernel)
+    scoped = explode_plan(plan_melted, bom_model, kernel=kernel, controllers=controllers)
+    expected = full[full[col("mrp_controller")].isin(controllers)]
+    if expected.empty:
+        assert scoped.empty
+    else:
+        assert_same_rows(expected, scoped)
+
+
+# ==============================================================================
+# 3. مخزن الـ BOM (SQLite)
+# ==============================================================================
+def test_bom_store_round_trip(tmp_path, component_df, plan_melted):
+    path = str(tmp_path / "bom.sqlite")
+    info = save_bom_store(component_df, path, source="test.xlsx")
+
+    assert bom_store_info(path) == info
+    assert info["fingerprint"] == bom_fingerprint(component_df)
+    stored = load_bom_store(path)
+    pd.testing.assert_frame_equal(stored, component_df.reset_index(drop=True), check_dtype=False)
+    assert bom_fingerprint(stored) == bom_fingerprint(component_df)
+
+
+def test_bom_subset_explodes_like_full_bom(tmp_path, component_df, plan_melted):
+    path = str(tmp_path / "bom.sqlite")
+    save_bom_store(component_df, path)
+    roots = plan_melted[col("material")].unique()[:2]
+    plan  = plan_melted[plan_melted[col("material")].isin(roots)]
+
+    subset = load_bom_subset(roots, path)
+    assert len(subset) < len(component_df)
+    assert_same_rows(
+        explode_plan(plan, build_bom_model(component_df), kernel="off"),
+        explode_plan(plan, build_bom_model(subset), kernel="off"),
+    )
+
+
+# ==============================================================================
+# 4. مصفوفة استخدام المكونات — أكواد Controller رقمية
+# ==============================================================================
+@pytest.mark.parametrize("wanted", [["101"], [101]])
+def test_usage_matrix_slice_numeric_controllers(component_df, plan_melted, wanted):
+    codes = {"M01": 101, "M02": 102, "M03": 103}
+    numeric = component_df.assign(**{col("mrp_controller"): component_df[col("mrp_controller")].map(codes)})
+    matrix = component_usage_matrix(plan_melted, build_bom_model(numeric))
+
+    dense = usage_matrix_dense(usage_matrix_slice(matrix, controllers=wanted))
+    full  = usage_matrix_dense(matrix)
+    assert len(dense) > 0
+    assert set(dense[col("mrp_controller")].astype(str)) == {"101"}
+    assert len(dense) == (full[col("mrp_controller")].astype(str) == "101").sum()
+
+
+# ==============================================================================
+# 5. فحص الحلقات — فقط على الحواف التي يمشيها التفجير
+# ==============================================================================
+def _edges(rows):
+    return pd.DataFrame(rows, columns=[col("material"), col("parent_material"), col("component")])
+
+
+def test_validate_bom_graph_cycles():
+    # A يمشي X→Y و B يمشي Y→X — لا يوجد تفجير يمر بحلقة
+    assert validate_bom_graph(_edges([("A", "A", "X"), ("A", "X", "Y"),
+                                      ("B", "B", "Y"), ("B", "Y", "X")])).empty
+
+    # حلقة داخل نصف مصنّع S: S→T→S
+    issues = validate_bom_graph(_edges([("A", "A", "S"), ("S", "S", "T"), ("S", "T", "S")]))
+    assert issues["نوع المشكلة"].str.contains("Cycle").tolist() == [True]
+    assert issues[col("material")].tolist() == ["S"]
+
+    # حلقة داخل منتج واحد + مكون في نفسه
+    issues = validate_bom_graph(_edges([("A", "A", "X"), ("A", "X", "Y"), ("A", "Y", "X"),
+                                        ("C", "C", "C")]))
+    assert sorted(issues[col("material")]) == ["A", "C"]
+
+
+# ==============================================================================
+# 6. توزيع الرصيد حسب الأولوية
+# ==============================================================================
+def _demand(rows, stock):
+    return pd.DataFrame([
+        {col("component"): "C1", col("component_desc"): "", col("component_uom"): "PC",
+         col("mrp_controller"): "M01", col("current_stock"): stock, col("component_order_type"): "F",
+         "Order Type": ot, "Date": pd.Timestamp(date), "BOM Level": 1,
+         "Required Component Quantity": qty}
+        for ot, date, qty in rows
+    ])
+
+
+def test_allocate_stock_by_date():
+    merged = summarize_requirements(_demand([("L", "2026-03-01", 4), ("E", "2026-03-08", 8)], stock=10))
+    alloc = allocate_stock(merged, "date")
+    assert alloc["Allocated Quantity"].tolist() == [4, 6]
+    assert alloc["Shortage Quantity"].tolist() == [0, 2]
+    assert alloc["Remaining Stock"].tolist() == [6, 0]
+    assert alloc["Allocation Status"].tolist() == ["🟢 مغطى", "🟡 جزئي"]
+
+
+def test_allocate_stock_by_order_type():
+    merged = summarize_requirements(_demand([("L", "2026-03-01", 4), ("E", "2026-03-08", 8)], stock=10))
+    alloc = allocate_stock(merged, "order_type", order_type_rank=["E"])
+    assert alloc["Order Type"].tolist() == ["E", "L"]
+    assert alloc["Allocated Quantity"].tolist() == [8, 2]
+    assert alloc["Shortage Quantity"].tolist() == [0, 2]
@@ -0,0 +1,131 @@
+# ==============================================================================
+# اختبارات خدمة HTTP — طلب لكل مسار على خادم حقيقي (منفذ عشوائي) بمخزن SQLite مؤقت
+# ==============================================================================
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+import mrp_service
+from conftest import random_component_df, random_plan
+from mrp_engine import (
+    bom_fingerprint,
+    build_bom_model,
+    col,
+    explode_plan,
+    offset_requirement_dates,
+    save_bom_store,
+    summarize_requirements,
+)
+
+
+@pytest.fixture(scope="module")
+def bom():
+    component_df = random_component_df(seed=11)
+    return component_df, random_plan(component_df, seed=11)
+
+
+@pytest.fixture(scope="module")
+def base_url(bom, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("service") / "bom.sqlite")
+    save_bom_store(bom[0], path)
+    mrp_service.load_service_model(path)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), mrp_service.MRPRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def request(url, body=None):
+    """(status, JSON) — أخطاء HTTP تُعاد كنتيجة وليس استثناء"""
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def plan_records(plan_melted):
+    return json.loads(plan_melted.to_json(orient="records", date_format="iso"))
+
+
+def test_health(base_url, bom):
+    status, body = request(f"{base_url}/health")
+    assert status == 200
+    assert body["fingerprint"] == bom_fingerprint(bom[0])
+    assert body["rows"] == len(bom[0])
+    assert body["models"] == bom[0][col("material")].nunique()
+
+
+def test_where_used(base_url, bom):
+    component_df = bom[0]
+    # مكون داخل نصف مصنّع ⇐ يظهر مباشرة وعبر الموديلات التي تحتوي نصف المصنّع
+    semi = "10000"
+    code = component_df.loc[component_df[col("material")] == semi, col("component")].iloc[0]
+    status, rows = request(f"{base_url}/where-used?component={code}")
+    assert status == 200
+    direct = component_df[component_df[col("component")] == code]
+    assert {r[col("material")] for r in rows if r["Used Via"] == code} == set(direct[col("material")])
+    assert any(r["Used Via"] == semi for r in rows)
+
+    status, body = request(f"{base_url}/where-used")
+    assert status == 400 and "error" in body
+
+
+def test_explode(base_url, bom):
+    component_df, plan_melted = bom
+    status, rows = request(f"{base_url}/explode", {"plan": plan_records(plan_melted), "lead_time": False})
+    assert status == 200
+
+    expected = summarize_requirements(explode_plan(plan_melted, build_bom_model(component_df)))
+    actual = pd.DataFrame(rows)
+    assert len(actual) == len(expected)
+    assert actual["Required Component Quantity"].sum() == pytest.approx(
+        expected["Required Component Quantity"].sum()
+    )
+
+    status, body = request(f"{base_url}/explode", {"plan": []})
+    assert status == 400 and "error" in body
+
+
+def test_explode_controllers(base_url, bom):
+    _, plan_melted = bom
+    status, rows = request(f"{base_url}/explode", {
+        "plan": plan_records(plan_melted), "controllers": ["M01"], "detail": True,
+    })
+    assert status == 200
+    assert rows and {r[col("mrp_controller")] for r in rows} == {"M01"}
+
+
+def test_coverage(base_url, bom):
+    component_df, plan_melted = bom
+    status, rows = request(f"{base_url}/coverage", {"plan": plan_records(plan_melted)})
+    assert status == 200
+
+    result_df = offset_requirement_dates(explode_plan(plan_melted, build_bom_model(component_df)))
+    need = result_df.groupby(col("component"))["Required Component Quantity"].sum()
+    actual = pd.DataFrame(rows).set_index(col("component"))
+    assert set(actual.index) == set(need.index)
+    pd.testing.assert_series_equal(
+        actual["Required Component Quantity"].sort_index(), need.sort_index(), check_names=False
+    )
+    short = actual["Shortage Quantity"] > 0
+    assert actual.loc[short, "First Shortage Date"].notna().all()
+    assert actual.loc[~short, "First Shortage Date"].isna().all()
+
+    status, body = request(f"{base_url}/coverage", {"plan": plan_records(plan_melted), "priority": "x"})
+    assert status == 400 and "error" in body
+
+
+def test_unknown_path(base_url):
+    status, body = request(f"{base_url}/nope")
+    assert status == 404 and "error" in body